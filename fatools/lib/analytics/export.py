@@ -21,13 +21,25 @@ class autostream(object):
             self.outstream.write( buff )
 
 
-def export_major_tab(analytical_sets, dbh, outstream):
+def get_code_lookup(analytical_sets, dbh):
+    """ return CodeLookup of all samples and markers of the analytical sets """
+
+    sample_ids = set()
+    marker_ids = set()
+    for analytical_set in analytical_sets:
+        sample_ids.update( analytical_set.sample_ids )
+        marker_ids.update( analytical_set.marker_ids )
+    return dbh.get_code_lookup( sample_ids, marker_ids )
+
+
+def export_major_tab(analytical_sets, dbh, outstream, lookup=None):
 
     output = []
+    lookup = lookup or get_code_lookup(analytical_sets, dbh)
 
     for analytical_set in analytical_sets:
         data, aux_data, assay_data = tabulate_data( analytical_set.allele_df.dominant_df,
-                                            dbh )
+                                            dbh, lookup )
         output.append( (analytical_set.label, data, aux_data, assay_data) )
 
     write_csv(output, outstream)
@@ -35,12 +47,13 @@ def export_major_tab(analytical_sets, dbh, outstream):
     return output
 
 
-def export_tab(analytical_sets, dbh, outstream):
+def export_tab(analytical_sets, dbh, outstream, lookup=None):
 
     output = []
+    lookup = lookup or get_code_lookup(analytical_sets, dbh)
 
     for analytical_set in analytical_sets:
-        data, aux_data, assay_data = tabulate_data( analytical_set.allele_df.df, dbh )
+        data, aux_data, assay_data = tabulate_data( analytical_set.allele_df.df, dbh, lookup )
         output.append( (analytical_set.label, data, aux_data, assay_data) )
 
     write_csv(output, outstream)
@@ -48,15 +61,17 @@ def export_tab(analytical_sets, dbh, outstream):
     return output
 
 
-def export_major_r(analytical_sets, dbh, outstream):
+def export_major_r(analytical_sets, dbh, outstream, lookup=None):
     """ export to file suitable for loading into R
         the file will be tab-delimited and has header
     """
 
     output = []
+    lookup = lookup or get_code_lookup(analytical_sets, dbh)
+
     for analytical_set in analytical_sets:
         data, aux_data, assay_data = tabulate_data( analytical_set.allele_df.dominant_df,
-                                            dbh )
+                                            dbh, lookup )
         output.append( (analytical_set.label, data, aux_data, assay_data) )
 
     write_r(output, outstream)
@@ -64,7 +79,7 @@ def export_major_r(analytical_sets, dbh, outstream):
     return output
 
 
-def export_alleledf(analytical_sets, dbh, outstream):
+def export_alleledf(analytical_sets, dbh, outstream, lookup=None):
     """ export allele dataframe to file suitable for loading
         into R or Python's pandas
     """
@@ -72,19 +87,22 @@ def export_alleledf(analytical_sets, dbh, outstream):
     # format: LABEL SAMPLE MARKER ALLELE SIZE HEIGHT AREA BETA THETA SYM SCORE TYPE
 
     outstream.write('LABEL\tMARKER\tSAMPLE\tBIN\tSIZE\tHEIGHT\tRATIO\tRANK\n')
+    lookup = lookup or get_code_lookup(analytical_sets, dbh)
 
     for analytical_set in analytical_sets:
 
         allele_df = analytical_set.allele_df.df
-        for t in allele_df.itertuples():
-            (marker_id, sample_id, value, size, height, assay_id, allele_id, ratio, rank) = t[1:]
-            marker = dbh.get_marker_by_id(marker_id)
-            sample = dbh.get_sample_by_id(sample_id)
-            outstream.write('%s\t%s\t%s\t%d\t%f\t%d\t%f\t%d\n' %
-                (analytical_set.label, marker.code, sample.code, value, size, height, ratio, rank))
+        if len(allele_df) == 0:
+            continue
+        label = analytical_set.label
+        for row in zip( allele_df['marker_id'].map(lookup.markers),
+                        allele_df['sample_id'].map(lookup.samples),
+                        allele_df['value'], allele_df['size'], allele_df['height'],
+                        allele_df['ratio'], allele_df['rank'] ):
+            outstream.write('%s\t%s\t%s\t%d\t%f\t%d\t%f\t%d\n' % ((label,) + row))
 
 
-def export_moidf(analytical_sets, dbh, outstream):
+def export_moidf(analytical_sets, dbh, outstream, lookup=None):
     """ export MoI dataframe to a file suitable for loading into
         R or Python's pandas
     """
@@ -94,21 +112,24 @@ def export_moidf(analytical_sets, dbh, outstream):
     # format: LABEL SAMPLE MOI MLOCI
 
     outstream.write('LABEL\tSAMPLE\tMOI\tMLOCI\n')
+    if dbh and not lookup:
+        lookup = get_code_lookup(analytical_sets, dbh)
 
     for analytical_set in analytical_sets:
         moi_result = calculate_moi(analytical_set.allele_df)
         label = analytical_set.label
-        for t in moi_result.sample_dist.itertuples():
+        sample_dist = moi_result.sample_dist
+        if lookup:
+            sample_codes = sample_dist.index.map(lookup.samples)
+        else:
+            sample_codes = sample_dist.index.map(str)
+        for (sample_code, t) in zip(sample_codes, sample_dist.itertuples()):
             (sample_id, moi_number, mloci_number) = t
-            if dbh:
-                sample_code = dbh.get_sample_by_id(sample_id).code
-            else:
-                sample_code = str(sample_id)
             outstream.write('%s\t%s\t%d\t%d\n' %
                 (label, sample_code, moi_number, mloci_number))
 
 
-def export_arlequin(analytical_sets, dbh, outstream, recode=False):
+def export_arlequin(analytical_sets, dbh, outstream, recode=False, lookup=None):
     """ export MLGT to Arlequin format
         recode: whether to use population-spesific alleles
     """
@@ -153,7 +174,7 @@ def export_arlequin(analytical_sets, dbh, outstream, recode=False):
     outstream.write( '\n'.join(_))
 
 
-def export_demetics(analytical_sets, dbh, outstream):
+def export_demetics(analytical_sets, dbh, outstream, lookup=None):
     """ export genotype data for export_demetics
         individual population fragment.length locus
         (individual -> sample code, population -> label, fragment.length -> allele, locus -> marker)
@@ -163,6 +184,7 @@ def export_demetics(analytical_sets, dbh, outstream):
     outstream.write('individual\tpopulation\tfragment.length\tlocus\n')
     labels = []
     label_pos = 0
+    lookup = lookup or get_code_lookup(analytical_sets, dbh)
 
     for analytical_set in analytical_sets:
 
@@ -170,12 +192,12 @@ def export_demetics(analytical_sets, dbh, outstream):
         label_id = label_pos
         label_pos += 1
         allele_df = analytical_set.allele_df.df
-        for t in allele_df.itertuples():
-            (marker_id, sample_id, value, size, height, assay_id, allele_id, ratio, rank) = t[1:]
-            marker = dbh.get_marker_by_id(marker_id)
-            #sample = dbh.get_sample_by_id(sample_id)
+        if len(allele_df) == 0:
+            continue
+        for (sample_id, value, marker_code) in zip( allele_df['sample_id'], allele_df['value'],
+                        allele_df['marker_id'].map(lookup.markers) ):
             outstream.write('%s\t%s\t%d\t%s\n' %
-                (sample_id, label_id, value, marker.code))
+                (sample_id, label_id, value, marker_code))
 
 
 def export_flat(analytical_set, dbh, outstream):
@@ -234,10 +256,12 @@ def export(analytical_sets, dbh, outfile, format='major_tab'):
     else:
         outstream = open(outfile, 'wt')
 
-    export_func(analytical_sets, dbh, outstream)
+    # codes of all samples & markers, shared by the exporters
+    lookup = get_code_lookup(analytical_sets, dbh) if dbh else None
+    export_func(analytical_sets, dbh, outstream, lookup=lookup)
 
 
-def tabulate_data( allele_df, dbh ):
+def tabulate_data( allele_df, dbh, lookup=None ):
 
     buf = []
     buf2 = []
@@ -255,26 +279,28 @@ def tabulate_data( allele_df, dbh ):
                             index='sample_id', columns='marker_id', values='assay_id',
                             aggfunc = lambda x: tuple(x) )
 
-    buf.append( tuple( ['Sample', 'ID'] +
-                    [ dbh.get_marker_by_id(x).code for x in table.columns ] ) )
-    buf2.append( tuple( ['Sample', 'ID'] +
-                    [ dbh.get_marker_by_id(x).code for x in heights.columns ] ) )
-    buf3.append( tuple( ['Sample', 'ID'] +
-                    [ dbh.get_marker_by_id(x).code for x in assay_ids.columns ] ) )
+    if lookup is None:
+        lookup = dbh.get_code_lookup( allele_df['sample_id'].unique(),
+                                        allele_df['marker_id'].unique() )
+
+    buf.append( tuple( ['Sample', 'ID'] + lookup.marker_codes(table.columns) ) )
+    buf2.append( tuple( ['Sample', 'ID'] + lookup.marker_codes(heights.columns) ) )
+    buf3.append( tuple( ['Sample', 'ID'] + lookup.marker_codes(assay_ids.columns) ) )
 
 
     empty = tuple()
 
-    rows = [ ((dbh.get_sample_by_id(r[0]).code,), (r[0],)) + r[1:]
-                for r in table.itertuples() ]
+    rows = [ ((code,), (r[0],)) + r[1:]
+                for (code, r) in zip(table.index.map(lookup.samples), table.itertuples()) ]
     rows.sort()
 
-    height_rows = [ ((dbh.get_sample_by_id(r[0]).code,), (r[0],)) + r[1:]
-                                for r in heights.itertuples() ]
+    height_rows = [ ((code,), (r[0],)) + r[1:]
+                for (code, r) in zip(heights.index.map(lookup.samples), heights.itertuples()) ]
     height_rows.sort()
 
-    assayid_rows = [ ((dbh.get_sample_by_id(r[0]).code,), (r[0],)) + r[1:]
-                                for r in assay_ids.itertuples() ]
+    assayid_rows = [ ((code,), (r[0],)) + r[1:]
+                for (code, r) in zip(assay_ids.index.map(lookup.samples),
+                                        assay_ids.itertuples()) ]
     assayid_rows.sort()
 
     for row in rows:
@@ -56,12 +56,29 @@ class Query(object):
         if self._analytical_sets is None or sample_ids:
             cerr('[query]: getting initial analytical sets')
             sample_sets = self.get_sample_sets( sample_ids )
+            self.prefetch_alleles( sample_sets )
             self._analytical_sets = get_analytical_sets( self._dbh, sample_sets,
                                         self._params['filter'] )
             cerr('[query]: initial total samples: %d' % self._analytical_sets.total_samples)
         return self._analytical_sets
 
 
+    def prefetch_alleles(self, sample_sets):
+        """ pull alleles of all samples in sample_sets with a single query; the
+            db handler caches the result, and the analytical sets of this and
+            the later filtering stages are derived from it
+        """
+        if not getattr(self._dbh, 'allele_cache_size', 0):
+            return
+        params = self._params['filter']
+        marker_ids = params.get_marker_ids(self._dbh)
+        sample_ids = set()
+        for sample_set in sample_sets:
+            sample_ids.update( sample_set.sample_ids )
+        if sample_ids and marker_ids:
+            self._dbh.get_allele_dataframe( sample_ids, marker_ids, params )
+
+
     def get_filtered_sample_sets(self, sample_ids = None):
         if self._filtered_sample_sets is None or sample_ids:
             if not sample_ids:
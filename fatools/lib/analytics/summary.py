@@ -123,14 +123,11 @@ def summarize_bins( analytical_sets ):
     # collect items (sizes) for each marker
     for label in allele_summaries:
         for (marker_id, allele_summary) in allele_summaries[label]['summary'].items():
-            pprint(allele_summary)
             for allele_params in allele_summary['alleles']:
                 bin_value = allele_params[0]
                 size_items = allele_params[9][0]
                 marker_summaries[marker_id][bin_value].extend( size_items )
-                marker_summaries[marker_id][bin_value].sort()
 
-    pprint(marker_summaries)
     bin_summaries = {}
 
     # process marker summary to obtain new bin paramater
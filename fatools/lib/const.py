@@ -60,6 +60,8 @@ class alignmethod(object):
     gm_strict = 'gm|strict'
     gm_relax = 'gm|relax'
     de_relax = 'de|relax'
+    dtw_strict = 'dtw|strict'
+    dtw_relax = 'dtw|relax'
 
 
 class scanningmethod(object):
@@ -19,6 +19,11 @@ from matplotlib import pylab as plt
 from bisect import bisect_left
 
 
+FIND_RAW_PEAKS_VERSION = 1
+""" version of find_raw_peaks(), to be increased whenever its results change, so
+    that peaks cached by previous versions are not used
+"""
+
 def find_raw_peaks( raw_data, params ):
 
     max_height = max(raw_data)
@@ -198,14 +203,52 @@ def find_peaks( raw_data,  params, raw_peaks = None ):
 ## allele datatype
 
 
-def scan_peaks( channel, params, peakdb ):
+def scan_peaks( channel, params, peakdb, peaks = None ):
     """
     scan for peaks based on the criteria defined in params, set as peak-scanned,
-    and prepare the channel data structure
+    and prepare the channel data structure; peaks already selected by
+    select_peaks() can be given
+    """
+
+    if peaks is None:
+        peaks = select_peaks( channel, params, peakdb )
+
+    # create alleles based on these peaks
+    alleles = []
+    for peak in peaks:
+        ( rtime, height, area, brtime, ertime, srtime, beta, theta ) = peak
+        wrtime = ertime - brtime
+        height = round(height)
+        allele = channel.new_allele(    rtime = rtime,
+                                        height = height,
+                                        area = area,
+                                        brtime = brtime,
+                                        ertime = ertime,
+                                        wrtime = wrtime,
+                                        srtime = srtime,
+                                        beta = beta,
+                                        theta = theta )
+        allele.type = peaktype.scanned
+        allele.method = binningmethod.notavailable
+        allele.marker = channel.marker
+        alleles.append( allele )
+
+    return alleles
+
+
+def select_peaks( channel, params, peakdb ):
+    """
+    return peaks of channel as list of
+    ( rtime, height, area, brtime, ertime, srtime, beta, theta )
     """
 
     if peakdb:
-        raw_peaks = pickle.loads(peakdb.Get(channel.tag().encode()))
+        # peakdb is peakcache.PeakCache
+        key = peakdb.make_key( channel.data, params, FIND_RAW_PEAKS_VERSION )
+        raw_peaks = peakdb.get( key )
+        if raw_peaks is None:
+            raw_peaks = find_raw_peaks( channel.data, params )
+            peakdb.put( key, raw_peaks )
     else:
         raw_peaks = None
 
@@ -251,28 +294,7 @@ def scan_peaks( channel, params, peakdb ):
     else:
         peaks = initial_peaks
 
-
-    # create alleles based on these peaks
-    alleles = []
-    for peak in peaks:
-        ( rtime, height, area, brtime, ertime, srtime, beta, theta ) = peak
-        wrtime = ertime - brtime
-        height = round(height)
-        allele = channel.new_allele(    rtime = rtime,
-                                        height = height,
-                                        area = area,
-                                        brtime = brtime,
-                                        ertime = ertime,
-                                        wrtime = wrtime,
-                                        srtime = srtime,
-                                        beta = beta,
-                                        theta = theta )
-        allele.type = peaktype.scanned
-        allele.method = binningmethod.notavailable
-        allele.marker = channel.marker
-        alleles.append( allele )
-
-    return alleles
+    return peaks
 
 
 
@@ -516,36 +538,23 @@ def call_peaks( channel, params, func, min_rtime, max_rtime ):
 
 def bin_peaks(channel, params, marker):
 
-    #sortedbins = marker.sortedbins
-    sortedbins = marker.get_sortedbins(channel.batch)
-    threshold = float(marker.repeats)/2 * 1.5
+    binindex = marker.get_binindex(channel.batch)
+
+    peaks = [ peak for peak in channel.all_alleles if peak.size >= 0 ]
+    if not peaks:
+        return
 
-    for peak in channel.alleles:
+    sizes = np.array( [ peak.size for peak in peaks ], dtype=float )
+    inrange = (sizes > marker.min_size) & (sizes < marker.max_size)
+    bins = binindex.bin_values( sizes ).tolist()
 
-        if peak.size < 0: continue
+    for peak, flag, bin_value in zip( peaks, inrange, bins ):
 
-        if not marker.min_size < peak.size < marker.max_size:
+        if not flag:
             peak.type = peaktype.unassigned
             continue
 
-        size = peak.size
-        idx = sortedbins.bisect_key_right( size )
-
-        if idx==0:
-            curr_bin = sortedbins[0]
-        elif idx == len(sortedbins):
-            curr_bin = sortedbins[-1]
-        else:
-            left_bin = sortedbins[idx-1]
-            right_bin = sortedbins[idx]
-
-            if size - left_bin[3] < right_bin[2] - size:
-                # belongs tp left_bin
-                curr_bin = left_bin
-            else:
-                curr_bin = right_bin
-
-        peak.bin = curr_bin[0]
+        peak.bin = bin_value
 
         # only assigned peak as bin if it unassigned or called
         if peak.type in [ peaktype.unassigned, peaktype.called ]:
@@ -560,7 +569,7 @@ def postannotate_peaks( channel, params ):
     # peak is stutter if the range < params.stutter_range and
     # ratio < params.stutter_ratio
 
-    alleles = sorted(list(channel.alleles), key = lambda x: x.height, reverse=True)
+    alleles = sorted(list(channel.all_alleles), key = lambda x: x.height, reverse=True)
     prev_alleles = []
 
     for allele in alleles:
@@ -6,11 +6,14 @@ from fatools.lib import const
 from fatools.lib.fautil.hcalign import align_hc
 from fatools.lib.fautil.gmalign import align_gm, align_sh, align_de
 from fatools.lib.fautil.pmalign import align_pm
+from fatools.lib.fautil.dtwalign import align_dtw
+from fatools.lib.fautil.fftalign import estimate_fft, check_fft
 
 from sortedcontainers import SortedListWithKey
 
 from scipy import signal, ndimage
 from scipy.optimize import curve_fit
+from scipy.interpolate import UnivariateSpline
 from peakutils import indexes
 
 import pandas as pd
@@ -227,24 +230,42 @@ def call_peaks( channel, params, func, min_rtime, max_rtime ):
     peak-called or peak-unassigned
     """
 
-    
-    for allele in channel.alleles:
+    call_alleles( channel.alleles, func, min_rtime, max_rtime )
 
-        if not min_rtime < allele.rtime < max_rtime:
-            if allele.type == const.peaktype.scanned:
-                allele.type = const.peaktype.unassigned
-            print("allele at ", allele.rtime," not called... outside range [", min_rtime, ", ", max_rtime, "]!")
-            continue
-        size, deviation, qcall, method = func(allele.rtime)
+
+def call_alleles( alleles, calibration, min_rtime, max_rtime ):
+    """
+    size alleles (eg. from all non-ladder channels of an assay) in one vectorized call
+    using LadderCalibration, and annotate as either peak-called or peak-unassigned
+    """
+
+    if not alleles:
+        return
+
+    rtimes = np.array( [ allele.rtime for allele in alleles ], dtype=float )
+    inside = (rtimes > min_rtime) & (rtimes < max_rtime)
+
+    sizes, deviations, qcalls = calibration.size( rtimes[inside] )
+    bins = np.round(sizes).astype(int)
+
+    called = [ allele for (allele, flag) in zip(alleles, inside) if flag ]
+    for allele, size, bin, deviation, qcall in zip( called, sizes.tolist(), bins.tolist(),
+                deviations.tolist(), qcalls.tolist() ):
         allele.size = size
-        allele.bin = round(size)
+        allele.bin = bin
         allele.deviation = deviation
         allele.qcall = qcall
         if allele.type == const.peaktype.scanned:
             allele.type = const.peaktype.called
         allele.method = const.binningmethod.notavailable
-    
-        print(allele)
+
+    for allele in [ allele for (allele, flag) in zip(alleles, inside) if not flag ]:
+        if allele.type == const.peaktype.scanned:
+            allele.type = const.peaktype.unassigned
+
+    cverr(3, 'D: called %d peak(s), %d peak(s) outside range [%d, %d]' %
+            (len(called), len(alleles) - len(called), min_rtime, max_rtime))
+
 
 def align_peaks(channel, params, ladder, anchor_pairs=None):
     """
@@ -260,8 +281,10 @@ def align_peaks(channel, params, ladder, anchor_pairs=None):
 
     #anchor_pairs = pairs
 
+    jobs, pool = params.ladder.align_jobs, params.ladder.align_pool
+
     if anchor_pairs:
-        return align_pm( alleles, ladder, anchor_pairs)
+        return align_pm( alleles, ladder, anchor_pairs, jobs=jobs, pool=pool)
 
     if len(alleles) <= len(ladder['sizes']) + 5:
         result = align_hc( alleles, ladder )
@@ -269,7 +292,27 @@ def align_peaks(channel, params, ladder, anchor_pairs=None):
         if result.score > 0.9:
             return result
 
-    return align_pm( alleles, ladder )
+    # coarse registration of the trace, used as initial z for PM and DTW only if
+    # it passes QC
+    initial_z, xcorr = estimate_fft( alleles, ladder['sizes'], channel.data )
+    if not check_fft( alleles, ladder['sizes'], initial_z, xcorr ):
+        initial_z = None
+
+    if initial_z is not None:
+        result = align_pm( alleles, ladder, initial_z=initial_z, jobs=jobs, pool=pool )
+        if result.score > 0.9:
+            return result
+
+    result = align_pm( alleles, ladder, jobs=jobs, pool=pool )
+    if result.score > 0.9:
+        return result
+
+    # DTW on the trace signal is only tried when PM fails, until its scores have
+    # been validated against existing alignments
+    dtw_result = align_dtw( alleles, ladder, channel.data, initial_z )
+    if dtw_result.score > result.score:
+        return dtw_result
+    return result
 
     if result.initial_pairs:
         result = align_gm( alleles, ladder, result.initial_pairs )
@@ -764,36 +807,68 @@ def generate_scoring_function( strict_params, relax_params ):
 
     return _scoring_func
 
+@attr.s
+class LadderCalibration(object):
+    """ ladder calibration compiled once, and used to size whole array of rtimes
+    """
+    method = attr.ib()
+    func = attr.ib()        # array of rtimes -> (sizes, deviations, qcalls)
+
+    def size(self, rtimes):
+        """ return arrays of (sizes, deviations, qcalls) """
+        return self.func( np.asarray(rtimes, dtype=float) )
+
+    def __call__(self, rtime):
+        """ return (size, deviation, qcall, method) of a single rtime """
+        sizes, deviations, qcalls = self.size( [rtime] )
+        return (sizes[0], deviations[0], qcalls[0], self.method)
+
+
+def _ladder_arrays( ladder_alleles ):
+    """ return ladder alleles sorted by rtime, and their rtimes, sizes and qscores """
+    ladders = sorted( ladder_alleles, key = lambda k: k.rtime )
+    x = np.array( [ p.rtime for p in ladders ], dtype=float )
+    y = np.array( [ p.size for p in ladders ], dtype=float )
+    q = np.array( [ p.qscore for p in ladders ], dtype=float )
+    return ladders, x, y, q
+
+
+def _neighbours( x, rtimes ):
+    """ return indices of left-closest and right-closest ladders """
+    right_idx = np.minimum( np.searchsorted(x, rtimes, side='right'), len(x) - 1 )
+    return right_idx - 1, right_idx
+
+
+def compile_calibration( ladder_alleles, method, z=None ):
+    """ return LadderCalibration for the allele method """
+
+    if method == const.allelemethod.leastsquare:
+        return least_square( ladder_alleles, z )
+    elif method == const.allelemethod.cubicspline:
+        return cubic_spline( ladder_alleles )
+    elif method == const.allelemethod.localsouthern:
+        return local_southern( ladder_alleles )
+    raise RuntimeError('E: unknown allele method: %s' % method)
+
+
 def least_square( ladder_alleles, z ):
 
     """ 3rd order polynomial resolver
     """
-    
-    ladder_allele_sorted = SortedListWithKey( ladder_alleles, key = lambda k: k.rtime )
-    f = np.poly1d(z)
 
-    def _f( rtime ):
-        size = f(rtime)
-        # get the left-closest and right-closest ladder
-
-        #left_idx = ladder_allele_sorted.bisect_key_left( rtime )
-        right_idx = ladder_allele_sorted.bisect_key_right( rtime )
-        left_idx = right_idx - 1
-        left_ladder = ladder_allele_sorted[left_idx]
-        right_ladder = ladder_allele_sorted[right_idx]
+    ladders, x, y, q = _ladder_arrays( ladder_alleles )
+    f = np.poly1d(z)
 
-        left_ladder.deviation = (left_ladder.size - f(left_ladder.rtime))**2
-        right_ladder.deviation = (right_ladder.size - f(right_ladder.rtime))**2
-        
-        #cerr(' ==> rtime: %d/%4.2f  [ %d/%4.2f | %d/%4.2f ]' % ( rtime, size,
-        #            left_ladder.rtime, left_ladder.size,
-        #            right_ladder.rtime, right_ladder.size))
+    deviations = (y - f(x))**2
+    for ladder, deviation in zip(ladders, deviations):
+        ladder.deviation = deviation
 
-        return (size, (left_ladder.deviation + right_ladder.deviation) / 2,
-                        min( left_ladder.qscore, right_ladder.qscore ),
-                        const.allelemethod.leastsquare)
+    def _f( rtimes ):
+        left_idx, right_idx = _neighbours( x, rtimes )
+        return ( f(rtimes), (deviations[left_idx] + deviations[right_idx]) / 2,
+                    np.minimum( q[left_idx], q[right_idx] ) )
 
-    return _f
+    return LadderCalibration( const.allelemethod.leastsquare, _f )
 
 
 def cubic_spline( ladder_alleles ):
@@ -801,68 +876,62 @@ def cubic_spline( ladder_alleles ):
         x is peaks, y is standard size
     """
 
-    ladder_allele_sorted = SortedListWithKey( ladder_alleles, key = lambda k: k.rtime )
-
-    ladder_peaks = []
-    ladder_sizes = []
-    for ladder_allele in ladder_allele_sorted:
-        ladder_peaks.append( ladder_allele.rtime )
-        ladder_sizes.append( ladder_allele.size )
-    f = UnivariateSpline(ladder_peaks, ladder_sizes, k=3, s=0)
-
-    def _f( rtime ):
-        size = f(rtime)
-
-        right_idx = ladder_allele_sorted.bisect_key_right( rtime )
-        left_idx = right_idx - 1
-        left_ladder = ladder_allele_sorted[left_idx]
-        right_ladder = ladder_allele_sorted[right_idx]
+    ladders, x, y, q = _ladder_arrays( ladder_alleles )
+    f = UnivariateSpline(x, y, k=3, s=0)
+    deviations = np.array( [ getattr(p, 'deviation', 0.0) for p in ladders ], dtype=float )
 
-        return (size, (left_ladder.deviation + right_ladder.deviation) / 2,
-                        min( left_ladder.qscore, right_ladder.qscore),
-                        allelemethod.cubicspline)
+    def _f( rtimes ):
+        left_idx, right_idx = _neighbours( x, rtimes )
+        return ( f(rtimes), (deviations[left_idx] + deviations[right_idx]) / 2,
+                    np.minimum( q[left_idx], q[right_idx] ) )
 
-    return _f
+    return LadderCalibration( const.allelemethod.cubicspline, _f )
 
 
 def local_southern( ladder_alleles ):
-    """ southern local interpolation """
+    """ southern local interpolation
+        the left and right curves of each interval between ladders are precomputed,
+        deviation is calculated as delta square between both curves
+    """
 
-    ladder_allele_sorted = SortedListWithKey( ladder_alleles, key = lambda k: k.rtime )
-    x = [ p.rtime for p in ladder_allele_sorted ]
-    y = [ p.size for p in ladder_allele_sorted ]
+    ladders, x, y, q = _ladder_arrays( ladder_alleles )
+    N = len(x)
 
-    def _f( rtime ):
-        """ return (size, deviation)
-            deviation is calculated as delta square between curve1 and curve2
-        """
+    # curves for idx = 0 .. N, as quadratic coefficients
+    Z1 = np.zeros( (N + 1, 3) )
+    Z2 = np.zeros( (N + 1, 3) )
+    S1 = np.zeros( N + 1 )
+    S2 = np.zeros( N + 1 )
+
+    edge_z1 = np.polyfit( x[0:3], y[0:3], 1)
+    edge_z2 = np.polyfit( x[-3:], y[-3:], 1)
 
-        idx = ladder_allele_sorted.bisect_key_right( rtime )
+    for idx in range(N + 1):
 
         # left curve
-        if (idx>1 and idx<len(x)-1):
-            z1 = np.polyfit( x[idx-2:idx+1], y[idx-2:idx+1], 2)
-            min_score1 = min( z.qscore for z in ladder_allele_sorted[idx-2:idx+1] )
+        if (idx>1 and idx<N-1):
+            Z1[idx] = np.polyfit( x[idx-2:idx+1], y[idx-2:idx+1], 2)
+            S1[idx] = q[idx-2:idx+1].min()
         else:
-            z1 = np.polyfit( x[0:3], y[0:3], 1)
-            min_score1 = .5 * min( z.qscore for z in ladder_allele_sorted[0:3] )
-            
-        size1 = np.poly1d( z1 )(rtime)           
-            
+            Z1[idx, 1:] = edge_z1
+            S1[idx] = .5 * q[0:3].min()
+
         # right curve
-        if (idx<len(x)-2 and idx>0):
-            z2 = np.polyfit( x[idx-1:idx+2], y[idx-1:idx+2], 2)
-            min_score2 = min( x.qscore for x in ladder_allele_sorted[idx-1:idx+2] )
+        if (idx<N-2 and idx>0):
+            Z2[idx] = np.polyfit( x[idx-1:idx+2], y[idx-1:idx+2], 2)
+            S2[idx] = q[idx-1:idx+2].min()
         else:
-            z2 = np.polyfit(x[-3:], y[-3:], 1)
-            min_score2 = .5 * min( z.qscore for z in ladder_allele_sorted[-3:] )
-
-        size2 = np.poly1d( z2 )(rtime)
+            Z2[idx, 1:] = edge_z2
+            S2[idx] = .5 * q[-3:].min()
 
-        return ( (size1 + size2)/2, (size1 - size2) ** 2, (min_score1 + min_score2)/2,
-                const.allelemethod.localsouthern)
+    def _f( rtimes ):
+        idx = np.searchsorted(x, rtimes, side='right')
+        c1, c2 = Z1[idx], Z2[idx]
+        size1 = (c1[:,0] * rtimes + c1[:,1]) * rtimes + c1[:,2]
+        size2 = (c2[:,0] * rtimes + c2[:,1]) * rtimes + c2[:,2]
+        return ( (size1 + size2)/2, (size1 - size2) ** 2, (S1[idx] + S2[idx])/2 )
 
-    return _f
+    return LadderCalibration( const.allelemethod.localsouthern, _f )
 
 
 ## this is a new algorithm and steps to perform peak analysis
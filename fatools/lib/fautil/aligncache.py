@@ -0,0 +1,152 @@
+# aligncache.py
+# cache of ladder alignment results, keyed by fingerprint of the ladder peaks
+
+from fatools.lib.utils import cerr, cverr
+
+import numpy as np
+import hashlib
+import json
+import os
+
+
+EXECUTION_SETTINGS = ( 'align_jobs', 'align_pool' )
+""" parameters that do not change alignment results """
+
+ALIGNMENT_VERSION = 1
+""" version of the ladder alignment code, to be increased whenever its results
+    change, so that results cached by previous versions are not used
+"""
+
+FORMAT_VERSION = 1
+""" version of the format of the entry files """
+
+
+def param_signature(params):
+    """ return a stable string representation of a parameter object, including
+        its class attributes and nested parameter objects, but not the execution
+        settings
+    """
+    if params is None:
+        return ''
+    if not hasattr(params, '__dict__'):
+        return repr(params)
+    items = []
+    for k in dir(params):
+        if k.startswith('_') or k in EXECUTION_SETTINGS:
+            continue
+        v = getattr(params, k)
+        if callable(v):
+            continue
+        items.append( (k, param_signature(v) if hasattr(v, '__dict__') else repr(v)) )
+    return repr( items )
+
+
+def ladder_signature(ladder):
+    """ return a stable string representation of a ladder definition """
+    return repr( ( ladder['code'], [ float(s) for s in ladder['sizes'] ],
+                    [ float(s) for s in ladder.get('signature', ladder['sizes']) ],
+                    ladder['k'], sorted( dict(ladder['strict']).items() ),
+                    sorted( dict(ladder['relax']).items() ) ) )
+
+
+def fingerprint(peaks, ladder, params=None, method=''):
+    """ return hex digest of ladder peaks (rtime & height), ladder definition,
+        alignment parameters, alignment method and version
+    """
+    h = hashlib.sha1()
+    h.update( ('%d|' % ALIGNMENT_VERSION).encode('UTF-8') )
+    h.update( np.array( [ p.rtime for p in peaks ], dtype=np.int64 ).tobytes() )
+    h.update( np.array( [ p.height for p in peaks ], dtype=np.float64 ).tobytes() )
+    h.update( ('%s|%s|' % (ladder_signature(ladder), method)).encode('UTF-8') )
+    h.update( param_signature(params).encode('UTF-8') )
+    return h.hexdigest()
+
+
+class AlignCache(object):
+    """ alignment results are stored as plain dict:
+            z, rss, dpscore, score, msg, method and pairs of (size, rtime)
+        if path is given, entries are also kept as JSON files under path, with
+        the format version; files of other versions are ignored
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None and self.path:
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                entry = self._load(filename)
+                if entry is not None:
+                    self.entries[key] = entry
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if self.path:
+            filename = self._filename(key)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmpname = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmpname, 'w') as f:
+                json.dump( dict(version = FORMAT_VERSION, entry = entry), f )
+            os.replace(tmpname, filename)
+
+
+    def _load(self, filename):
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except ValueError:
+            cerr('W: invalid alignment cache file %s, ignored' % filename)
+            return None
+        if not isinstance(data, dict) or data.get('version') != FORMAT_VERSION:
+            return None
+        return data['entry']
+
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+
+    def report(self):
+        cerr('I: alignment cache - hit: %d, miss: %d' % (self.hits, self.misses))
+
+
+def make_entry(z, rss, dpscore, score, msg, method, sized_peaks):
+    """ sized_peaks is list of (size, peak) """
+    return dict( z = [ float(x) for x in z ], rss = float(rss), dpscore = float(dpscore),
+                score = score, msg = msg, method = method,
+                pairs = [ (float(s), int(p.rtime)) for (s, p) in sized_peaks ] )
+
+
+def sized_peaks_from_entry(entry, peaks):
+    """ translate cached (size, rtime) back to [ (size, peak), ... ] """
+    d_peaks = { p.rtime: p for p in peaks }
+    return [ (s, d_peaks[rtime]) for (s, rtime) in entry['pairs'] ]
+
+
+_cache = None
+
+def set_cache(path=None):
+    """ activate alignment cache, optionally persisted under path """
+    global _cache
+    _cache = AlignCache(path)
+    cverr(3, 'D: using alignment cache at %s' % path)
+    return _cache
+
+
+def get_cache():
+    """ return active alignment cache, or None """
+    return _cache
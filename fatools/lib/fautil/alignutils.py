@@ -187,6 +187,42 @@ def generate_scores(sizes, rtimes, similarity, func, tolerance = 4):
     return M
 
 
+def render_template(positions, length, sigma=1.5):
+    """ return array of given length containing unit-height gaussian peaks
+        centered at positions, used as synthetic ladder trace
+    """
+
+    radius = 4 * sigma
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) == 0:
+        return np.zeros(length)
+
+    # window of each peak is int(pos - radius) .. int(pos + radius)
+    lo = np.trunc(positions - radius).astype(int)
+    hi = np.trunc(positions + radius).astype(int)
+    idx = lo[:, None] + np.arange( int(np.max(hi - lo)) + 1 )
+    mask = (idx <= hi[:, None]) & (idx >= 0) & (idx < length)
+    values = np.exp( - (idx - positions[:, None])**2 / (2 * sigma**2) )
+    template = np.bincount( idx[mask], weights = values[mask], minlength = length )
+
+    return np.minimum(template[:length], 1.0)
+
+
+def normalize_trace(data, peaks, start, end, step=1):
+    """ return trace of data[start:end], scaled by median height of peaks and
+        clipped to [0, 1], and downsampled by taking the maximum of each step
+    """
+
+    scale = np.median( [ p.rfu for p in peaks ] ) if peaks else 1.0
+    trace = np.clip( np.asarray(data[start:end], dtype=float) / max(scale, 1), 0, 1 )
+
+    if step > 1:
+        trace = np.append( trace, np.zeros( -len(trace) % step ) )
+        trace = trace.reshape(-1, step).max(axis=1)
+
+    return trace
+
+
 def plot(rtimes, sizes, z, peak_pairs):
     """ plot rtimes, sizes, z and peak pairs
     """
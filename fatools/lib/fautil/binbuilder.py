@@ -0,0 +1,100 @@
+# binbuilder.py
+# build empirical bins from population allele size distribution
+
+from fatools.lib.utils import cverr
+from fatools.lib.fautil.binindex import grouped_percentile
+
+import numpy as np
+
+
+def smooth_histogram(sizes, resolution=0.05, bandwidth=0.25):
+    """ return (edge, density) where density is the histogram of sizes with bin
+        width resolution, smoothed with Gaussian kernel of sd bandwidth, and
+        edge is the size of the first histogram bin
+    """
+
+    edge = np.floor(sizes.min()) - 4 * bandwidth
+    counts = np.bincount( ((sizes - edge) / resolution).astype(int) ).astype(float)
+
+    half = int(np.ceil(4 * bandwidth / resolution))
+    x = np.arange(-half, half + 1) * resolution
+    kernel = np.exp( -0.5 * (x / bandwidth) ** 2 )
+    density = np.convolve( counts, kernel / kernel.sum(), mode='same' )
+
+    return edge, density
+
+
+def find_centers(density, min_distance, min_height=0):
+    """ return indexes of local maxima of density, sorted by position, where
+        maxima closer than min_distance to a higher one are discarded
+    """
+
+    d = density
+    maxima = np.flatnonzero( (d[1:-1] > d[:-2]) & (d[1:-1] >= d[2:]) & (d[1:-1] > min_height) ) + 1
+
+    # greedy, from the highest maxima
+    accepted = []
+    for i in maxima[ np.argsort( -d[maxima], kind='stable' ) ]:
+        if all( abs(i - j) >= min_distance for j in accepted ):
+            accepted.append(i)
+
+    return np.array(sorted(accepted), dtype=int)
+
+
+def build_bins(sizes, repeats, min_size=None, max_size=None, resolution=0.05,
+            bandwidth=0.25, separation=0.6, min_count=3, min_ratio=0.002):
+    """ find bin centers as peaks of the kernel density of sizes, and return bins
+        of [ bin_value, mean, 25percentile, 75percentile ] sorted by bin value,
+        as used by Bin.bins
+        bin values are placed on the repeat unit grid, anchored at the most
+        populated bin; peaks closer than separation * repeats are merged, and
+        peaks with less than min_count sizes or less than min_ratio of the most
+        populated bin are discarded
+    """
+
+    sizes = np.asarray(sizes, dtype=float)
+    sizes = sizes[ sizes >= 0 ]
+    if min_size is not None:
+        sizes = sizes[ sizes > min_size ]
+    if max_size is not None:
+        sizes = sizes[ sizes < max_size ]
+    if len(sizes) == 0:
+        return []
+
+    edge, density = smooth_histogram(sizes, resolution, bandwidth)
+    peaks = find_centers(density, separation * repeats / resolution)
+    if len(peaks) == 0:
+        return []
+    centers = edge + (peaks + 0.5) * resolution
+
+    # group sizes within half of the minimum separation around each center
+    half = separation * repeats / 2
+    sizes = np.sort(sizes)
+    starts = np.searchsorted( sizes, centers - half )
+    counts = np.searchsorted( sizes, centers + half, side='right' ) - starts
+    keep = (counts >= min_count) & (counts >= min_ratio * counts.max())
+    if not keep.any():
+        return []
+
+    starts, counts = starts[keep], counts[keep]
+    cumsum = np.r_[0, np.cumsum(sizes)]
+    means = (cumsum[starts + counts] - cumsum[starts]) / counts
+    lows = grouped_percentile( sizes, starts, counts, 25 )
+    highs = grouped_percentile( sizes, starts, counts, 75 )
+
+    # bin values on the repeat grid, relative to the most populated bin
+    anchor = np.argmax(counts)
+    base = int(round(means[anchor]))
+    values = base + repeats * np.round( (means - means[anchor]) / repeats ).astype(int)
+
+    bins = {}
+    for (value, count, mean, low, high) in zip(values.tolist(), counts, means, lows, highs):
+        if value in bins:
+            if bins[value][0] >= count:
+                cverr(3, 'D: bin %d - discarding minor peak at %5.2f' % (value, mean))
+                continue
+            cverr(3, 'D: bin %d - discarding minor peak at %5.2f' % (value, bins[value][1][1]))
+        bins[value] = ( count, [ int(value), round(float(mean), 3),
+                            round(float(low), 3), round(float(high), 3) ] )
+
+    return [ bins[value][1] for value in sorted(bins) ]
@@ -0,0 +1,88 @@
+# binindex.py
+# vectorized bin assignment
+
+import numpy as np
+import itertools
+
+
+# global version counter, bumped whenever any bins change
+_versions = itertools.count(1)
+
+def next_version():
+    return next(_versions)
+
+
+class BinIndex(object):
+    """ bins of a marker as parallel arrays sorted by bin center:
+            values, centers, lows, highs
+        each bin is defined as [ bin_value, center, low, high ]
+    """
+
+    def __init__(self, values, centers, lows, highs, version=0):
+        self.values = values
+        self.centers = centers
+        self.lows = lows
+        self.highs = highs
+        self.version = version
+
+
+    @classmethod
+    def from_bins(cls, bins, version=0):
+        bins = list(bins)
+        if not bins:
+            raise RuntimeError('E: can not create index from empty bins')
+        arr = np.array( [ b[:4] for b in bins ], dtype=float )
+        order = np.argsort( arr[:,1], kind='stable' )
+        arr = arr[order]
+        return cls( arr[:,0].astype(int), arr[:,1].copy(), arr[:,2].copy(), arr[:,3].copy(),
+                    version )
+
+
+    @property
+    def sortedbins(self):
+        """ list of [ bin_value, center, low, high ] sorted by center """
+        return [ [ int(v), float(c), float(l), float(h) ] for (v, c, l, h)
+                    in zip(self.values, self.centers, self.lows, self.highs) ]
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def assign(self, sizes):
+        """ return array of index of the bin for each size; a size between two bin
+            centers belongs to the bin whose edge is nearer
+        """
+        sizes = np.asarray(sizes, dtype=float)
+        last = len(self.centers) - 1
+        idx = np.searchsorted( self.centers, sizes, side='right' )
+        left = np.clip( idx - 1, 0, last )
+        right = np.clip( idx, 0, last )
+        return np.where( sizes - self.highs[left] < self.lows[right] - sizes, left, right )
+
+
+    def bin_values(self, sizes):
+        """ return array of bin value for each size """
+        return self.values[ self.assign(sizes) ]
+
+
+    def bin_alleles(self, alleles):
+        """ return list of bin value for each allele, eg. of a channel or an assay """
+        return self.bin_values( [ a.size for a in alleles ] ).tolist()
+
+
+    def bin_dataframe(self, df, size_column='SIZE', bin_column='BIN'):
+        """ set bin_column of whole DataFrame based on size_column """
+        df[bin_column] = self.bin_values( df[size_column].values )
+        return df
+
+
+def grouped_percentile(sorted_sizes, starts, counts, q):
+    """ per-group percentile, with the same linear interpolation as np.percentile """
+
+    pos = (counts - 1) * q / 100.0
+    lower = np.floor(pos).astype(int)
+    upper = np.minimum(lower + 1, counts - 1)
+    frac = pos - lower
+    return ( sorted_sizes[starts + lower] * (1 - frac) +
+                sorted_sizes[starts + upper] * frac )
@@ -1,16 +1,18 @@
 import pandas, attr, yaml
 import numpy as np
 from fatools.lib.fautil.mixin import BinMixIn
-from fatools.lib.utils import cout, cerr
+from fatools.lib.fautil.binindex import BinIndex, grouped_percentile
+from fatools.lib.utils import cout, cerr, cverr, cexit
 from collections import defaultdict
 
-from IPython import embed
-
 def do_binsutil(args):
 
     if args.optimize:
         do_optimize(args)
 
+    elif args.build:
+        do_build(args)
+
     elif args.summarize:
         do_summarize(args)
 
@@ -27,38 +29,189 @@ def do_summarize(args):
         cout(stats[s].repr())
 
 
+def do_build(args):
+
+    from fatools.lib.fautil.binbuilder import build_bins
+    from fatools.lib.const import peaktype
+
+    marker_sizes = []
+    if args.sqldb:
+        from fatools.lib.sqlmodels.handler import SQLHandler
+        dbh = SQLHandler(args.sqldb)
+        if not (args.batch and args.marker):
+            cexit('E: --build from database requires --batch and --marker')
+        batches = [ dbh.get_batch(code) for code in args.batch.split(',') ]
+        for code in args.marker.split(','):
+            marker = dbh.get_marker(code)
+            sizes = dbh.get_allele_sizes( marker, batches,
+                            [ peaktype.bin, peaktype.called, peaktype.unassigned ] )
+            marker_sizes.append( (marker.label, sizes, args.repeats or marker.repeats,
+                                    args.min or marker.min_size, args.max or marker.max_size) )
+
+    elif args.infile:
+        if not args.repeats:
+            cexit('E: --build from infile requires --repeats')
+        d = pandas.read_table(args.infile)
+        markers = args.marker.split(',') if args.marker else sorted( d['MARKER'].unique() )
+        for marker in markers:
+            sizes = d.loc[ d['MARKER'] == marker, 'SIZE' ].values.astype(float)
+            marker_sizes.append( (marker, sizes, args.repeats, args.min, args.max) )
+
+    else:
+        cexit('E: --build requires either --sqldb or --infile')
+
+    results = {}
+    for (label, sizes, repeats, min_size, max_size) in marker_sizes:
+        bins = build_bins( sizes, repeats, min_size, max_size )
+        cerr('I: marker %s - %d size(s) => %d bin(s)' % (label, len(sizes), len(bins)))
+        results[label] = { 'label': label, 'bins': bins }
+
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            yaml.dump( results, f )
+    else:
+        cout( yaml.dump( results ) )
+
+
 def do_optimize(args):
 
     d = pandas.read_table(args.infile)
 
-    p = d[ d['MARKER'] == args.marker ].copy()
+    if args.marker:
+        markers = args.marker.split(',')
+    else:
+        markers = sorted( d['MARKER'].unique() )
 
-    counts = np.round( p['SIZE'] )
+    marker_sizes = {}
+    for marker in markers:
+        sizes = d.loc[ d['MARKER'] == marker, 'SIZE' ].values.astype(float)
+        if len(sizes) == 0:
+            cerr('W: no peaks for marker %s' % marker)
+            continue
+        marker_sizes[marker] = sizes
+
+    tasks = [ (marker, sizes, args.anchor, args.repeats, args.min, args.max,
+                args.shift, args.tolerance) for (marker, sizes) in marker_sizes.items() ]
+
+    results = {}
+    if args.jobs > 1 and len(tasks) > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for (marker, bins, n) in executor.map( optimize_marker_p, tasks ):
+                results[marker] = bins
+                cerr('I: marker %s optimized in %d iteration(s)' % (marker, n))
+    else:
+        for task in tasks:
+            marker, bins, n = optimize_marker_p( task )
+            results[marker] = bins
+            cerr('I: marker %s optimized in %d iteration(s)' % (marker, n))
 
-    c = defaultdict(int)
-    for i in counts:
-        c[int(i)] += 1
+    for marker in markers:
+        if marker not in results:
+            continue
+        cout('== marker %s' % marker)
+        binindex = BinIndex.from_bins( results[marker] )
+        for stat in bin_statistics( binindex, marker_sizes[marker] ):
+            cout(stat.repr())
 
-    bins = sorted(c.items(), key = lambda x: x[1])
-    print(bins)
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            yaml.dump( { marker: { 'label': marker, 'bins': bins }
+                            for marker, bins in results.items() }, f)
+
+
+def optimize_marker_p( args ):
+    marker, sizes, anchor, repeats, min_range, max_range, shift, tolerance = args
 
     tbin = Bin()
-    tbin.initbins(args.anchor, args.repeats, args.min, args.max, args.shift)
-
-    for i in range(0, 30):
-        print('<<ITER:  %d >>' % i)
-        call_peaks(tbin, p)
-        stat = bin_stats(p)
-        for s in sorted(stat.keys()):
-            print(stat[s].repr())
-        if i % 10 == 0:
-            tbin.adjust_bins(stat, reset=True, repeats=args.repeats)
-        else:
-            tbin.adjust_bins(stat)
+    tbin.initbins(anchor, repeats, min_range, max_range, shift)
+    n = optimize_bins(tbin.bins, sizes, repeats, tolerance=tolerance)
+    return (marker, tbin.bins, n)
 
-    if args.outfile:
-        with open(args.outfile, 'w') as f:
-            yaml.dump({ args.marker: { 'label': args.marker, 'bins': tbin.bins}}, f)
+
+@attr.s
+class GroupStat(object):
+    """ summary of sizes assigned to a single bin """
+
+    size = attr.ib()
+    f = attr.ib()
+    mean = attr.ib()
+    median = attr.ib()
+    min = attr.ib()
+    max = attr.ib()
+
+    def repr(self):
+        return "<Bin: %d / %5.4f / %5.4f / %5.4f - %5.4f d: %5.4f f: %d>" % (
+            self.size, self.mean, self.median, self.min, self.max, self.max - self.min, self.f )
+
+
+def group_sizes(binindex, sizes):
+    """ sort sizes by (bin, size) and return (bin positions, sorted sizes, group starts)
+        where group starts are the offsets of each occupied bin in sorted sizes
+    """
+
+    positions = binindex.assign(sizes)
+    order = np.lexsort( (sizes, positions) )
+    positions = positions[order]
+    sorted_sizes = sizes[order]
+    starts = np.flatnonzero( np.r_[True, positions[1:] != positions[:-1]] )
+    return positions[starts], sorted_sizes, starts
+
+
+def bin_statistics(binindex, sizes):
+    """ return list of GroupStat for each occupied bin """
+
+    positions, sorted_sizes, starts = group_sizes(binindex, np.asarray(sizes, dtype=float))
+    counts = np.diff( np.r_[starts, len(sorted_sizes)] )
+    means = np.add.reduceat(sorted_sizes, starts) / counts
+    medians = grouped_percentile(sorted_sizes, starts, counts, 50)
+    mins = sorted_sizes[starts]
+    maxs = sorted_sizes[starts + counts - 1]
+
+    return [ GroupStat( size = int(binindex.values[i]), f = int(f), mean = float(mean),
+                        median = float(med), min = float(lo), max = float(hi) )
+            for (i, f, mean, med, lo, hi) in zip(positions, counts, means, medians, mins, maxs) ]
+
+
+def optimize_bins(bins, sizes, repeats, max_iter=30, tolerance=1e-3, reset_every=10):
+    """ iteratively move bins (list of [ value, center, low, high ]) to the median
+        of their assigned sizes, with low & high at the 10th & 90th percentiles;
+        every reset_every iterations bins are re-spaced from the anchor bin
+        (the most populated and tightest one)
+        stop when no bin moves more than tolerance; return number of iterations
+    """
+
+    sizes = np.asarray(sizes, dtype=float)
+    bin_pos = { b[0]: i for (i, b) in enumerate(bins) }
+
+    for i in range(max_iter):
+        binindex = BinIndex.from_bins(bins)
+        positions, sorted_sizes, starts = group_sizes(binindex, sizes)
+        counts = np.diff( np.r_[starts, len(sorted_sizes)] )
+        values = binindex.values[positions]
+        d = sorted_sizes[starts + counts - 1] - sorted_sizes[starts]
+
+        if i % reset_every == 0:
+            reset_bins(bins, bin_pos, values, counts, d, repeats)
+            cverr(3, 'D: iteration %d - bins reset' % i)
+            continue
+
+        p10, med, p90 = [ grouped_percentile(sorted_sizes, starts, counts, q)
+                            for q in (10, 50, 90) ]
+        lows = np.where( d > 0.5, p10, med - 0.5 )
+        highs = np.where( d > 0.5, p90, med + 0.5 )
+
+        shift = 0.0
+        for (value, c, lo, hi) in zip(values.tolist(), med.tolist(), lows.tolist(), highs.tolist()):
+            b = bins[ bin_pos[value] ]
+            shift = max(shift, abs(b[1] - c), abs(b[2] - lo), abs(b[3] - hi))
+            b[1], b[2], b[3] = c, lo, hi
+
+        cverr(3, 'D: iteration %d - max shift: %5.4f' % (i, shift))
+        if shift <= tolerance:
+            return i + 1
+
+    return max_iter
 
 
 class Bin(BinMixIn):
@@ -69,19 +222,14 @@ class Bin(BinMixIn):
     def initbins(self, anchor, repeats, min_range, max_range, shift=0):
 
         mod = anchor % repeats
-        print('mod', mod)
-        print('min_range', min_range)
         min_range = (min_range // repeats -1) * repeats + mod
-        print('min_range', min_range)
+        cverr(3, 'D: anchor mod: %d, min_range: %d' % (mod, min_range))
 
         #super().initbins(min_range, max_range, repeats)
         self.bins = []
         for i in range(min_range, max_range, repeats):
             self.bins.append([i, float(i) + shift, i - 0.5 + shift, i + 0.5 + shift])
-        print(self.bins)
-
-    def adjust_bins(self, containers, reset=False, repeats=-1):
-        adjust_bins(self.bins, containers, reset, repeats)
+        cverr(3, 'D: initial bins: %s' % str(self.bins))
 
 
 @attr.s
@@ -107,29 +255,7 @@ class BinContainer(object):
 
 def call_peaks(bins, peaks):
 
-    sortedbins = bins.sortedbins
-
-    #embed()
-
-    for i in peaks.index:
-        size = peaks.loc[i, 'SIZE']
-        idx = sortedbins.bisect_key_right( size )
-
-        if idx == 0:
-            curr_bin = sortedbins[0]
-        elif idx == len(sortedbins):
-            curr_bin = sortedbins[-1]
-        else:
-            left_bin = sortedbins[idx-1]
-            right_bin = sortedbins[idx]
-
-            if size - left_bin[3] < right_bin[2] - size:
-                # belongs tp left_bin
-                curr_bin = left_bin
-            else:
-                curr_bin = right_bin
-
-        peaks.loc[i, 'BIN'] = curr_bin[0]
+    BinIndex.from_bins( bins.bins ).bin_dataframe( peaks )
 
 
 def bin_stats(peaks):
@@ -146,87 +272,27 @@ def bin_stats(peaks):
     return b
 
 
-def adjust_bins(bins, stat, reset=False, repeats=-1):
-
-    if reset:
-        reset_bins(bins, stat, repeats)
-        return
-
-    for idx in range(len(bins)):
-        b = bins[idx]
-        value = b[0]
-        if value in stat:
-            #print('update bins', value)
-            s = stat[value]
-            values = sorted(s.values)
-            size = len(values)
-            if size % 2 == 0:
-                idx = int(size/2) - 1
-                med = (values[idx] + values[idx+1])/2
-                q1 = values[:idx]
-                q2 = values[idx:]
-            else:
-                idx = int(size//2)
-                med = values[idx]
-                q1 = values[:idx]
-                q2 = values[idx+1:]
-
-            b[1] = float(med)
-            percentiles = np.percentile( s.values, [10, 50, 90])
-            if not reset and s.d() > 0.5:
-                #b[2] = float(np.mean(q1))
-                #b[3] = float(np.mean(q2))
-                b[2] = float(percentiles[0])
-                b[3] = float(percentiles[2])
-            else:
-                b[2] = b[1] - 0.5
-                b[3] = b[1] + 0.5
-
-            #percentiles = np.percentile( s.values, [20, 50, 80] )
-            #b[1] = float(percentiles[1])
-            #if not reset and s.d() > 1.0:
-            #    b[2] = float(percentiles[0])
-            #    b[3] = float(percentiles[2])
-            #else:
-            #    if len(s.values) > 1:
-            #        avg = float(b[1] + np.mean(s.values)) / 2
-            #    else:
-            #        avg = b[1]
-            #    b[2] = avg - 1.0
-            #    b[3] = avg + 1.0
-                #b[2] = b[1] - 1.0
-                #b[3] = b[1] + 1.0
-
 def reset_bin_item(a_bin):
     a_bin[2] = a_bin[1] - 0.5
     a_bin[3] = a_bin[1] + 0.5
 
 
-def reset_bins(bins, stat, repeats):
+def reset_bins(bins, bin_pos, values, counts, d, repeats):
+    """ re-space bins, going up and down from the anchor bin, ie. the bin with
+        the most sizes, or the narrowest spread among those
+    """
 
-    anchor_bin = None
-    for s in stat.values():
-        if anchor_bin is None:
-            anchor_bin = s
-            continue
-        if s.f() > anchor_bin.f():
-            anchor_bin = s
-        elif s.f() == anchor_bin.f() and s.d() < anchor_bin.d():
-            anchor_bin = s
-
-    # create a dict of bins from original bins
-    bin_d = {}
-    for b in bins:
-        bin_d[b[0]] = b
+    # anchor is the bin with maximum count, then minimum spread
+    anchor = values[ np.lexsort( (d, -counts) )[0] ]
 
     # set anchor bin
-    u_bin = bin_d[anchor_bin.size]
+    u_bin = bins[ bin_pos[anchor] ]
     reset_bin_item(u_bin)
 
     # going up for each bin
     base_size = u_bin[1]
-    for i in range(anchor_bin.size + repeats, bins[-1][0]+1, repeats):
-        b = bin_d[i]
+    for i in range(anchor + repeats, bins[-1][0]+1, repeats):
+        b = bins[ bin_pos[i] ]
         if b[1] - base_size < repeats - 0.75:
             b[1] = base_size + repeats - 0.5
             reset_bin_item(b)
@@ -234,10 +300,9 @@ def reset_bins(bins, stat, repeats):
 
     # going down for each bin
     base_size = u_bin[1]
-    for i in range(anchor_bin.size - repeats, bins[0][0]-1, -repeats):
-        b = bin_d[i]
+    for i in range(anchor - repeats, bins[0][0]-1, -repeats):
+        b = bins[ bin_pos[i] ]
         if base_size - b[1] < repeats - 0.75:
             b[1] = base_size - repeats + 0.5
             reset_bin_item(b)
         base_size = b[1]
-
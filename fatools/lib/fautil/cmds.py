@@ -58,6 +58,10 @@ def init_argparser(parser=None):
     p.add_argument('--listpeaks', default=False, action='store_true',
             help = 'list all peaks')
 
+    p.add_argument('--fused', default=False, action='store_true',
+            help = 'run align, call and listpeaks on each FSA file in a single pass, '
+                    'without keeping all FSA files in memory')
+
     p.add_argument('--peaks_format', default="standard",
                    help = "format for peaks output file (standard, peakscanner)")
     
@@ -75,6 +79,9 @@ def init_argparser(parser=None):
     p.add_argument('--markerfile', default="",
             help = "YAML marker file")
 
+    p.add_argument('--ladderfile', default="",
+            help = "YAML ladder (size standard) file")
+
     # options
 
     p.add_argument('--cluster', default=0, type=int,
@@ -89,6 +96,9 @@ def init_argparser(parser=None):
     p.add_argument('--no-cache', default=False, action='store_true',
             help = 'do not use caches')
 
+    p.add_argument('--aligncache', default=False,
+            help = 'directory for caching ladder alignment results')
+
     p.add_argument('--commit', default=False, action='store_true',
             help = 'commit to database')
 
@@ -125,6 +135,10 @@ def main(args):
 
     _params.baselinewindow = args.baselinewindow 
 
+    if args.ladderfile:
+        from fatools.lib.fautil.ladders import load_ladders
+        cerr('I: loaded ladder(s): %s' % ', '.join(load_ladders(args.ladderfile)))
+
     if args.baselinemethod !="":
         if args.baselinemethod=='none':
             _params.baselinemethod = baselinemethod.none
@@ -147,13 +161,18 @@ def main(args):
 
     if args.file or args.infile or args.indir:
         cverr(4, 'D: opening FSA file(s)')
-        fsa_list = open_fsa(args, _params)
+        if args.fused:
+            # FSA files are opened one at a time while being processed
+            fsa_list = iter_fsa(args, _params)
+        else:
+            fsa_list = open_fsa(args, _params)
     elif dbh is None:
         cverr(4, 'D: connecting to database')
         dbh = get_dbhandler(args)
         fsa_list = get_fsa_list(args, dbh)
 
-    cerr('I: obtained %d FSA' % len(fsa_list))
+    if not args.fused:
+        cerr('I: obtained %d FSA' % len(fsa_list))
 
     if args.commit:
         with transaction.manager:
@@ -177,13 +196,16 @@ def do_facmds(args, fsa_list, params, dbh=None):
     f_bad_files = open(bad_files_filename,'w')
     
     executed = 0
+    if args.fused:
+        executed += do_fused( args, fsa_list, params, f_bad_files, dbh )
+        fsa_list = []
     if args.clear:
         do_clear( args, fsa_list, dbh )
         executed += 1
-    if args.align:
+    if args.align and not args.fused:
         do_align( args, fsa_list, f_bad_files, dbh )
         executed += 1
-    if args.call:
+    if args.call and not args.fused:
         do_call( args, fsa_list, params, dbh )
         executed += 1
     if args.plot:
@@ -195,7 +217,7 @@ def do_facmds(args, fsa_list, params, dbh=None):
     if args.ladderplot:
         do_ladderplot( args, fsa_list, dbh )
         executed += 1
-    if args.listpeaks is not False:
+    if args.listpeaks is not False and not args.fused:
         do_listpeaks( args, fsa_list, dbh )
         executed += 1
 
@@ -204,36 +226,86 @@ def do_facmds(args, fsa_list, params, dbh=None):
     else:
         cerr('I: executed %d command(s)' % executed)
 
+    from fatools.lib.fautil.aligncache import get_cache
+    if get_cache() is not None:
+        get_cache().report()
+
     f_bad_files.close()
     
 def do_clear( args, fsa_list, dbh ):
     pass
 
 
-def do_align( args, fsa_list, f_bad_files, dbh ):
+def do_fused( args, fsa_list, params, f_bad_files, dbh ):
+    """ align, call and list the peaks of each FSA before opening the next one;
+        return the number of commands
+    """
+
+    if args.plot or args.ladderplot or args.dendogram or args.clear:
+        cexit('E: --fused can only be used with --align, --call and --listpeaks')
+
+    cerr('I: Processing FSA files...')
+
+    align_params = get_align_params( args )
+    if args.call:
+        set_call_params( args, params )
+    if args.listpeaks is not False:
+        write_peaks_header( args )
+
+    for (fsa, sample_code) in fsa_list:
+        if args.align and not align_fsa( fsa, align_params, f_bad_files ):
+            continue
+        if args.call:
+            cverr(3, 'D: calling FSA %s' % fsa.filename)
+            fsa.call(params)
+        if args.listpeaks is not False:
+            write_peaks( args, fsa, sample_code )
+
+    return len( [ cmd for cmd in (args.align, args.call, args.listpeaks) if cmd ] )
+
+
+def get_align_params( args ):
 
     _params = params.Params()
     if args.ladder_rfu_threshold >= 0:
         _params.ladder.min_rfu = args.ladder_rfu_threshold
+    return _params
+
+
+def align_fsa( fsa, _params, f_bad_files ):
+    """ align fsa, return False if the ladder does not match """
+
+    cverr(3, 'D: aligning FSA %s' % fsa.filename)
+    try:
+        fsa.align(_params)
+    except LadderMismatchException:
+        f_bad_files.write(("LadderMismatch: %s\n") % fsa.filename)
+        return False
+    return True
+
+
+def do_align( args, fsa_list, f_bad_files, dbh ):
+
+    _params = get_align_params( args )
 
     cerr('I: Aligning size standards...')
 
     for (fsa, sample_code) in fsa_list:
-        cverr(3, 'D: aligning FSA %s' % fsa.filename)
-        try:
-            fsa.align(_params)
-        except LadderMismatchException:
-            f_bad_files.write(("LadderMismatch: %s\n") % fsa.filename)
-            continue
+        align_fsa( fsa, _params, f_bad_files )
 
-def do_call( args, fsa_list, params, dbh ):
 
-    cerr('I: Calling non-ladder peaks...')
+def set_call_params( args, params ):
 
     if args.nonladder_rfu_threshold >= 0:
         params.nonladder.min_rfu = args.nonladder_rfu_threshold
 
 
+def do_call( args, fsa_list, params, dbh ):
+
+    cerr('I: Calling non-ladder peaks...')
+
+    set_call_params( args, params )
+
     for (fsa, sample_code) in fsa_list:
         cverr(3, 'D: calling FSA %s' % fsa.filename)
         fsa.call(params)
@@ -294,7 +366,7 @@ def do_dendogram( args, fsa_list, dbh ):
 
         #initial_pair, P, L = hclustalign.hclust_align(peaks, ladder)
         P = hcalign.generate_tree( [ (n.rtime, 0) for n in peaks ] )
-        L = hcalign.generate_tree( [ (e, 0) for e in ladder['sizes'] ] )
+        L = ladder['T']
 
         clusters = hcalign.fcluster(L.z, args.cluster or ladder['k'], criterion="maxclust")
         print(clusters)
@@ -314,6 +386,14 @@ def do_dendogram( args, fsa_list, dbh ):
 
 def do_listpeaks( args, fsa_list, dbh ):
 
+    write_peaks_header( args )
+
+    for (fsa, sample_code) in fsa_list:
+        write_peaks( args, fsa, sample_code )
+
+
+def write_peaks_header( args ):
+
     if args.outfile != '-':
         out_stream = open(args.outfile, 'w')
     else:
@@ -329,37 +409,47 @@ def do_listpeaks( args, fsa_list, dbh ):
         raise RuntimeError("Unknown value for args.peaks_format")
     out_stream.close()
 
-    for (fsa, sample_code) in fsa_list:
-        cverr(3, 'D: calling FSA %s' % fsa.filename)
 
-        markers = fsa.panel.data['markers']
+def write_peaks( args, fsa, sample_code ):
 
-        out_stream = open(args.outfile, 'a')
-        for channel in fsa.channels:
-            if channel.is_ladder():
-                continue
+    cverr(3, 'D: calling FSA %s' % fsa.filename)
+
+    markers = fsa.panel.data['markers']
+
+    out_stream = open(args.outfile, 'a')
+    for channel in fsa.channels:
+        if channel.is_ladder():
+            continue
+
+        color = markers["x/"+channel.dye]['filter']
 
-            color = markers["x/"+channel.dye]['filter']
-
-            #cout('Marker => %s | %s [%d]' % (channel.marker.code, channel.dye,
-            #       len(channel.alleles)))
-            #cout("channel has alleles :",len(channel.alleles))
-            i=1
-            for p in channel.alleles:
-
-                if args.peaks_format=='standard':
-                    out_stream.write('%6s\t%10s\t%3s\t%d\t%d\t%5i\t%3.2f\t%3.2f\n' %
-                                     (sample_code, fsa.filename[:-4], color, p.rtime, p.size, p.height, p.area, p.qscore))
-                else:
-                    out_stream.write('"%s, %i",%s, %f, %i, %i, %i, %i, %i, %f, %i, %f, %i, %f,,\n' %
-                                    #(color, i+1, fsa.filename, size_bp, height,area_s, area_bp, size_s, begin_s, begin_bp, end_s, end_bp, width_s, width_bp))
-                                     (color, i, fsa.filename, p.size, p.height, p.area, -1, p.rtime, -1,-1,-1,-1,-1,-1))
-                i = i+1
-                
-        out_stream.close()
+        #cout('Marker => %s | %s [%d]' % (channel.marker.code, channel.dye,
+        #       len(channel.alleles)))
+        #cout("channel has alleles :",len(channel.alleles))
+        i=1
+        for p in channel.alleles:
+
+            if args.peaks_format=='standard':
+                out_stream.write('%6s\t%10s\t%3s\t%d\t%d\t%5i\t%3.2f\t%3.2f\n' %
+                                 (sample_code, fsa.filename[:-4], color, p.rtime, p.size, p.height, p.area, p.qscore))
+            else:
+                out_stream.write('"%s, %i",%s, %f, %i, %i, %i, %i, %i, %f, %i, %f, %i, %f,,\n' %
+                                #(color, i+1, fsa.filename, size_bp, height,area_s, area_bp, size_s, begin_s, begin_bp, end_s, end_bp, width_s, width_bp))
+                                 (color, i, fsa.filename, p.size, p.height, p.area, -1, p.rtime, -1,-1,-1,-1,-1,-1))
+            i = i+1
+
+    out_stream.close()
 
 def open_fsa( args, _params ):
-    """ open FSA file(s) and prepare fsa instances
+    """ open FSA file(s) and return list of (fsa, sample_code)
+        requires: args.file, args.panel, args.panelfile
+    """
+
+    return list( iter_fsa( args, _params ) )
+
+
+def iter_fsa( args, _params ):
+    """ open FSA file(s) one at a time, and yield (fsa, sample_code)
         requires: args.file, args.panel, args.panelfile
     """
 
@@ -382,7 +472,6 @@ def open_fsa( args, _params ):
         raise NotImplementedError()
 
     panel = Panel.get_panel(args.panel)
-    fsa_list = []
     index = 1
 
     # prepare caching
@@ -390,6 +479,10 @@ def open_fsa( args, _params ):
         if not os.path.exists('.fatools_caches/channels'):
             os.makedirs('.fatools_caches/channels')
 
+    if args.aligncache and not args.no_cache:
+        from fatools.lib.fautil import aligncache
+        aligncache.set_cache(args.aligncache)
+
     if args.file:
         for fsa_filename in args.file.split(','):
             fsa_filename = fsa_filename.strip()
@@ -400,8 +493,7 @@ def open_fsa( args, _params ):
                 filename = fsa_filename
 
             fsa = FSA.from_file(filename, panel, _params, cache = not args.no_cache)
-            # yield (fsa, str(i))
-            fsa_list.append( (fsa, str(index)) )
+            yield (fsa, str(index))
             index += 1
 
     elif args.infile:
@@ -430,13 +522,9 @@ def open_fsa( args, _params ):
 
             fsa = FSA.from_file( fsa_filename, panel, _params, options, cache = not args.no_cache )
             if 'SAMPLE' in inrows.fieldnames:
-
-                # yield (fsa, r['SAMPLE'])
-                fsa_list.append( (fsa, r['SAMPLE']) )
+                yield (fsa, r['SAMPLE'])
             else:
-
-                # yield (fsa, str(index))
-                fsa_list.append( (fsa, str(index)) )
+                yield (fsa, str(index))
                 index += 1
 
     elif args.indir:
@@ -446,12 +534,9 @@ def open_fsa( args, _params ):
             fsa_filename = fsa_filename.strip()
 
             fsa = FSA.from_file(fsa_filename, panel, _params, cache = not args.no_cache)
-            # yield (fsa, str(i))
-            fsa_list.append( (fsa, str(index)) )
+            yield (fsa, str(index))
             index += 1
 
-    return fsa_list
-
 
 def get_fsa_list( args, dbh ):
     """
@@ -0,0 +1,155 @@
+# dtwalign.py
+# align ladder trace against synthetic ladder template using dynamic time warping
+
+from fatools.lib.utils import cerr, cverr
+from fatools.lib import const
+from fatools.lib.fautil.alignutils import (estimate_z, align_dp, pair_sized_peaks,
+            AlignResult, render_template, normalize_trace)
+
+import numpy as np
+
+
+def dtw_path(template, trace, band, penalty=0.1, block=256):
+    """ banded DTW between template (rows) and trace (columns), with Sakoe-Chiba
+        band of half-width band around the diagonal; each non-diagonal step costs
+        additional penalty so that missing or extra peaks do not shift the warp
+        return (rows, cols) of the warping path, from (0, 0) to (M-1, N-1)
+    """
+
+    M, N = len(template), len(trace)
+    center = np.arange(M) * (N - 1) / max(M - 1, 1)
+    lo = np.clip( np.floor(center - band).astype(int), 0, N - 1 )
+    hi = np.clip( np.ceil(center + band).astype(int) + 1, 1, N )
+    W = int( (hi - lo).max() )
+
+    cols = lo[:, None] + np.arange(W)
+    valid = cols < hi[:, None]
+    D = np.full( (M, W), np.inf )
+
+    for r0 in range(0, M, block):
+        r1 = min(M, r0 + block)
+
+        # squared-difference cost for this block of rows
+        C = ( template[r0:r1, None] - trace[ np.minimum(cols[r0:r1], N - 1) ] ) ** 2
+        C[ ~valid[r0:r1] ] = np.inf
+
+        for i in range(r0, r1):
+            # T[j] = cost of row i up to column j, plus penalty of horizontal steps
+            T = np.cumsum(C[i - r0]) + (cols[i] - lo[i]) * penalty
+            if i == 0:
+                D[0] = T
+                continue
+
+            # best of the upper and diagonal cells in previous row
+            idx = cols[i] - lo[i-1]
+            up = np.where( (idx >= 0) & (idx < W), D[i-1, np.clip(idx, 0, W - 1)], np.inf )
+            idx -= 1
+            diag = np.where( (idx >= 0) & (idx < W), D[i-1, np.clip(idx, 0, W - 1)], np.inf )
+            A = np.minimum(up + penalty, diag)
+
+            # D[j] = c[j] + min(A[j], D[j-1] + penalty) solved as running minimum
+            T_prev = np.concatenate( ([-penalty], T[:-1]) )
+            with np.errstate(invalid='ignore'):
+                row = T + np.minimum.accumulate(A - T_prev - penalty)
+            row[ ~valid[i] ] = np.inf
+            D[i] = row
+
+    def cost(i, j):
+        k = j - lo[i]
+        return D[i, k] if 0 <= k < W else np.inf
+
+    # backtrack from the end
+    i, j = M - 1, N - 1
+    rows, cols_ = [i], [j]
+    while i > 0 or j > 0:
+        if i == 0:
+            j -= 1
+        elif j == 0:
+            i -= 1
+        else:
+            steps = [ (cost(i-1, j-1), i-1, j-1), (cost(i-1, j) + penalty, i-1, j),
+                        (cost(i, j-1) + penalty, i, j-1) ]
+            _, i, j = min(steps)
+        rows.append(i)
+        cols_.append(j)
+
+    return np.array(rows[::-1]), np.array(cols_[::-1])
+
+
+def estimate_dtw(peaks, sizes, data, step=2, band=0.1, sigma=1.5, margin=50,
+            tolerance=12, z=None):
+    """ warp the normalized ladder trace against a template rendered from sizes,
+        and pair each size with the nearest peak to its warped position
+        if initial z (eg. from fftalign.estimate_fft) is not given, sizes are
+        placed linearly between the first and the last peaks
+        return list of (rtime, size)
+    """
+
+    start = max(0, peaks[0].rtime - margin)
+    end = min(len(data), peaks[-1].rtime + margin)
+    trace = normalize_trace(data, peaks, start, end, step)
+    N = len(trace)
+
+    if z is None:
+        scale = (peaks[-1].rtime - peaks[0].rtime) / (sizes[-1] - sizes[0])
+        positions = ( peaks[0].rtime + (np.asarray(sizes) - sizes[0]) * scale - start ) / step
+    else:
+        # invert z (rtime -> size) on the scan grid
+        rtime_grid = np.arange(len(data), dtype=float)
+        positions = ( np.interp(sizes, np.poly1d(z)(rtime_grid), rtime_grid) - start ) / step
+    template = render_template(positions, N, sigma)
+
+    if z is not None:
+        # template is already registered, a narrower band is sufficient
+        band = band / 2
+    rows, cols = dtw_path(template, trace, max(2, int(band * N)))
+
+    rtimes = np.array( [ p.rtime for p in peaks ] )
+    pairs = {}
+    for size, pos in zip(sizes, positions):
+        matched = cols[ rows == int(round(pos)) ]
+        if len(matched) == 0:
+            continue
+        col = matched[ np.argmax(trace[matched]) ]
+        rtime = start + col * step + step // 2
+        k = np.argmin( abs(rtimes - rtime) )
+        dist = abs(rtimes[k] - rtime)
+        if dist > tolerance:
+            continue
+        # one peak can only be paired with one size
+        if rtimes[k] in pairs and pairs[rtimes[k]][1] <= dist:
+            continue
+        pairs[rtimes[k]] = (size, dist)
+
+    return sorted( (int(rtime), size) for rtime, (size, dist) in pairs.items() )
+
+
+def align_dtw(peaks, ladder, data, z=None):
+    """ DTW-based ladder alignment, followed by DP refinement
+        return AlignResult
+    """
+
+    cverr(3, 'I: DTW method is running!')
+
+    sizes = list(ladder['sizes'])
+    peaks = list(sorted(peaks))
+    if len(peaks) < 4:
+        return AlignResult(0, ['Too few peaks'], None, const.alignmethod.dtw_relax)
+
+    pairs = estimate_dtw(peaks, sizes, data, z=z)
+    if len(pairs) < 4:
+        return AlignResult(0, ['DTW failed'], None, const.alignmethod.dtw_relax)
+
+    rtimes, bpsizes = zip( *pairs )
+    zres = estimate_z(rtimes, bpsizes, 3)
+
+    rtimes = [ p.rtime for p in peaks ]
+    dp_result = align_dp(rtimes, sizes, [ 1.0 ] * len(rtimes), zres.z, zres.rss)
+    dp_result.sized_peaks = pair_sized_peaks(peaks, dp_result.sized_peaks)
+
+    score, msg = ladder['qcfunc'](dp_result, method='strict')
+    if score > 0.9:
+        return AlignResult(score, msg, dp_result, const.alignmethod.dtw_strict, pairs)
+
+    score, msg = ladder['qcfunc'](dp_result, method='relax')
+    return AlignResult(score, msg, dp_result, const.alignmethod.dtw_relax, pairs)
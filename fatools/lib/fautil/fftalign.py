@@ -0,0 +1,140 @@
+# fftalign.py
+# coarse ladder registration using FFT cross-correlation
+
+from fatools.lib.utils import cverr
+from fatools.lib.fautil.alignutils import render_template, normalize_trace
+
+import numpy as np
+
+
+MIN_SCORE = 0.5
+""" minimum normalized cross-correlation of a usable registration """
+
+MIN_MATCHED = 0.75
+""" minimum fraction of ladder sizes with a peak near the registered position """
+
+
+def cross_correlate(trace, template):
+    """ return cross-correlation of template against trace for lags
+        0 .. len(trace) - 1, ie. position of template start in trace
+    """
+
+    n = 1 << int( np.ceil( np.log2( len(trace) + len(template) ) ) )
+    corr = np.fft.irfft( np.fft.rfft(trace, n) * np.conj(np.fft.rfft(template, n)), n )
+    return corr[:len(trace)]
+
+
+def correlator(trace, max_length):
+    """ return function of template, up to max_length long, that returns the
+        normalized (Pearson) cross-correlation of template against the windows of
+        trace starting at lags 0 .. len(trace) - 1; trace is padded with zeros
+        beyond its end, and its transform is computed only once
+    """
+
+    N = len(trace)
+    padded = np.append(trace, np.zeros(max_length))
+    n = 1 << int( np.ceil( np.log2( len(padded) + max_length ) ) )
+    ftrace = np.fft.rfft(padded, n)
+    cs = np.cumsum( np.append(0, padded) )
+    cs2 = np.cumsum( np.append(0, padded**2) )
+
+    def correlate(template):
+        m = len(template)
+        corr = np.fft.irfft( ftrace * np.conj(np.fft.rfft(template, n)), n )[:N]
+        s = cs[m:m + N] - cs[:N]
+        s2 = cs2[m:m + N] - cs2[:N]
+        mean_t = template.mean()
+        norm_t = np.sqrt( ((template - mean_t)**2).sum() )
+        var = np.maximum(s2 - s * s / m, 1e-12)
+        return (corr - s * mean_t) / (norm_t * np.sqrt(var))
+
+    return correlate
+
+
+def estimate_fft(peaks, sizes, data, scales=None, step=2, sigma=1.5, margin=50,
+            coarse_step=8, coarse_sigma=3.0, candidates=3):
+    """ search linear scale factors (scans per bp), and for each scale find the
+        offset with the best normalized cross-correlation between the normalized
+        trace and the ladder template
+        the scales are searched first on a downsampled trace with broader template
+        peaks, then around the best candidates at full resolution; the scale step
+        shifts the last size by about sigma, so that the peaks stay registered
+        return (z, score) where z is linear polynomial of rtime -> size and score
+        is the normalized cross-correlation
+    """
+
+    sizes = np.asarray(sorted(sizes), dtype=float)
+    peaks = list(sorted(peaks))
+    start = max(0, peaks[0].rtime - margin)
+    end = min(len(data), peaks[-1].rtime + margin)
+
+    def template_length(scale, step, sigma):
+        return int( (sizes[-1] - sizes[0]) * scale / step + 8 * sigma ) + 1
+
+    def prepare(step, sigma, max_scale):
+        # leading zeros allow the template to start before the trace
+        pad = int(4 * sigma) + 1
+        trace = normalize_trace(data, peaks, start, end, step)
+        trace = np.append(np.zeros(pad), trace)
+        return correlator(trace, template_length(max_scale, step, sigma)), pad
+
+    def register(correlate, step, sigma, scale):
+        positions = (sizes - sizes[0]) * scale / step + 4 * sigma
+        template = render_template(positions, template_length(scale, step, sigma), sigma)
+        corr = correlate(template)
+        lag = int(np.argmax(corr))
+        return corr[lag], lag, scale
+
+    def scale_delta(step, sigma):
+        # scale step that shifts the last size by sigma
+        return sigma * step / (sizes[-1] - sizes[0])
+
+    if scales is not None:
+        correlate, pad = prepare(step, sigma, max(scales))
+        results = [ register(correlate, step, sigma, scale) for scale in scales ]
+
+    else:
+        # 0.05 - 0.25 bp per scan, as in bounds used by gmalign
+        delta = scale_delta(coarse_step, coarse_sigma)
+        correlate, _ = prepare(coarse_step, coarse_sigma, 20 + 2 * delta)
+        coarse = sorted( [ register(correlate, coarse_step, coarse_sigma, scale)
+                            for scale in np.arange(4, 20 + delta, delta) ], reverse=True )
+
+        # refine the best candidates with distinct scales
+        best = []
+        for (score, lag, scale) in coarse:
+            if all( abs(scale - other) > 4 * delta for other in best ):
+                best.append(scale)
+                if len(best) >= candidates:
+                    break
+
+        fine_delta = scale_delta(step, sigma)
+        correlate, pad = prepare(step, sigma, max(best) + 3 * delta)
+        results = []
+        for scale in best:
+            results += [ register(correlate, step, sigma, s) for s in
+                    np.arange(scale - 2 * delta, scale + 2 * delta + fine_delta, fine_delta) ]
+
+    score, lag, scale = max(results)
+
+    # rtime of first size, placed 4 * sigma after the template start
+    rtime_0 = start + (lag - pad + 4 * sigma) * step
+    z = np.array( [ 1.0 / scale, sizes[0] - rtime_0 / scale ] )
+    cverr(3, 'D: FFT registration - scale: %5.2f scan/bp, offset: %d, score: %5.2f'
+                % (scale, rtime_0, score))
+
+    return z, score
+
+
+def check_fft(peaks, sizes, z, score, tolerance=3.0):
+    """ return True if registration z is usable, ie. its score is high enough and
+        most ladder sizes have a peak within tolerance bp of their position
+    """
+
+    if score < MIN_SCORE:
+        return False
+
+    peak_sizes = np.poly1d(z)( np.array( [ p.rtime for p in peaks ], dtype=float ) )
+    matched = sum( 1 for size in sizes if np.min(np.abs(peak_sizes - size)) <= tolerance )
+    cverr(3, 'D: FFT registration - matched %d of %d sizes' % (matched, len(sizes)))
+    return matched >= MIN_MATCHED * len(sizes)
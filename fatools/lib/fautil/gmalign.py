@@ -32,6 +32,14 @@ class ZFunc(object):
             self.similarity = [ 1.0 ] * len(self.peaks)
 
 
+    def __getstate__(self):
+        # peaks are only needed by get_sized_peaks() in the calling process,
+        # hence do not send them (and their channels) to worker processes
+        state = self.__dict__.copy()
+        state['peaks'] = None
+        return state
+
+
     def get_initial_z(self):
         """
         return (initial_z, initial_rss) based on anchor pairs
@@ -84,18 +84,14 @@ def generate_cluster(T, k):
 
 def align_hc( peaks, ladder):
     """ peaks: list of rtime, in ascending order
-        ladders: list of size from ladders, in ascending order
+        ladder: LadderIndex from fautil.ladders
 
         returns: (score, msg, result, method)
     """
 
     #import pprint; pprint.pprint(peaks)
 
-    # generate P for ladder
-    if 'C' not in ladder:
-        if 'T' not in ladder:
-            ladder['T'] = generate_tree( [ (n,0) for n in ladder['sizes'] ] )
-        ladder['C'] = generate_cluster(ladder['T'], ladder['k'])
+    # ladder tree and clusters are precompiled in ladder index
     ladder_clusters = ladder['C']
     ladder_sizes = ladder['sizes']
 
@@ -0,0 +1,153 @@
+# ladders.py
+# registry of precompiled, immutable ladder (size standard) index
+
+from fatools.lib.utils import cverr
+from fatools.lib import const
+from fatools.lib.fautil.hcalign import generate_tree, generate_cluster
+
+from types import MappingProxyType
+import threading
+import numpy as np
+import attr
+import yaml
+
+
+@attr.s(frozen=True, eq=False, repr=False)
+class LadderIndex(object):
+    """ precompiled ladder, built once per ladder definition and never modified;
+        supports ladder['key'] access for code expecting const.ladders dict
+    """
+    code = attr.ib()
+    dye = attr.ib()
+    sizes = attr.ib()           # read-only array of sizes, in ascending order
+    strict = attr.ib()
+    relax = attr.ib()
+    k = attr.ib()
+    a = attr.ib()
+    signature = attr.ib()       # read-only array of signature sizes
+    signature_gaps = attr.ib()  # read-only array of gaps between signature sizes
+    gaps = attr.ib()            # read-only array of gaps between ladder sizes
+    T = attr.ib()               # hierarchical tree of ladder sizes
+    C = attr.ib()               # clusters of ladder sizes
+    qcfunc = attr.ib()
+    size_qcfunc = attr.ib()     # qcfunc for algo.size_peaks(), scoring result tuples
+    definition = attr.ib()      # the original definition, used for pickling
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __reduce__(self):
+        # only send the definition, the receiving process uses its own registry
+        return (_unpickle_ladder, (self.code, self.definition))
+
+    def __repr__(self):
+        return '<LadderIndex: %s | %s | %d sizes>' % (self.code, self.dye, len(self.sizes))
+
+
+def _readonly(values):
+    arr = np.array(sorted(values), dtype=float)
+    arr.setflags(write=False)
+    return arr
+
+
+def build_index(code, definition):
+    """ compile ladder definition (a dict as in const.ladders) into LadderIndex """
+
+    # prevent circular import
+    from fatools.lib.fautil.algo2 import generate_scoring_function
+    from fatools.lib.fautil import algo
+
+    sizes = _readonly(definition['sizes'])
+    signature = _readonly(definition.get('signature', definition['sizes']))
+    strict = MappingProxyType(dict(definition['strict']))
+    relax = MappingProxyType(dict(definition['relax']))
+
+    T = generate_tree( [ (n, 0) for n in sizes ] )
+    C = tuple( tuple(c) for c in generate_cluster(T, definition['k']) )
+
+    gaps = np.diff(sizes)
+    gaps.setflags(write=False)
+    signature_gaps = np.diff(signature)
+    signature_gaps.setflags(write=False)
+
+    cverr(3, 'D: compiled ladder index %s' % code)
+
+    return LadderIndex( code = code, dye = definition['dye'], sizes = sizes,
+                strict = strict, relax = relax, k = definition['k'],
+                a = definition.get('a', 1), signature = signature,
+                signature_gaps = signature_gaps, gaps = gaps,
+                T = T, C = C, qcfunc = generate_scoring_function(strict, relax),
+                size_qcfunc = algo.generate_scoring_function(strict, relax),
+                definition = definition )
+
+
+_definitions = dict(const.ladders)
+_registry = {}
+_lock = threading.Lock()
+
+
+def get_ladder(code):
+    """ return LadderIndex of ladder code, compiling it on first use """
+
+    try:
+        return _registry[code]
+    except KeyError:
+        pass
+
+    with _lock:
+        if code not in _registry:
+            if code not in _definitions:
+                raise RuntimeError('E: unknown ladder: %s' % code)
+            _registry[code] = build_index(code, _definitions[code])
+        return _registry[code]
+
+
+def register_ladder(code, definition):
+    """ register a ladder definition; the index is (re)compiled only if the
+        definition differs from the registered one
+    """
+
+    with _lock:
+        if _definitions.get(code) == definition:
+            return
+        _definitions[code] = definition
+        _registry.pop(code, None)
+
+
+def load_ladders(infile):
+    """ load ladder definitions from YAML file (or stream), with the same structure
+        as const.ladders; return list of ladder codes
+    """
+
+    if isinstance(infile, str):
+        with open(infile) as f:
+            definitions = yaml.safe_load(f)
+    else:
+        definitions = yaml.safe_load(infile)
+
+    for code, definition in definitions.items():
+        register_ladder(code, definition)
+
+    return list(definitions.keys())
+
+
+def preload():
+    """ compile all registered ladders, eg. before forking worker processes so
+        that the children share the already built index
+    """
+    for code in list(_definitions.keys()):
+        get_ladder(code)
+
+
+def _unpickle_ladder(code, definition):
+    register_ladder(code, definition)
+    return get_ladder(code)
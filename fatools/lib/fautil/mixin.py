@@ -1,14 +1,14 @@
 
 from fatools.lib.fautil import traceio, traceutils
 from fatools.lib.utils import cout, cerr
-from fatools.lib.const import (peaktype, channelstatus, assaystatus, dyes, ladders,
+from fatools.lib.const import (peaktype, channelstatus, assaystatus, dyes,
                                     allelemethod, alignmethod, binningmethod, scanningmethod)
-from fatools.lib.fautil import algo
-from sortedcontainers import SortedListWithKey
+from fatools.lib.fautil import algo, aligncache
+from fatools.lib.fautil.ladders import get_ladder
+from fatools.lib.fautil.binindex import BinIndex, next_version
 
 import io, numpy as np
 from copy import copy
-from functools import lru_cache
 import pprint, sys, time
 
 
@@ -118,11 +118,26 @@ class MarkerMixIn(object):
     #def sortedbins(self):
     #    return SortedListWithKey(self.bins, key = lambda b: b[1])
 
-    @lru_cache(maxsize=32)
+    def get_binindex(self, batch):
+        """ return compiled BinIndex of the bins used by batch """
+        # keep Bin instance per chain of bin batches that get_bin() searches, so
+        # that changing batch.bin_batch (eg. dbmgr --setbinbatch) is picked up;
+        # the Bin keeps its own index up to date
+        if not hasattr(self, '_bins'):
+            self._bins = {}
+        key = []
+        b = batch
+        while b is not None:
+            key.append(b.id)
+            b = b.bin_batch
+        key = tuple(key)
+        bin = self._bins.get(key, None)
+        if bin is None:
+            bin = self._bins[key] = self.get_bin(batch)
+        return bin.get_binindex()
+
     def get_sortedbins(self, batch):
-        # get Bin from this batch
-        bin = self.get_bin(batch)
-        return bin.sortedbins
+        return self.get_binindex(batch).sortedbins
 
     def initbins(self, start_range, end_range, batch):
         # check whether we already have bin data, otherwise create new one
@@ -130,6 +145,7 @@ class MarkerMixIn(object):
         if bin is None:
             bin = self.new_bin( batch = batch )
         bin.initbins( start_range, end_range, self.repeats )
+        self._bins = {}
 
 
     def new_bin(self, batch):
@@ -144,6 +160,7 @@ class BinMixIn(object):
         for size in range(start_range, end_range, repeats):
             self.bins.append( [size, float(size), float(size-1), float(size+1)] )
             # the real bins are defined by [ bin_value, mean, 25percentile, 75percentile ]
+        self.touch_bins()
 
     def adjustbins(self, updated_bins):
         bins = copy(self.bins)
@@ -155,10 +172,23 @@ class BinMixIn(object):
 
         # force db to update
         self.bins = bins
+        self.touch_bins()
+
+    def touch_bins(self):
+        """ mark bins as modified, so that the compiled index will be rebuilt """
+        self._bins_version = next_version()
+
+    def get_binindex(self):
+        """ return compiled BinIndex, rebuilt only when bins have been modified """
+        version = getattr(self, '_bins_version', 0)
+        index = getattr(self, '_binindex', None)
+        if index is None or index.version != version:
+            index = self._binindex = BinIndex.from_bins(self.bins, version)
+        return index
 
     @property
     def sortedbins(self):
-        return SortedListWithKey(self.bins, key = lambda b: b[1])
+        return self.get_binindex().sortedbins
 
 
 
@@ -322,8 +352,11 @@ class ChannelMixIn(object):
         raise NotImplementedError()
 
 
-    def scan(self, params, peakdb = None):
-        """ scan using params """
+    def scan(self, params, peakdb = None, writer = None, peaks = None):
+        """ scan using params; if writer (sqlmodels.bulk.AlleleWriter) is given,
+            peaks are written in bulk instead of as Allele instances; if peaks is
+            given (see select_peaks()), the trace is not scanned again
+        """
 
         #print('SCANNING: %s' % self.dye)
 
@@ -333,23 +366,41 @@ class ChannelMixIn(object):
         alleleset.binning_method = binningmethod.notavailable
 
         # first, check whether we are ladder or not
+        scanning_params = self.scanning_params(params)
+        alleles = self._scan_peaks(alleleset, scanning_params, peakdb, writer, peaks)
+        if self.marker.code == 'ladder':
+            cerr('ladder: %d; ' % len(alleles), nl=False)
+        else:
+            cerr('%s: %d; ' % (self.marker.label, len(alleles)), nl=False)
+        alleleset.scanning_method = scanning_params.method
+
+
+    def scanning_params(self, params):
+        """ return ladder or nonladder parameters of params suitable for this channel """
+
         if self.marker.code == 'ladder':
 
             ladder_code = self.assay.size_standard
-            sizes = ladders[ladder_code]['sizes']
+            sizes = get_ladder(ladder_code).sizes
             params.ladder.max_peak_number = len(sizes) * 2
             params.ladder.expected_peak_number = len(sizes)
+            return params.ladder
 
-            alleles = algo.scan_peaks(self, params.ladder, peakdb)
-            cerr('ladder: %d; ' % len(alleles), nl=False)
-            alleleset.scanning_method = params.ladder.method
+        return params.nonladder
 
 
-        else:
+    def select_peaks(self, params, peakdb = None):
+        """ return peaks found in the trace, without creating alleles """
+        return algo.select_peaks(self, self.scanning_params(params), peakdb)
 
-            alleles = algo.scan_peaks(self, params.nonladder, peakdb)
-            cerr('%s: %d; ' % (self.marker.label, len(alleles)), nl=False)
-            alleleset.scanning_method = params.nonladder.method
+
+    def _scan_peaks(self, alleleset, params, peakdb, writer, peaks):
+        if peaks is None:
+            peaks = algo.select_peaks(self, params, peakdb)
+        if writer is None:
+            return algo.scan_peaks(self, params, peakdb, peaks)
+        writer.add_peaks(alleleset, self.marker, peaks)
+        return peaks
 
 
     def preannotate(self, params):
@@ -364,9 +415,9 @@ class ChannelMixIn(object):
             raise RuntimeError("ERR - can't align ladder on non-ladder channel")
 
         ladder_code = self.assay.size_standard
-        ladder = ladders[ladder_code]
-        ladder_sizes = ladder['sizes']
-        ladder_qc_func = algo.generate_scoring_function( ladder['strict'], ladder['relax'] )
+        ladder = get_ladder(ladder_code)
+        ladder_sizes = ladder.sizes.tolist()
+        ladder_qc_func = ladder.size_qcfunc
 
         # reset all calculated values
         for p in self.alleles:
@@ -374,8 +425,23 @@ class ChannelMixIn(object):
             p.bin = -1
 
         start_time = time.process_time()
-        (qcscore, remarks, results, method) = algo.size_peaks(self, params, ladder_sizes,
+        cache = aligncache.get_cache()
+        entry = None
+        if cache is not None:
+            alleles = list(self.alleles)
+            key = aligncache.fingerprint(alleles, ladder, params, 'algo.size_peaks')
+            entry = cache.get(key)
+        if entry is not None:
+            results = ( entry['dpscore'], entry['rss'], np.array(entry['z']),
+                        aligncache.sized_peaks_from_entry(entry, alleles) )
+            (qcscore, remarks, method) = entry['score'], entry['msg'], entry['method']
+        else:
+            (qcscore, remarks, results, method) = algo.size_peaks(self, params, ladder_sizes,
                                                 ladder_qc_func)
+            if cache is not None:
+                (dpscore, rss, z, aligned_peaks) = results
+                cache.put(key, aligncache.make_entry(z, rss, dpscore, qcscore, remarks,
+                                                method, aligned_peaks))
         stop_time = time.process_time()
         (dpscore, rss, z, aligned_peaks) = results
         #qcscore, remarks = algo.score_ladder(rss, len(aligned_peak), len(ladder_sizes))
@@ -395,7 +461,9 @@ class ChannelMixIn(object):
         assay.rss = rss
         assay.z = z
         assay.ladder_peaks = len(aligned_peaks)
-        assay.process_time += int((stop_time - start_time) * 1000)  # in miliseconds
+        # process_time is not stored, and is only set if preannotated by this process
+        assay.process_time = ( getattr(assay, 'process_time', 0)
+                                + int((stop_time - start_time) * 1000) )  # in miliseconds
         assay.method = method
         if remarks:
             if assay.report:
@@ -433,12 +501,12 @@ class ChannelMixIn(object):
             # this is specific for combined marker
             # create allelesets as many as markers
             for marker in self.markers:
-                alleleset = self.allelesets[0].clone()
+                alleleset = self.get_latest_alleleset().clone()
                 alleleset.marker = marker
                 algo.bin_peaks( alleleset, params, marker )
 
         else:
-            algo.bin_peaks( self.allelesets[0], params, self.marker )
+            algo.bin_peaks( self.get_latest_alleleset(), params, self.marker )
 
 
     def postannotate(self, params):
@@ -450,7 +518,7 @@ class ChannelMixIn(object):
         if self.marker.code == 'undefined':
             return
 
-        algo.postannotate_peaks( self.allelesets[0], params )
+        algo.postannotate_peaks( self.get_latest_alleleset(), params )
         #raise NotImplementedError()
 
 
@@ -468,7 +536,7 @@ class ChannelMixIn(object):
 
     @property
     def alleles(self):
-        return self.get_latest_alleleset().alleles
+        return self.get_latest_alleleset().all_alleles
 
 
     def new_allele(self, rtime, height, area, brtime, ertime, wrtime, srtime, beta, theta):
@@ -493,8 +561,7 @@ class ChannelMixIn(object):
         #comps = algo.simple_pca( peak_sizes )
         #algo.plot_pca(comps, peak_sizes)
 
-        from fatools.lib import const
-        std_sizes = const.ladders['LIZ600']['sizes']
+        std_sizes = get_ladder('LIZ600').sizes
 
         x = std_sizes
         y = [ x * 0.1 for x in peak_sizes ]
@@ -537,14 +604,21 @@ class AssayMixIn(object):
             c.preprocess(params)
 
 
-    def scan(self, params, peakdb = None):
-        """ scan for peaks """
+    def scan(self, params, peakdb = None, writer = None, peaks = None):
+        """ scan for peaks; peaks is dict of channel id to peaks, as returned by
+            select_peaks()
+        """
         for c in self.channels:
-            c.scan(params, peakdb)
+            c.scan(params, peakdb, writer, peaks[c.id] if peaks else None)
         self.status = assaystatus.scanned
         cerr('')
 
 
+    def select_peaks(self, params, peakdb = None):
+        """ return dict of channel id to peaks found in the channel """
+        return { c.id: c.select_peaks(params, peakdb) for c in self.channels }
+
+
     def preannotate(self, params):
         """ annotate peaks for broad, rtime-based stutter & overlapping peaks """
         channels =  list(self.channels)
@@ -642,7 +716,7 @@ class AssayMixIn(object):
         # check panel
         panel = self.panel
         ladder_code = panel.get_ladder_code()
-        ladder_dye = ladders[ladder_code]['dye']
+        ladder_dye = get_ladder(ladder_code).dye
 
         # check excluded_markers
 
@@ -713,6 +787,13 @@ class AlleleSetMixIn(object):
     def batch(self):
         return self.sample.batch
 
+    @property
+    def all_alleles(self):
+        """ alleles of this alleleset, including those kept in packed storage by
+            the implementation
+        """
+        return self.alleles
+
 
 
 class AlleleMixIn(object):
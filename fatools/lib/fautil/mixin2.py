@@ -1,10 +1,13 @@
 
 from fatools.lib.fautil import algo2 as algo
+from fatools.lib.fautil.ladders import get_ladder
+from fatools.lib.fautil import aligncache
+from fatools.lib.fautil.alignutils import AlignResult, DPResult
 from fatools.lib.utils import cout, cerr, cexit
 from fatools.lib import const
 
-from functools import lru_cache
 
+import numpy as np
 import attr
 import time
 
@@ -75,28 +78,8 @@ class ChannelMixIn(object):
         
         if ladder==None:
             return
-        
-        # get function for call_peaks        
-        ladders = ladder.alleles
 
-        # check the allele method
-        method = parameters.allelemethod
-        
-        if method == const.allelemethod.leastsquare:
-            func = algo.least_square( ladders, self.fsa.z)
-        elif method == const.allelemethod.cubicspline:
-            func = algo.cubic_spline( ladders )
-        elif method == const.allelemethod.localsouthern:
-            func = algo.local_southern( ladders )
-        else:
-            raise RuntimeError
-        
-        #min_rtime = ladders[1].rtime
-        #max_rtime = ladders[-2].rtime
-        
-        min_rtime = params.min_rtime
-        max_rtime = ladders[-1].rtime
-        
+        func, min_rtime, max_rtime = self.fsa.get_calibration(parameters, ladder)
         algo.call_peaks(self, params, func, min_rtime, max_rtime)
         #algo.bin_peaks(self, params, self.marker)
         #algo.postannotate_peaks(self, params)
@@ -118,13 +101,8 @@ class ChannelMixIn(object):
 
         ladder = self.fsa.panel.get_ladder()
 
-        # prepare ladder qcfunc
-        if 'qcfunc' not in ladder:
-            ladder['qcfunc'] =  algo.generate_scoring_function(
-                                            ladder['strict'], ladder['relax'] )
-
         start_time = time.process_time()
-        result = algo.align_peaks(self, parameters, ladder, anchor_pairs)
+        result = self.align_cached(parameters, ladder, anchor_pairs)
         dpresult = result.dpresult
         fsa = self.fsa
         fsa.z = dpresult.z
@@ -138,7 +116,6 @@ class ChannelMixIn(object):
         alleles.sort(key = lambda x: x.rtime)
 
         ladder_sizes = ladder['sizes']
-        ladder_sizes.sort()
 
         if (len(alleles) != len(ladder_sizes)):
             raise LadderMismatchException( ("alleles not same length as ladder for file: %s!") % fsa.filename)
@@ -153,6 +130,32 @@ class ChannelMixIn(object):
              result.method, fsa.duration, fsa.filename) )
 
 
+    def align_cached(self, parameters, ladder, anchor_pairs=None):
+        """ return AlignResult from alignment cache if ladder peaks are identical,
+            otherwise align and store the result in the cache
+        """
+
+        cache = aligncache.get_cache()
+        if cache is None or anchor_pairs:
+            return algo.align_peaks(self, parameters, ladder, anchor_pairs)
+
+        alleles = self.get_alleles()
+        key = aligncache.fingerprint(alleles, ladder, parameters.ladder,
+                    'algo2.align_peaks')
+        entry = cache.get(key)
+        if entry is not None:
+            sized_peaks = aligncache.sized_peaks_from_entry(entry, alleles)
+            dpresult = DPResult(entry['dpscore'], entry['rss'],
+                    np.array(entry['z']), sized_peaks)
+            return AlignResult(entry['score'], entry['msg'], dpresult, entry['method'])
+
+        result = algo.align_peaks(self, parameters, ladder, anchor_pairs)
+        dpresult = result.dpresult
+        cache.put(key, aligncache.make_entry(dpresult.z, dpresult.rss, dpresult.dpscore,
+                    result.score, result.msg, result.method, dpresult.sized_peaks))
+        return result
+
+
     # ChannelMixIn call method
     def call(self, ladder, parameters=None):
 
@@ -227,12 +230,34 @@ class FSAMixIn(object):
 
     # FSAMixIn call method
     def call(self, parameters):
+        """ scan all non-ladder channels, and size their peaks in a single call """
 
         ladder = self.get_ladder_channel()
 
+        alleles = []
         for c in self.channels:
             if c.marker.code != 'ladder':
-                c.scan( parameters, ladder)
+                c.scan( parameters )
+                if c.status != const.channelstatus.reseted:
+                    alleles.extend( c.alleles )
+
+        func, min_rtime, max_rtime = self.get_calibration(parameters, ladder)
+        algo.call_alleles(alleles, func, min_rtime, max_rtime)
+
+
+    def get_calibration(self, parameters, ladder):
+        """ return (LadderCalibration, min_rtime, max_rtime) based on ladder channel """
+
+        ladders = ladder.alleles
+        func = algo.compile_calibration( ladders, parameters.allelemethod, self.z )
+
+        #min_rtime = ladders[1].rtime
+        #max_rtime = ladders[-2].rtime
+
+        min_rtime = parameters.nonladder.min_rtime
+        max_rtime = max( p.rtime for p in ladders )
+
+        return func, min_rtime, max_rtime
 
     def get_ladder_channel(self):
 
@@ -292,12 +317,6 @@ class MarkerMixIn(object):
         marker.update(d)
         return marker
 
-    @lru_cache(maxsize=32)
-    def get_sortedbins(self, batch):
-        # get Bin from this batch
-        bin = self.get_bin(batch)
-        return bin.sortedbins
-
 
 class PanelMixIn(object):
     """
@@ -334,7 +353,7 @@ class PanelMixIn(object):
 
 
     def get_ladder(self):
-        return const.ladders[ self.data['ladder']]
+        return get_ladder( self.data['ladder'] )
 
 
 
@@ -0,0 +1,232 @@
+# peakcache.py
+# cache of raw peaks found in channel traces
+#
+# entries are keyed by the hash of the trace, the fingerprint of the parameters
+# used by the peak finder and the version of the peak finder, so that entries are
+# never used for a different trace, different parameters or changed code; the
+# value is a small header followed by int32 rtimes and float64 heights
+#
+# the cache is kept either in a single SQLite file, or in a directory of files
+# sharded by the first characters of the key
+
+from fatools.lib.utils import cerr
+
+import numpy as np
+import hashlib, struct, os, time
+
+
+MAGIC = b'FPK1'
+_HEADER = struct.Struct('<4sI')         # magic, number of peaks
+
+PEAK_PARAMS = ( 'method', 'widths', 'width_ratio', 'min_snr', 'min_height',
+                'min_rtime', 'max_rtime' )
+""" scanning parameters used by algo.find_raw_peaks() """
+
+
+def trace_digest(data):
+    """ return hex digest of trace data """
+    data = np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=16)
+    h.update( ('%s|%s|' % (data.dtype.str, data.shape)).encode('UTF-8') )
+    h.update( data.tobytes() )
+    return h.hexdigest()
+
+
+def param_fingerprint(params):
+    """ return hex digest of the peak finding parameters of params """
+    signature = repr( [ (name, repr(getattr(params, name, None))) for name in PEAK_PARAMS ] )
+    return hashlib.blake2b( signature.encode('UTF-8'), digest_size=8 ).hexdigest()
+
+
+def make_key(data, params, version):
+    return '%s-%s-%d' % (trace_digest(data), param_fingerprint(params), version)
+
+
+def split_key(key):
+    """ return (trace digest, parameter fingerprint, version) of key """
+    trace, fingerprint, version = key.split('-')
+    return (trace, fingerprint, int(version))
+
+
+def encode_peaks(peaks):
+    """ encode list of (rtime, height) """
+    peaks = list(peaks)
+    rtimes = np.array( [ p[0] for p in peaks ], dtype='<i4' )
+    heights = np.array( [ p[1] for p in peaks ], dtype='<f8' )
+    return _HEADER.pack(MAGIC, len(peaks)) + rtimes.tobytes() + heights.tobytes()
+
+
+def decode_peaks(value):
+    """ decode value into list of (rtime, height) """
+    magic, n = _HEADER.unpack_from(value)
+    if magic != MAGIC:
+        raise RuntimeError('E: invalid peak cache entry')
+    offset = _HEADER.size
+    rtimes = np.frombuffer(value, dtype='<i4', count=n, offset=offset)
+    heights = np.frombuffer(value, dtype='<f8', count=n, offset=offset + 4 * n)
+    return list( zip( rtimes.tolist(), heights.tolist() ) )
+
+
+class SQLiteBackend(object):
+    """ entries are rows of a single table in a SQLite file """
+
+    commit_size = 500
+    """ number of new entries committed at once """
+
+    def __init__(self, path, shared=False):
+        import sqlite3
+        self.path = path
+        if shared:
+            # do not hold the write lock of the file across entries
+            self.commit_size = 1
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS peaks '
+                    '(key TEXT PRIMARY KEY, value BLOB NOT NULL, created INTEGER NOT NULL)' )
+        self.conn.commit()
+        self.pending = 0
+
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM peaks WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def put(self, key, value):
+        self.conn.execute( 'INSERT OR REPLACE INTO peaks VALUES (?, ?, ?)',
+                    (key, value, int(time.time())) )
+        self.pending += 1
+        if self.pending >= self.commit_size:
+            self.flush()
+
+
+    def entries(self):
+        """ yield (key, size, created) """
+        for row in self.conn.execute('SELECT key, length(value), created FROM peaks'):
+            yield row
+
+
+    def delete(self, keys):
+        self.conn.executemany( 'DELETE FROM peaks WHERE key = ?', [ (k,) for k in keys ] )
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class DirectoryBackend(object):
+    """ entries are files, in subdirectories named by the first 2 characters of
+        the key; entries are written through renames, so that several processes
+        can share the directory
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+    def put(self, key, value):
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(value)
+        os.replace(tmpname, filename)
+
+
+    def entries(self):
+        for shard in sorted(os.listdir(self.path)):
+            shard_path = os.path.join(self.path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                if name.endswith('.tmp'):
+                    continue
+                st = os.stat(os.path.join(shard_path, name))
+                yield (name, st.st_size, int(st.st_mtime))
+
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self._filename(key))
+            except FileNotFoundError:
+                pass
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class PeakCache(object):
+    """ cache of raw peaks, ie. list of (rtime, height), with hit/miss counters;
+        path is a directory (existing, or ending with '/') for DirectoryBackend,
+        otherwise a SQLite file; shared is set if several processes write into
+        the cache at once
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        if os.path.isdir(path) or path.endswith('/'):
+            self.backend = DirectoryBackend(path, shared)
+        else:
+            self.backend = SQLiteBackend(path, shared)
+        self.hits = 0
+        self.misses = 0
+
+
+    def make_key(self, data, params, version):
+        return make_key(data, params, version)
+
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_peaks(value)
+
+
+    def put(self, key, peaks):
+        self.backend.put(key, encode_peaks(peaks))
+
+
+    def entries(self):
+        """ yield (key, size, created) """
+        return self.backend.entries()
+
+
+    def delete(self, keys):
+        self.backend.delete(keys)
+
+
+    def report(self):
+        cerr('I: peak cache - hit: %d, miss: %d' % (self.hits, self.misses))
+
+
+    def close(self):
+        self.backend.close()
@@ -4,8 +4,9 @@ pair minimization algorithm
 
 
 import numpy as np
-import itertools
+import itertools, atexit
 from scipy.optimize import minimize
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from fatools.lib.utils import cout, cerr, cverr, is_verbosity
 from fatools.lib.fautil.alignutils import (estimate_z, pair_f, align_dp,
@@ -15,19 +16,25 @@ from fatools.lib import const
 
 
 
-def align_pm(peaks, ladder, anchor_pairs=None):
+def align_pm(peaks, ladder, anchor_pairs=None, initial_z=None, jobs=1, pool='thread'):
+    """ pair-minimization alignment;
+        initial_z (eg. from fftalign.estimate_fft) replaces the search for anchor pairs
+        jobs > 1 spreads candidate evaluation over a thread or process pool
+    """
+
+    executor = get_executor(jobs, pool)
 
     if not anchor_pairs:
         anchor_peaks = [ p for p in peaks if 1500 < p.rtime < 5000 ]
-        anchor_pairs, initial_z = estimate_pm( anchor_peaks, ladder['signature'] )
+        anchor_pairs, initial_z = estimate_pm( anchor_peaks, ladder['signature'], initial_z )
 
     else:
         rtimes, bpsizes = zip( *anchor_pairs )
         initial_z = estimate_z(rtimes, bpsizes, 1)
 
     anchor_pairs.sort()
-    pairs, z, rss, f = align_upper_pm(peaks, ladder, anchor_pairs, initial_z)
-    pairs, z, rss, f = align_lower_pm(peaks, ladder, pairs, initial_z)
+    pairs, z, rss, f = align_upper_pm(peaks, ladder, anchor_pairs, initial_z, executor, jobs)
+    pairs, z, rss, f = align_lower_pm(peaks, ladder, pairs, initial_z, executor, jobs)
 
     #print(rss)
     #plot(f.rtimes, f.sizes, z, pairs)
@@ -98,7 +105,7 @@ def align_pm(peaks, ladder, anchor_pairs=None):
     return align_gm(peaks, ladder, anchor_pairs, dp_result.z)
 
 
-def align_lower_pm(peaks, ladder, anchor_pairs, anchor_z):
+def align_lower_pm(peaks, ladder, anchor_pairs, anchor_z, executor=None, jobs=1):
 
     # anchor pairs must be in asceding order
 
@@ -122,7 +129,7 @@ def align_lower_pm(peaks, ladder, anchor_pairs, anchor_z):
     print('est_first_bpsize:', est_first_bpsize)
     first_bpsize = [ s for s in lower_sizes if s >= est_first_bpsize ][0]
 
-    scores = []
+    candidates = []
     for first_peak in lower_peaks[:-2]:
         if first_peak.rtime >= anchor_pairs[0][0]:
             break
@@ -131,11 +138,9 @@ def align_lower_pm(peaks, ladder, anchor_pairs, anchor_z):
             zres = estimate_z( [ first_peak.rtime ] + anchor_rtimes, [ first_bpsize ] + anchor_bpsizes, 3 )
             #print('rss:', zres.rss)
             #plot(f.rtimes, f.sizes, zres.z, [ (first_peak.rtime, first_bpsize), ] )
-            score, z = minimize_score(f, zres.z, 3)
-
-            scores.append( (score, z) )
-            #plot(f.rtimes, f.sizes, z, [ (first_peak.rtime, first_bpsize), ] )
+            candidates.append( zres.z )
 
+    scores = evaluate_candidates(f, candidates, 3, executor, jobs)
     scores.sort( key = lambda x: x[0] )
     #import pprint; pprint.pprint( scores[:10] )
 
@@ -152,7 +157,7 @@ def align_lower_pm(peaks, ladder, anchor_pairs, anchor_z):
 
 
 
-def align_upper_pm(peaks, ladder, anchor_pairs, anchor_z):
+def align_upper_pm(peaks, ladder, anchor_pairs, anchor_z, executor=None, jobs=1):
 
     # anchor pairs must be in asceding order
 
@@ -181,7 +186,7 @@ def align_upper_pm(peaks, ladder, anchor_pairs, anchor_z):
     #print('last_bpsize:', last_bpsize)
     #plot(f.rtimes, f.sizes, anchor_z, [])
 
-    scores = []
+    candidates = []
     #print(peaks)
     for last_peak in reversed(peaks[-14:]):
         if last_peak.rtime <= anchor_pairs[-1][0]:
@@ -189,12 +194,9 @@ def align_upper_pm(peaks, ladder, anchor_pairs, anchor_z):
 
         zres = estimate_z(anchor_rtimes + [last_peak.rtime], anchor_bpsizes + [last_bpsize], 2)
         #plot(f.rtimes, f.sizes, zres.z, [ (last_peak.rtime, last_bpsize)] )
-        score, z = minimize_score(f, zres.z, 2)
-        #print(score)
-        #plot(f.rtimes, f.sizes, z, [] )
-
-        scores.append( (score, z) )
+        candidates.append( zres.z )
 
+    scores = evaluate_candidates(f, candidates, 2, executor, jobs)
     scores.sort( key = lambda x: x[0] )
     #import pprint; pprint.pprint( scores[:10] )
 
@@ -208,7 +210,12 @@ def align_upper_pm(peaks, ladder, anchor_pairs, anchor_z):
 
 
 
-def minimize_score( f, z, order ):
+def minimize_score( f, z, order, bound=None ):
+    """ iteratively re-pair peaks and re-fit z until the score converges
+        if bound (best score of other candidates) is given, stop as soon as
+        the score is worse than bound and no longer improving
+        return (score, z)
+    """
 
     last_score = score = 0
 
@@ -221,6 +228,10 @@ def minimize_score( f, z, order ):
         if last_score and abs(last_score - score) < 1e-6:
             break
 
+        if bound is not None and last_score and score > bound and score >= last_score:
+            # this candidate can not beat the best one anymore
+            return score, z
+
         pairs, rss = f.get_pairs(z)
         rtimes, bpsizes = zip( *pairs )
         zres = estimate_z(rtimes, bpsizes, order)
@@ -233,15 +244,83 @@ def minimize_score( f, z, order ):
 
 
 
-def estimate_pm(peaks, bpsizes):
+def evaluate_candidates( f, candidates, order, executor=None, jobs=1 ):
+    """ run minimize_score() for each candidate initial z, using the best score
+        found so far as pruning bound for the remaining candidates
+        with executor, candidates are evaluated in waves of jobs, ie. the number
+        of workers of the executor
+        return [ (score, z), ... ] in candidate order
+    """
+
+    scores = []
+    bound = None
+
+    if executor is None:
+        for z in candidates:
+            score, z = minimize_score(f, z, order, bound)
+            scores.append( (score, z) )
+            if bound is None or score < bound:
+                bound = score
+        return scores
+
+    wave_size = max(1, jobs)
+    for i in range(0, len(candidates), wave_size):
+        futures = [ executor.submit(minimize_score, f, z, order, bound)
+                        for z in candidates[i:i+wave_size] ]
+        for future in futures:
+            score, z = future.result()
+            scores.append( (score, z) )
+            if bound is None or score < bound:
+                bound = score
+
+    return scores
+
+
+_executors = {}
+
+def shutdown_executors():
+    """ shut down the executors created by get_executor() """
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+def get_executor(jobs, pool='thread'):
+    """ return a shared executor with jobs workers, or None if jobs <= 1;
+        the executors are shut down at exit
+    """
+
+    if jobs <= 1:
+        return None
+
+    key = (pool, jobs)
+    if not _executors:
+        atexit.register(shutdown_executors)
+    if key not in _executors:
+        if pool == 'thread':
+            _executors[key] = ThreadPoolExecutor(max_workers=jobs)
+        elif pool == 'process':
+            _executors[key] = ProcessPoolExecutor(max_workers=jobs)
+        else:
+            raise RuntimeError('E: unknown executor pool type: %s' % pool)
+
+    return _executors[key]
+
+
+def estimate_pm(peaks, bpsizes, initial_z=None):
+
+    f = ZFunc(peaks, bpsizes, [], estimate = True)
+
+    if initial_z is not None:
+        # coarse z is known, only need DP to get the anchor pairs
+        dp_result = align_dp(f.rtimes, f.sizes, f.similarity, initial_z, 0)
+        return ( [(x[1], x[0]) for x in dp_result.sized_peaks], dp_result.z )
 
     rtimes = [ p.rtime for p in peaks ]
 
     rtime_points = prepare_rtimes( rtimes )
     bpsize_pair = [ bpsizes[1], bpsizes[-2]]
 
-    f = ZFunc(peaks, bpsizes, [], estimate = True)
-
     scores = []
     for rtime_pair in rtime_points:
         if rtime_pair[0] >= rtime_pair[1]:
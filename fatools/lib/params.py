@@ -80,6 +80,11 @@ class LadderScanningParameter(ScanningParameter):
         self.artifact_dist = 15
         self.artifact_ratio = 0.5
 
+        # number of workers and pool type ('thread' or 'process') used for
+        # evaluating candidate alignments in pair-minimization method
+        self.align_jobs = 1
+        self.align_pool = 'thread'
+
 class Params(object):
 
     ladder = LadderScanningParameter()
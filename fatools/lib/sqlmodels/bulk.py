@@ -0,0 +1,98 @@
+# bulk.py
+# bulk persistence of alleles, bypassing the ORM unit of work
+
+from fatools.lib.const import peaktype, binningmethod
+from fatools.lib.utils import cverr
+
+from fatools.lib.sqlmodels.stamps import touch_batches
+
+from zope.sqlalchemy import mark_changed
+
+
+def execute_many(session, stmt, rows):
+    """ execute stmt with list of parameter dicts in the session transaction;
+        the session is marked as changed, otherwise the transaction manager
+        discards statements that were not issued by the unit of work
+    """
+    if rows:
+        session.execute( stmt, rows )
+        mark_changed( session )
+
+
+class AlleleWriter(object):
+    """ collect peaks of many channels as plain rows and insert them into
+        alleles table using executemany, once batch_size peaks are pending;
+        allelesets are still created as ORM instances, and are flushed once
+        per batch to obtain their ids
+    """
+
+    def __init__(self, session, Allele, batch_size=50000):
+        self.session = session
+        self.table = Allele.__table__
+        self.batch_size = batch_size
+        self.pending = []           # [ (alleleset, marker_id, peaks), ... ]
+        self.pending_count = 0
+        self.written = []           # allelesets whose alleles were inserted
+        self.total = 0
+
+
+    def add_peaks(self, alleleset, marker, peaks):
+        """ peaks is list of ( rtime, height, area, brtime, ertime, srtime, beta, theta ) """
+        if alleleset.pack_peaks:
+            # packed peaks are written with the alleleset itself
+            for ( rtime, height, area, brtime, ertime, srtime, beta, theta ) in peaks:
+                alleleset.new_allele( rtime = int(rtime), height = float(round(height)),
+                        area = float(area), brtime = int(brtime), ertime = int(ertime),
+                        wrtime = int(ertime - brtime), srtime = float(srtime),
+                        beta = float(beta), theta = float(theta),
+                        type = peaktype.scanned, method = binningmethod.notavailable )
+            self.total += len(peaks)
+            return
+        self.pending.append( (alleleset, marker.id, peaks) )
+        self.pending_count += len(peaks)
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # assign ids to new allelesets
+        self.session.flush()
+
+        rows = []
+        for (alleleset, marker_id, peaks) in self.pending:
+            for ( rtime, height, area, brtime, ertime, srtime, beta, theta ) in peaks:
+                rows.append( dict( alleleset_id = alleleset.id, marker_id = marker_id,
+                        rtime = int(rtime), height = float(round(height)), area = float(area),
+                        brtime = int(brtime), ertime = int(ertime),
+                        wrtime = int(ertime - brtime), srtime = float(srtime),
+                        beta = float(beta), theta = float(theta),
+                        type = peaktype.scanned, method = binningmethod.notavailable ) )
+
+        execute_many( self.session, self.table.insert(), rows )
+        touch_batches( self.session,
+                    alleleset_ids = [ alleleset.id for (alleleset, m, p) in self.pending ] )
+
+        cverr(3, 'D: bulk inserted %d allele(s) of %d channel(s)'
+                    % (len(rows), len(self.pending)))
+        self.total += len(rows)
+        self.written.extend( alleleset for (alleleset, m, p) in self.pending )
+        self.pending = []
+        self.pending_count = 0
+
+
+    def close(self):
+        """ write pending peaks, flush the session and expire the alleles of the
+            written allelesets, so that they are reloaded from database on next
+            access; other changes in the session are kept
+        """
+        from fatools.lib.sqlmodels.schema import repack_allelesets
+
+        self.flush()
+        repack_allelesets( self.session )
+        self.session.flush()
+        for alleleset in self.written:
+            self.session.expire( alleleset, ['alleles'] )
+        self.written = []
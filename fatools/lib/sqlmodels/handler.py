@@ -2,7 +2,7 @@
 import sys, os
 from fatools.lib.utils import cout, cerr
 from fatools.lib.sqlmodels.handler_interface import base_sqlhandler
-from fatools.lib.sqlmodels import schema
+from fatools.lib.sqlmodels import schema, tracestore
 
 
 class SQLHandler(base_sqlhandler):
@@ -27,12 +27,90 @@ class SQLHandler(base_sqlhandler):
             sys.exit(1)
         self.dbfile = dbfile
         self.engine, self.session = schema.engine_from_file(dbfile)
+        self.trace_store = None
+        if os.path.isdir( tracestore.TraceStore.path_for(dbfile) ):
+            self.open_trace_store()
+        if not initial:
+            # older database without the column keeps all peaks as Allele rows,
+            # until upgraded with dbmgr --migrate-packedpeaks
+            schema.AlleleSet.packed_storage = schema.has_packed_storage(self.engine)
+            # likewise, batches of older database have no modification stamps
+            # until upgraded with dbmgr --migrate-batchstamps
+            schema.Batch.stamped = schema.has_batch_stamps(self.engine)
 
 
     def initdb(self, create_table = True):
         if create_table:
             schema.Base.metadata.create_all(self.engine)
+            schema.AlleleSet.packed_storage = True
+            schema.Batch.stamped = True
         from fatools.lib.sqlmodels.setup import setup
         setup( self.session )
         cout('Database at %s has been initialized.' % self.dbfile)
 
+
+    def open_trace_store(self, create=False):
+        """ open the trace store next to the database file, which will be used
+            to resolve trace references held by the database
+        """
+        path = tracestore.TraceStore.path_for(self.dbfile)
+        if create and not os.path.isdir(path):
+            os.mkdir(path)
+        self.trace_store = tracestore.TraceStore(path)
+        tracestore.set_store(self.engine, self.trace_store)
+        return self.trace_store
+
+
+    def repack_peaks(self):
+        """ repack the allelesets whose packed peaks have been modified in the
+            current session; needs to be called before the session is flushed
+        """
+        schema.repack_allelesets( self.session() )
+
+
+    def upgrade_packed_storage(self):
+        """ add column for packed peaks to allelesets table of older database;
+            return True if the table has been upgraded
+        """
+        upgraded = False
+        if not schema.has_packed_storage(self.engine):
+            self.engine.execute('ALTER TABLE allelesets ADD COLUMN peaks BLOB')
+            upgraded = True
+        schema.AlleleSet.packed_storage = True
+        return upgraded
+
+
+    def upgrade_batch_stamps(self):
+        """ add column for modification stamps to batches table of older database;
+            return True if the table has been upgraded
+        """
+        upgraded = False
+        if not schema.has_batch_stamps(self.engine):
+            self.engine.execute('ALTER TABLE batches ADD COLUMN stamp INTEGER NOT NULL DEFAULT 0')
+            upgraded = True
+        schema.Batch.stamped = True
+        return upgraded
+
+
+    def migrate_indexes(self):
+        """ create indexes declared in schema that are missing in older database,
+            and update the statistics used by the query planner; return the names
+            of created indexes
+        """
+        from sqlalchemy import inspect
+
+        inspector = inspect(self.engine)
+        tables = inspector.get_table_names()
+        created = []
+        for table in schema.Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = set( idx['name'] for idx in inspector.get_indexes(table.name) )
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                cerr('I: creating index %s' % index.name)
+                index.create(self.engine)
+                created.append(index.name)
+        self.engine.execute('ANALYZE')
+        return created
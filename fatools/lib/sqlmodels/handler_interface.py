@@ -1,15 +1,35 @@
 
-from pandas import DataFrame
+from pandas import DataFrame, concat
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import bindparam, select, and_, func, inspect
+from sqlalchemy.orm import undefer, contains_eager, object_session
+from sqlalchemy.orm.util import identity_key
+from fatools.lib.const import peaktype, assaystatus
+from fatools.lib.utils import cerr, cverr
+from fatools.lib.sqlmodels.bulk import execute_many
+from fatools.lib.sqlmodels.stamps import touch_batch, get_stamps
+from collections import OrderedDict
+import itertools
+import numpy as np
 
 class base_sqlhandler(object):
     """ base class for SQLAlchemy-friendly handler """
 
+    allele_cache_size = 0
+    """ number of allele dataframes kept by get_allele_dataframe(); the cache is
+        invalidated only by changes made within this process, hence it is off
+        unless the database is not modified by other processes meanwhile
+    """
+
+    prefetch_page_size = 20
+    """ number of assays whose channels are prefetched at once by AssayList """
+
     Panel = None
     Marker = None
     Batch = None
     Sample = None
     Assay = None
+    Channel = None
     Allele = None
 
     def __init__(self):
@@ -95,26 +115,303 @@ class base_sqlhandler(object):
     def get_batches(self):
         return self.Batch.query(self.session())
 
+    def get_code_lookup(self, sample_ids=None, marker_ids=None):
+        """ return CodeLookup with codes of samples and markers, each loaded with
+            a single query; if sample_ids or marker_ids is None, all samples or
+            markers are loaded
+        """
+
+        session = self.session()
+        maps = []
+        for (cls, ids) in [ (self.Sample, sample_ids), (self.Marker, marker_ids) ]:
+            q = session.query( cls.id, cls.code )
+            if ids is not None:
+                ids = [ int(i) for i in set(ids) ]
+                if not ids:
+                    maps.append( {} )
+                    continue
+                q = q.filter( cls.id.in_( ids ) )
+            maps.append( dict(q) )
+
+        return CodeLookup( *maps )
+
+
     def get_by_ids(self):
         pass
 
 
+    def get_assay_list(self, batch, sample_codes=None, filenames=None, assay_ids=None,
+                panel_codes=None):
+        """ return AssayList of (assay, sample_code) of assays of batch, selected
+            with a single query, optionally restricted to the given sample codes,
+            assay filenames, assay ids and panel codes
+        """
+
+        Assay, Sample, Panel = self.Assay, self.Sample, self.Panel
+        q = self.session().query( Assay, Sample.code ).join( Assay.sample ).join( Assay.panel )
+        q = q.filter( Sample.batch_id == batch.id )
+        if sample_codes:
+            q = q.filter( Sample.code.in_( sample_codes ) )
+        if filenames:
+            q = q.filter( Assay.filename.in_( filenames ) )
+        if assay_ids:
+            q = q.filter( Assay.id.in_( assay_ids ) )
+        if panel_codes:
+            q = q.filter( Panel.code.in_( panel_codes ) )
+        q = q.options( contains_eager( Assay.sample ), contains_eager( Assay.panel ) )
+
+        return AssayList( self, q.order_by( Sample.id, Assay.id ) )
+
+
+    def release_assay(self, assay):
+        """ expunge assay with its channels, allelesets and alleles from the session;
+            the changes of the assay need to be flushed first
+        """
+
+        session = object_session(assay)
+        if session is None:
+            return
+
+        # channels and allelesets are dynamic relationships, hence only their ids
+        # are queried, and the instances already in the session are looked up
+        q = session.query( self.Channel.id, self.AlleleSet.id ).outerjoin( self.AlleleSet,
+                    self.AlleleSet.channel_id == self.Channel.id ).filter(
+                    self.Channel.assay_id == assay.id )
+        instances = []
+        for (channel_id, alleleset_id) in q:
+            instances.append( session.identity_map.get( identity_key(self.Channel, channel_id) ) )
+            if alleleset_id is None:
+                continue
+            alleleset = session.identity_map.get( identity_key(self.AlleleSet, alleleset_id) )
+            if alleleset is None:
+                continue
+            instances.append( alleleset )
+            # alleles are released only if loaded, without loading them
+            if 'alleles' not in inspect(alleleset).unloaded:
+                instances.extend( alleleset.alleles )
+        instances.append( assay )
+
+        for instance in instances:
+            if instance is not None and instance in session:
+                session.expunge( instance )
+
+
+    def prefetch_channels(self, assays, columns=('data', 'raw_data')):
+        """ load channels of assays, including their deferred columns, with a single
+            query; the returned channels need to be kept referenced while the assays
+            are processed, as the session holds only weak references to them
+        """
+
+        ids = [ assay.id for assay in assays ]
+        if not ids:
+            return []
+        q = self.session().query( self.Channel ).filter( self.Channel.assay_id.in_( ids ) )
+        return q.options( *[ undefer(column) for column in columns ] ).all()
+
+
     ## getter for data
 
     def get_allele_dataframe(self, sample_ids, marker_ids, params):
         """ return a Pandas dataframe with this columns
-            ( marker_id, sample_id, bin, size, height, assay_id )
+            ( marker_id, sample_id, value, size, height, assay_id, allele_id,
+              ratio, rank )
+            packed peaks of the requested types are included with allele_id of -1;
+            if allele_cache_size is set, the result is taken from a cached
+            dataframe of the same filter params that covers sample_ids and
+            marker_ids, as long as the stamps of the batches of its samples (see
+            stamps.py) are unchanged, ie. the batches have not been modified by
+            any process since
         """
 
+        assert sample_ids
+        assert marker_ids
+        assert params
+
+        if not (self.allele_cache_size and self.Batch.stamped):
+            return self.query_allele_dataframe(sample_ids, marker_ids, params)
+
+        sample_ids = frozenset(sample_ids)
+        marker_ids = frozenset(marker_ids)
+        params_key = allele_params_key(params)
+
+        cache = self._allele_cache()
+        batch_ids = set( itertools.chain( *[ e.stamps for e in cache.values() ] ) )
+        stamps = get_stamps( self.session(), batch_ids ) if batch_ids else {}
+        key = (hash(sample_ids), tuple(sorted(marker_ids)), params_key)
+        entry = cache.get(key)
+        if entry is None or not entry.covers(sample_ids, marker_ids, params_key, stamps):
+            # any other cached dataframe covering the samples & markers
+            entry = next( ( e for e in cache.values()
+                                if e.covers(sample_ids, marker_ids, params_key, stamps) ),
+                            None )
+
+        if entry is None:
+            for k in [ k for (k, e) in cache.items() if not e.is_valid(stamps) ]:
+                del cache[k]
+            batch_ids = self.get_batch_ids_of_samples(sample_ids)
+            entry = AlleleCacheEntry( key, sample_ids, marker_ids,
+                        get_stamps( self.session(), batch_ids ),
+                        self.query_allele_dataframe(sample_ids, marker_ids, params) )
+            cache[key] = entry
+            while len(cache) > self.allele_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end( entry.key )
+
+        return entry.subset( sample_ids, marker_ids )
+
+
+    def _allele_cache(self):
+        try:
+            return self._allele_cache_
+        except AttributeError:
+            self._allele_cache_ = OrderedDict()
+            return self._allele_cache_
+
+
+    def get_batch_ids_of_samples(self, sample_ids):
+        q = self.session().query( self.Sample.batch_id ).filter(
+                        self.Sample.id.in_( list(sample_ids) ) ).distinct()
+        return sorted( batch_id for (batch_id,) in q )
+
+
+    def query_allele_dataframe(self, sample_ids, marker_ids, params):
+        """ query the database and return allele dataframe, see get_allele_dataframe() """
+
         # params ->
         # allele_absolute_threshold
         # allele_relative_threshold
         # allele_relative_cutoff
         # peak_type
 
-        assert sample_ids
-        assert marker_ids
-        assert params
+        q = self.get_allele_query(sample_ids, marker_ids, params)
+        groups = self._read_allele_groups(q)
+
+        packed = self._read_packed_alleles(sample_ids, marker_ids, params)
+        if packed is not None and len(packed) > 0:
+            # packed peaks are merged into the groups of Allele rows
+            df = concat( list(groups) + [ packed ], ignore_index=True )
+            df = df.sort_values( [ 'marker_id', 'sample_id', 'height' ],
+                        ascending = [ True, True, False ], kind = 'mergesort' )
+            groups = [ df.reset_index(drop=True) ]
+
+        filtering = ( params.rel_threshold != 0 or params.rel_cutoff != 0 or
+                        params.stutter_ratio != 0 )
+        dfs = []
+        for df in groups:
+            if filtering:
+                df = filter_allele_groups(df, params)
+            else:
+                df['ratio'] = 1
+                df['rank'] = -1
+            dfs.append( df )
+
+        dfs = [ df for df in dfs if len(df) > 0 ]
+        if not dfs:
+            return DataFrame()
+
+        df = concat( dfs, ignore_index=True )
+        return df[ [ 'marker_id', 'sample_id', 'value', 'size', 'height', 'assay_id',
+                        'allele_id', 'ratio', 'rank' ] ]
+
+
+    def _read_allele_groups(self, q, chunksize=100000):
+        """ yield dataframes of result of allele query q, read in chunks; rows of
+            the last (marker_id, sample_id) group of a chunk are carried over to
+            the next chunk, so that each group is yielded in a single dataframe
+        """
+
+        columns = [ ('sample_id', int), ('assay_id', int), ('marker_id', int),
+                    ('allele_id', int), ('value', int), ('size', float), ('height', float) ]
+
+        # all columns are plain numbers, so rows are fetched from the DBAPI cursor
+        # without the per-row overhead of result proxies
+        result = self.session().execute( q.statement )
+        carry = None
+        while True:
+            rows = result.cursor.fetchmany( chunksize )
+            if not rows:
+                break
+            df = DataFrame( { name: np.array( values, dtype=dtype )
+                                for ((name, dtype), values) in zip(columns, zip(*rows)) },
+                            columns = [ name for (name, dtype) in columns ] )
+            if carry is not None:
+                df = concat( [ carry, df ], ignore_index=True )
+            last = ( (df['marker_id'] == df['marker_id'].iat[-1]) &
+                        (df['sample_id'] == df['sample_id'].iat[-1]) )
+            carry = df[last]
+            yield df[~last].reset_index(drop=True)
+
+        result.close()
+        if carry is not None:
+            yield carry.reset_index(drop=True)
+
+
+    def _read_packed_alleles(self, sample_ids, marker_ids, params):
+        """ return dataframe of the packed peaks of the allelesets of sample_ids
+            passing the peak type and absolute threshold of params, with the
+            columns of _read_allele_groups() and allele_id of -1; return None if
+            peaks of these types are always stored as Allele rows
+        """
+
+        if type(params.peaktype) in [ list, tuple ]:
+            peaktypes = params.peaktype
+        else:
+            peaktypes = [ params.peaktype ]
+        if not self._reads_packed(peaktypes):
+            return None
+
+        self.repack_peaks()
+        q = self.session().query( self.AlleleSet.sample_id, self.Channel.assay_id,
+                self.AlleleSet.marker_id, self.AlleleSet.peaks
+            ).join( self.Channel, self.AlleleSet.channel_id == self.Channel.id )
+        q = q.filter( self.AlleleSet.sample_id.in_( list(sample_ids) ),
+                    self.AlleleSet.peaks != None )
+        if marker_ids:
+            q = q.filter( self.AlleleSet.marker_id.in_( list(marker_ids) ) )
+
+        columns = dict( sample_id = [], assay_id = [], marker_id = [], value = [],
+                    size = [], height = [] )
+        for (sample_id, assay_id, marker_id, peaks) in q:
+            peaks = select_packed( peaks, peaktypes )
+            if params.abs_threshold > 0:
+                peaks = peaks[ peaks['height'] > params.abs_threshold ]
+            n = len(peaks)
+            if n == 0:
+                continue
+            columns['sample_id'].append( np.full(n, sample_id, dtype=int) )
+            columns['assay_id'].append( np.full(n, assay_id, dtype=int) )
+            columns['marker_id'].append( np.full(n, marker_id, dtype=int) )
+            columns['value'].append( peaks['bin'].astype(int) )
+            columns['size'].append( peaks['size'].astype(float) )
+            columns['height'].append( peaks['height'].astype(float) )
+
+        if not columns['sample_id']:
+            return None
+        df = DataFrame( { name: np.concatenate(values) for (name, values) in columns.items() } )
+        df['allele_id'] = -1
+        return df[ [ 'sample_id', 'assay_id', 'marker_id', 'allele_id', 'value', 'size',
+                        'height' ] ]
+
+
+    def _reads_packed(self, peaktypes=None):
+        """ return True if peaks of peaktypes (or of any type if None) may be kept
+            as packed peaks, and hence are not found by queries of Allele rows
+        """
+        if not self.AlleleSet.packed_storage:
+            return False
+        if peaktypes is None:
+            return True
+        return not set(peaktypes) <= set(self.AlleleSet.materialized_types)
+
+
+    def get_allele_query(self, sample_ids, marker_ids, params):
+        """ return query of ( sample_id, assay_id, marker_id, allele_id, bin, size,
+            height ) of Allele rows, ordered by marker_id, sample_id and descending
+            height; the filters match ix_allelesets_sample_marker and
+            ix_alleles_alleleset_type_height indexes. Packed peaks are not
+            included, see _read_packed_alleles()
+        """
 
         q = self.session().query( self.AlleleSet.sample_id, self.Channel.assay_id,
                 self.Allele.marker_id, self.Allele.id, self.Allele.bin,
@@ -129,88 +426,275 @@ class base_sqlhandler(object):
         q = q.order_by( self.Allele.marker_id, self.AlleleSet.sample_id,
                         self.Allele.height.desc() )
 
-        print('MARKER IDS:', marker_ids)
-
         if marker_ids:
             q = q.filter( self.AlleleSet.marker_id.in_( marker_ids ) )
-            #q = q.outerjoin( Marker, Allele.marker_id == Marker.id )
-            #q = q.filter( Marker.id.in_( marker_ids ) )
 
         if params.abs_threshold > 0:
             q = q.filter( self.Allele.height > params.abs_threshold )
 
-        if params.rel_threshold == 0 and params.rel_cutoff == 0 and params.stutter_ratio == 0:
-            df = DataFrame( [ (marker_id, sample_id, value, size, height, assay_id, allele_id, 1, -1 )
-                    for ( sample_id, assay_id, marker_id, allele_id, value, size, height ) in q ] )
+        return q
+
 
-        else:
+    def get_allele_sizes(self, marker, batches, peaktypes=None):
+        """ return numpy array of allele sizes of marker from all samples in batches,
+            including the packed peaks
+        """
 
-            alleles = []
-
-            # loop control
-            max_height = 0
-            last_marker_id = 0
-            last_sample_id = 0
-            skip_flag = False       # whether to skip the current sample & marker
-            stutter_flag = False    # whether current allele is considered stutter
-            current_alleles = None  # contains the alleles of current sample & marker
-
-            # the loop
-            for ( sample_id, assay_id, marker_id, allele_id, value, size, height ) in q:
-                if sample_id == last_sample_id:
-                    if last_marker_id == marker_id:
-                        if skip_flag:
-                            continue
-                        rank += 1
-                        ratio = height / max_height
-                        if ratio < params.rel_threshold:
-                            skip_flag = True
-                            continue
-                        if (    params.rel_cutoff > 0 and
-                                ratio > params.rel_cutoff ):
-                            # turn off this marker by skipping this sample_id & marker_id
-                            skip_flag = True
-                            # don't forget to remove the latest allele
-                            del alleles[-1]
-                            continue
-
-                        stutter_flag = False
-                        if params.stutter_ratio > 0:
-                            for dval, dsize, dheight in current_alleles:
-                                allele_range = abs(dsize - size)
-                                allele_ratio = height/dheight
-                                if ( (  allele_range < params.stutter_range and
-                                        allele_ratio < params.stutter_ratio ) or
-                                      ( allele_range < params.stutter_baserange and
-                                        allele_ratio < params.stutter_baseratio )):
-                                    stutter_flag = True
-                                    break
-                                    current_alleles.append( (value, size, height) )
-                                    print(sample_id, marker_id, value, size, height, allele_ratio)
-                                    continue
-
-                        current_alleles.append( (value, size, height) )
-                        if stutter_flag:
-                            continue
-
-                else:
-                    last_sample_id = sample_id
-                    last_marker_id = marker_id
-                    max_height = height
-                    skip_flag = False
-                    ratio = 1
-                    rank = 1
-                    current_alleles = [ (value, size, height) ]
-
-                alleles.append( (marker_id, sample_id, value, size, height, assay_id, allele_id, ratio, rank) )
-
-            df = DataFrame( alleles )
+        q = self.session().query( self.Allele.size ).select_from(self.Allele)
+        q = q.join( self.AlleleSet, self.Allele.alleleset_id == self.AlleleSet.id )
+        q = q.join( self.Sample, self.AlleleSet.sample_id == self.Sample.id )
+        q = q.filter( self.Allele.marker_id == marker.id,
+                        self.Sample.batch_id.in_( [ b.id for b in batches ] ) )
+        if peaktypes:
+            q = q.filter( self.Allele.type.in_( peaktypes ) )
+        sizes = np.fromiter( (size for (size,) in q), dtype=float )
+
+        if not self._reads_packed(peaktypes):
+            return sizes
+
+        self.repack_peaks()
+        q = self.session().query( self.AlleleSet.peaks )
+        q = q.join( self.Sample, self.AlleleSet.sample_id == self.Sample.id )
+        q = q.filter( self.AlleleSet.marker_id == marker.id, self.AlleleSet.peaks != None,
+                        self.Sample.batch_id.in_( [ b.id for b in batches ] ) )
+        packed = [ ( select_packed(peaks, peaktypes) if peaktypes else peaks )['size']
+                        for (peaks,) in q ]
+        return np.concatenate( [ sizes ] + packed )
+
+
+    def rebin_batch(self, batch, markers=None):
+        """ re-bin the stored alleles of the latest alleleset of each channel of
+            batch without loading the assays, using the current bins of each
+            marker; return number of updated alleles
+        """
 
-        if len(df) == 0:
-            return df
+        session = self.session()
+        session.flush()
+
+        # combined markers are binned by cloning their allelesets per marker,
+        # which requires the assays to be loaded
+        q = session.query( self.AlleleSet.id ).join( self.Sample,
+                    self.AlleleSet.sample_id == self.Sample.id ).join( self.Marker,
+                    self.AlleleSet.marker_id == self.Marker.id ).filter(
+                    self.Sample.batch_id == batch.id, self.Marker.code == 'combined' )
+        if markers:
+            q = q.filter( self.AlleleSet.marker_id.in_( [ m.id for m in markers ] ) )
+        if q.first() is not None:
+            raise RuntimeError('E: batch %s has channels of combined marker, which can not '
+                        'be re-binned without loading the assays' % batch.code)
+
+        latest = self._latest_allelesets(session, batch)
+
+        q = session.query( self.Allele.id, self.Allele.marker_id, self.Allele.size,
+                self.Allele.bin, self.Allele.type, self.Channel.assay_id
+            ).select_from(self.Allele)
+        q = q.join( self.AlleleSet, self.Allele.alleleset_id == self.AlleleSet.id )
+        q = q.join( self.Channel, self.AlleleSet.channel_id == self.Channel.id )
+        q = q.join( self.Sample, self.AlleleSet.sample_id == self.Sample.id )
+        q = q.filter( self.Sample.batch_id == batch.id, self.AlleleSet.id.in_( latest ) )
+        if markers:
+            q = q.filter( self.Allele.marker_id.in_( [ m.id for m in markers ] ) )
+        q = q.order_by( self.Allele.marker_id )
+
+        # packed peaks first, so that peaks materialized by re-binning are
+        # already flushed as rows when the rows are queried below
+        packed_changed, processed = self._rebin_packed(session, batch, markers)
+
+        rows = q.all()
+        if not rows and not processed:
+            return 0
+
+        n_changed = packed_changed
+        if rows:
+            allele_ids, marker_ids, sizes, bins, types, assay_ids = zip( *rows )
+            marker_ids = np.array(marker_ids)
+            sizes = np.array(sizes, dtype=float)
+            new_bins = np.array(bins)
+            new_types = np.array(types, dtype=object)
+            done = np.zeros(len(rows), dtype=bool)
+
+            starts = np.flatnonzero( np.r_[True, marker_ids[1:] != marker_ids[:-1]] )
+            ends = np.r_[starts[1:], len(rows)]
+            for (start, end) in zip(starts, ends):
+                marker = self.get_marker_by_id( int(marker_ids[start]) )
+                if marker.code in ('ladder', 'undefined'):
+                    continue
+                try:
+                    binindex = marker.get_binindex(batch)
+                except RuntimeError:
+                    cerr('W: no bins for marker %s, skipped' % marker.label)
+                    continue
+
+                cverr(3, 'D: re-binning %d allele(s) of marker %s' % (end - start, marker.label))
+                s = slice(start, end)
+                valid = sizes[s] >= 0
+                inrange = valid & (sizes[s] > marker.min_size) & (sizes[s] < marker.max_size)
+                new_bins[s] = np.where( inrange, binindex.bin_values(sizes[s]), new_bins[s] )
+                types_ = new_types[s]
+                types_[ valid & ~inrange ] = peaktype.unassigned
+                types_[ inrange & np.isin(types_, [ peaktype.unassigned, peaktype.called ]) ] = peaktype.bin
+                done[s] = True
+
+            changed = np.flatnonzero( done & ( (new_bins != np.array(bins)) |
+                                                (new_types != np.array(types, dtype=object)) ) )
+            if len(changed):
+                t = self.Allele.__table__
+                stmt = t.update().where( t.c.id == bindparam('_id') ).values(
+                            bin = bindparam('_bin'), type = bindparam('_type') )
+                execute_many( session, stmt, [ dict( _id = allele_ids[i],
+                        _bin = int(new_bins[i]), _type = new_types[i] ) for i in changed ] )
+            n_changed += len(changed)
+            processed |= set( assay_ids[i] for i in np.flatnonzero(done) )
+
+        processed = sorted( processed )
+        if processed:
+            t = self.Assay.__table__
+            stmt = t.update().where( t.c.id == bindparam('_id') ).values(
+                        status = assaystatus.binned )
+            execute_many( session, stmt, [ dict( _id = assay_id ) for assay_id in processed ] )
+
+        # loaded instances are now stale
+        session.expire_all()
+        touch_batch(session, batch.id)
+
+        return n_changed
+
+
+    def _latest_allelesets(self, session, batch):
+        """ return subquery of the ids of the latest alleleset of each channel of
+            batch, ie. the allelesets that are not superseded by a later scan
+        """
 
-        df.columns = ( 'marker_id', 'sample_id', 'value', 'size', 'height', 'assay_id', 'allele_id', 'ratio', 'rank' )
-        return df
+        q = session.query( func.max( self.AlleleSet.id ) )
+        q = q.join( self.Sample, self.AlleleSet.sample_id == self.Sample.id )
+        q = q.filter( self.Sample.batch_id == batch.id )
+        return q.group_by( self.AlleleSet.channel_id ).subquery()
+
+
+    def _rebin_packed(self, session, batch, markers):
+        """ re-bin packed peaks of the latest allelesets of batch; peaks that
+            become binned are materialized as Allele rows when the allelesets
+            are flushed
+        """
+
+        if not self.AlleleSet.packed_storage:
+            return 0, set()
+
+        q = session.query( self.AlleleSet ).options( undefer('peaks') )
+        q = q.join( self.Sample, self.AlleleSet.sample_id == self.Sample.id )
+        q = q.filter( self.Sample.batch_id == batch.id, self.AlleleSet.peaks != None,
+                    self.AlleleSet.id.in_( self._latest_allelesets(session, batch) ) )
+        if markers:
+            q = q.filter( self.AlleleSet.marker_id.in_( [ m.id for m in markers ] ) )
+
+        changed = 0
+        assay_ids = set()
+        binindexes = {}
+        for alleleset in q:
+            marker = self.get_marker_by_id( alleleset.marker_id )
+            if marker.code in ('ladder', 'undefined'):
+                continue
+            if marker.id not in binindexes:
+                try:
+                    binindexes[marker.id] = marker.get_binindex(batch)
+                except RuntimeError:
+                    cerr('W: no bins for marker %s, skipped' % marker.label)
+                    binindexes[marker.id] = None
+            binindex = binindexes[marker.id]
+            alleles = alleleset.get_packed_alleles()
+            if binindex is None or not alleles:
+                continue
+
+            sizes = np.array( [ a.size for a in alleles ], dtype=float )
+            for (allele, size, value) in zip(alleles, sizes, binindex.bin_values(sizes).tolist()):
+                if size < 0:
+                    continue
+                if not (marker.min_size < size < marker.max_size):
+                    if allele.type != peaktype.unassigned:
+                        allele.type = peaktype.unassigned
+                        changed += 1
+                    continue
+                type_ = allele.type
+                if type_ in (peaktype.unassigned, peaktype.called):
+                    type_ = peaktype.bin
+                if allele.bin != value or allele.type != type_:
+                    allele.bin = value
+                    allele.type = type_
+                    changed += 1
+            assay_ids.add( alleleset.channel.assay_id )
+
+        # repack the modified allelesets
+        self.repack_peaks()
+        session.flush()
+
+        return changed, assay_ids
+
+
+    def pack_batch_peaks(self, batch, chunk=1000):
+        """ move stored alleles of batch that are not of the materialized types
+            (see AlleleSet.materialized_types) to the packed peaks of their
+            allelesets, except those of ladder channels; return ( number of
+            allelesets, number of alleles )
+        """
+
+        if not self.AlleleSet.packed_storage:
+            raise RuntimeError('E: database has no column for packed peaks, '
+                        'upgrade it with dbmgr --migrate-packedpeaks')
+
+        session = self.session()
+        session.flush()
+
+        t = self.Allele.__table__
+        at = self.AlleleSet.__table__
+        dtype = self.AlleleSet.peak_dtype
+
+        q = session.query( self.AlleleSet.id ).join( self.Sample,
+                    self.AlleleSet.sample_id == self.Sample.id ).join( self.Marker,
+                    self.AlleleSet.marker_id == self.Marker.id )
+        alleleset_ids = [ alleleset_id for (alleleset_id,) in q.filter(
+                    self.Sample.batch_id == batch.id, self.Marker.code != 'ladder' ) ]
+
+        update_stmt = at.update().where( at.c.id == bindparam('_id') ).values(
+                    peaks = bindparam('_peaks', type_=at.c.peaks.type) )
+        delete_stmt = t.delete().where( t.c.id == bindparam('_id') )
+
+        n_allelesets = n_alleles = 0
+        for i in range(0, len(alleleset_ids), chunk):
+            ids = alleleset_ids[i:i + chunk]
+            rows = session.execute( select( [ t.c.alleleset_id, t.c.id ]
+                            + [ t.c[name] for name in dtype.names ] ).where( and_(
+                        t.c.alleleset_id.in_( ids ),
+                        ~ t.c.type.in_( self.AlleleSet.materialized_types ) ) ).order_by(
+                        t.c.alleleset_id, t.c.rtime ) ).fetchall()
+            if not rows:
+                continue
+
+            existing = dict( session.execute( select( [ at.c.id, at.c.peaks ] ).where(
+                        and_( at.c.id.in_( ids ), at.c.peaks != None ) ) ).fetchall() )
+
+            updates = []
+            groups = np.array( [ row[0] for row in rows ] )
+            starts = np.flatnonzero( np.r_[True, groups[1:] != groups[:-1]] )
+            ends = np.r_[starts[1:], len(rows)]
+            for (start, end) in zip(starts, ends):
+                alleleset_id = int(groups[start])
+                peaks = np.array( [ tuple(row[2:]) for row in rows[start:end] ], dtype=dtype )
+                if alleleset_id in existing:
+                    peaks = np.sort( np.concatenate( [ existing[alleleset_id], peaks ] ),
+                                order='rtime', kind='stable' )
+                updates.append( dict( _id = alleleset_id, _peaks = peaks ) )
+
+            execute_many( session, update_stmt, updates )
+            execute_many( session, delete_stmt, [ dict( _id = row[1] ) for row in rows ] )
+            cverr(3, 'D: packed %d allele(s) of %d alleleset(s)' % (len(rows), len(updates)))
+            n_allelesets += len(updates)
+            n_alleles += len(rows)
+
+        # loaded instances are now stale
+        session.expire_all()
+        touch_batch(session, batch.id)
+
+        return n_allelesets, n_alleles
 
 
     def customize_filter(self, q, params):
@@ -223,3 +707,190 @@ class base_sqlhandler(object):
 
         return q
 
+
+def allele_params_key(params):
+    """ return hashable key of the params used by get_allele_query() and
+        filter_allele_groups()
+    """
+    peaktype = params.peaktype
+    if type(peaktype) in [ list, tuple ]:
+        peaktype = tuple(peaktype)
+    return ( peaktype, params.abs_threshold, params.rel_threshold, params.rel_cutoff,
+                params.stutter_ratio ) + tuple( getattr(params, name, None) for name in
+                ( 'stutter_range', 'stutter_baserange', 'stutter_baseratio' ) )
+
+
+class CodeLookup(object):
+    """ id -> code maps of samples and markers, for vectorized mapping of
+        dataframe columns, eg. df['sample_id'].map(lookup.samples)
+    """
+
+    def __init__(self, samples, markers):
+        self.samples = samples
+        self.markers = markers
+
+    def sample_codes(self, sample_ids):
+        return [ self.samples[i] for i in sample_ids ]
+
+    def marker_codes(self, marker_ids):
+        return [ self.markers[i] for i in marker_ids ]
+
+
+class AssayList(object):
+    """ (assay, sample_code) of the assays selected by a query; the rows are
+        streamed with yield_per, and the channels of each page of assays are
+        prefetched, instead of loading the deferred traces of every channel with
+        its own query
+    """
+
+    def __init__(self, dbh, q, page_size=None):
+        self.dbh = dbh
+        self.q = q
+        self.page_size = page_size or dbh.prefetch_page_size
+        self._len = None
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self.q.order_by(None).count()
+        return self._len
+
+    def rows(self):
+        """ iterate over (assay, sample_code) without prefetching the channels """
+        return iter( self.q.yield_per( self.page_size ) )
+
+    def __iter__(self):
+        rows = self.rows()
+        while True:
+            page = list(itertools.islice(rows, self.page_size))
+            if not page:
+                return
+            channels = self.dbh.prefetch_channels( [ assay for (assay, sample_code) in page ] )
+            yield from page
+            del channels
+
+
+class AlleleCacheEntry(object):
+    """ allele dataframe of sample_ids and marker_ids, with the stamps of the
+        batches of the samples at the time of the query
+    """
+
+    def __init__(self, key, sample_ids, marker_ids, stamps, df):
+        self.key = key
+        self.sample_ids = sample_ids
+        self.marker_ids = marker_ids
+        self.stamps = stamps
+        self.df = df
+
+    def is_valid(self, stamps):
+        """ stamps is dict of batch_id: current stamp, see stamps.get_stamps() """
+        return all( stamps.get(batch_id) == stamp for (batch_id, stamp) in self.stamps.items() )
+
+    def covers(self, sample_ids, marker_ids, params_key, stamps):
+        return ( self.key[2] == params_key and sample_ids <= self.sample_ids and
+                    marker_ids <= self.marker_ids and self.is_valid(stamps) )
+
+    def subset(self, sample_ids, marker_ids):
+        """ return copy of the dataframe restricted to sample_ids and marker_ids """
+        df = self.df
+        if len(df) == 0:
+            return df.copy()
+        if sample_ids == self.sample_ids and marker_ids == self.marker_ids:
+            return df.copy()
+        mask = df['sample_id'].isin(sample_ids) & df['marker_id'].isin(marker_ids)
+        return df[mask].reset_index(drop=True)
+
+
+def select_packed(peaks, peaktypes):
+    """ return the packed peaks whose type is in peaktypes """
+    types = np.array( [ t.encode('ASCII') for t in peaktypes ], dtype=peaks.dtype['type'] )
+    return peaks[ np.isin( peaks['type'], types ) ]
+
+
+def filter_allele_groups(df, params):
+    """ return rows of df passing relative threshold, cutoff and stutter filters
+        of params, with ratio (height relative to the highest peak) and rank
+        (order by descending height) of each row within its (marker_id,
+        sample_id) group; df must be ordered by marker_id, sample_id and
+        descending height
+    """
+
+    # groups are contiguous, the first row of each group is its highest peak
+    group, starts = group_index( df['marker_id'].values, df['sample_id'].values )
+    height = df['height'].values.astype(float)
+    rank = np.arange( len(df) ) - starts[group] + 1
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        ratio = height / height[ starts[group] ]
+    ratio[ rank == 1 ] = 1
+
+    # rows below relative threshold, except the highest one
+    keep = (rank == 1) | (ratio >= params.rel_threshold)
+
+    if params.rel_cutoff > 0:
+        # a second peak above the cutoff excludes the whole sample & marker
+        excluded = np.zeros( len(starts), dtype=bool )
+        excluded[ group[ keep & (rank == 2) & (ratio > params.rel_cutoff) ] ] = True
+        keep &= ~ excluded[group]
+
+    if params.stutter_ratio > 0:
+        # peaks below threshold are not considered, as in the original row loop
+        stutter = np.zeros( len(df), dtype=bool )
+        stutter[keep] = stutter_mask( group[keep], df['size'].values[keep], height[keep],
+                                rank[keep], params )
+        keep &= ~stutter
+
+    df = df[keep].copy()
+    df['ratio'] = ratio[keep]
+    df['rank'] = rank[keep]
+    return df
+
+
+def group_index(*keys):
+    """ return ( group number of each row, index of first row of each group )
+        for rows sorted by keys
+    """
+
+    n = len(keys[0])
+    if n == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    boundary = np.zeros( n, dtype=bool )
+    boundary[0] = True
+    for key in keys:
+        boundary[1:] |= key[1:] != key[:-1]
+    return np.cumsum(boundary) - 1, np.flatnonzero(boundary)
+
+
+def stutter_mask(group, size, height, rank, params):
+    """ return boolean array marking stutter peaks, ie. peaks that are close to
+        a higher ranked peak of the same group and lower than the stutter ratio
+        (or base ratio within the base range) of that peak
+    """
+
+    n = len(group)
+
+    # sort by size within group, so that neighbouring peaks are in a window
+    order = np.lexsort( (size, group) )
+    group, size, height, rank = group[order], size[order], height[order], rank[order]
+
+    width = max( params.stutter_range, params.stutter_baserange )
+    stutter = np.zeros( n, dtype=bool )
+    for k in range(1, n):
+        distance = np.abs( size[k:] - size[:-k] )
+        near = (group[k:] == group[:-k]) & (distance < width)
+        if not near.any():
+            # sizes are sorted, farther neighbours are out of the window as well
+            break
+
+        # compare the lower ranked peak of each pair against the higher ranked one
+        left_first = rank[:-k] < rank[k:]
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            ratio = np.where( left_first, height[k:] / height[:-k], height[:-k] / height[k:] )
+        is_stutter = near & ( ( (distance < params.stutter_range) &
+                                    (ratio < params.stutter_ratio) ) |
+                                ( (distance < params.stutter_baserange) &
+                                    (ratio < params.stutter_baseratio) ) )
+        stutter[k:] |= is_stutter & left_first
+        stutter[:-k] |= is_stutter & ~left_first
+
+    mask = np.zeros( n, dtype=bool )
+    mask[order] = stutter
+    return mask
@@ -0,0 +1,112 @@
+# npcodec.py
+# compact binary encoding of numpy arrays for NPArray columns
+#
+# layout: magic (4 bytes), dtype code, compression code, ndim, pad,
+#         shape as ndim x uint64, then the (compressed) array buffer;
+# blobs without the magic are decoded as legacy numpy.save() output
+
+import numpy as np
+import struct, zlib, lzma, io
+
+
+MAGIC = b'FNP1'
+_HEADER = struct.Struct('<4sBBBx')
+
+_DTYPES = [ np.dtype(t).newbyteorder('<') for t in
+            ( 'bool', 'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64',
+                'uint64', 'float16', 'float32', 'float64' ) ]
+_DTYPE_CODES = { dt: i for (i, dt) in enumerate(_DTYPES) }
+
+NONE, ZLIB, LZMA = 0, 1, 2
+_COMPRESSIONS = { None: NONE, 'none': NONE, 'zlib': ZLIB, 'lzma': LZMA }
+
+_compression = NONE
+_level = 6
+
+
+def set_compression(method=None, level=6):
+    """ set compression (None, 'zlib' or 'lzma') used for newly encoded arrays """
+    global _compression, _level
+    if method not in _COMPRESSIONS:
+        raise RuntimeError('E: unknown compression method: %s' % method)
+    _compression = _COMPRESSIONS[method]
+    _level = level
+
+
+def downcast(arr, rtol=0):
+    """ return arr with the smallest integer dtype that holds its values, or as
+        float32 if the values round trip within rtol (relative tolerance)
+    """
+
+    if arr.size == 0:
+        return arr
+
+    if arr.dtype.kind in 'iu':
+        lo, hi = arr.min(), arr.max()
+        for dt in (np.int16, np.int32):
+            info = np.iinfo(dt)
+            if info.min <= lo and hi <= info.max:
+                return arr.astype(dt) if np.dtype(dt).itemsize < arr.dtype.itemsize else arr
+        return arr
+
+    if arr.dtype == np.float64:
+        arr32 = arr.astype(np.float32)
+        if rtol > 0:
+            if np.allclose(arr32, arr, rtol=rtol, atol=0, equal_nan=True):
+                return arr32
+        elif np.array_equal(arr32, arr):
+            return arr32
+
+    return arr
+
+
+def encode(arr, rtol=None, compression=None, level=None):
+    """ return bytes of arr; if rtol is not None, arr is downcast first """
+
+    arr = np.asarray(arr)
+    if rtol is not None:
+        arr = downcast(arr, rtol)
+
+    dt = arr.dtype.newbyteorder('<')
+    if dt not in _DTYPE_CODES:
+        # unsupported dtype, eg. object or structured array
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        return buf.getvalue()
+
+    compression = _compression if compression is None else _COMPRESSIONS[compression]
+    level = _level if level is None else level
+
+    payload = np.ascontiguousarray(arr, dtype=dt).tobytes()
+    if compression == ZLIB:
+        payload = zlib.compress(payload, level)
+    elif compression == LZMA:
+        payload = lzma.compress(payload, preset=level)
+
+    return b''.join( [ _HEADER.pack(MAGIC, _DTYPE_CODES[dt], compression, arr.ndim),
+                        struct.pack('<%dQ' % arr.ndim, *arr.shape), payload ] )
+
+
+def decode(blob):
+    """ return numpy array from bytes; uncompressed arrays are read-only views
+        of blob
+    """
+
+    if blob[:4] != MAGIC:
+        return np.load(io.BytesIO(blob))
+
+    _, code, compression, ndim = _HEADER.unpack_from(blob)
+    offset = _HEADER.size + 8 * ndim
+    shape = struct.unpack_from('<%dQ' % ndim, blob, _HEADER.size)
+
+    payload = memoryview(blob)[offset:]
+    if compression == ZLIB:
+        payload = zlib.decompress(payload)
+    elif compression == LZMA:
+        payload = lzma.decompress(payload)
+
+    return np.frombuffer(payload, dtype=_DTYPES[code]).reshape(shape)
+
+
+def is_encoded(blob):
+    return blob is not None and blob[:4] == MAGIC
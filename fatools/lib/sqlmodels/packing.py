@@ -0,0 +1,103 @@
+# packing.py
+# packed storage of peaks of an AlleleSet as a single structured array
+
+from fatools.lib.fautil.mixin import AlleleMixIn
+
+from sqlalchemy import types
+import numpy as np
+
+
+_STRLEN = 16
+
+
+def peak_dtype(table):
+    """ return numpy structured dtype holding all non-key columns of alleles table """
+
+    fields = []
+    for c in table.columns:
+        if c.primary_key or c.foreign_keys:
+            continue
+        if isinstance(c.type, types.Boolean):
+            fields.append( (c.name, '?') )
+        elif isinstance(c.type, types.Integer):
+            fields.append( (c.name, '<i4') )
+        elif isinstance(c.type, types.Float):
+            fields.append( (c.name, '<f8') )
+        elif isinstance(c.type, types.String):
+            fields.append( (c.name, 'S%d' % _STRLEN) )
+        else:
+            raise RuntimeError('E: column %s can not be packed' % c.name)
+    return np.dtype(fields)
+
+
+def peak_defaults(table):
+    """ return dict of default values of packed fields """
+
+    defaults = {}
+    for c in table.columns:
+        if c.primary_key or c.foreign_keys:
+            continue
+        if c.default is not None and c.default.is_scalar:
+            defaults[c.name] = c.default.arg
+        elif isinstance(c.type, types.String):
+            defaults[c.name] = ''
+        else:
+            defaults[c.name] = -1
+    return defaults
+
+
+class PackedAllele(AlleleMixIn):
+    """ peak kept in the packed peaks of an AlleleSet, with the same attributes
+        as Allele; modifying any attribute marks the AlleleSet for repacking
+    """
+
+    id = None
+
+    def __init__(self, alleleset, values):
+        self.__dict__.update(values)
+        self.__dict__['alleleset'] = alleleset
+        self.__dict__['marker_id'] = alleleset.marker_id
+
+    def __setattr__(self, key, value):
+        self.__dict__[key] = value
+        self.alleleset.peaks_changed()
+
+    @property
+    def channel(self):
+        return self.alleleset.channel
+
+    @property
+    def marker(self):
+        return self.alleleset.marker
+
+    def values(self, names):
+        return { name: self.__dict__[name] for name in names }
+
+
+def pack_alleles(alleles, dtype):
+    """ return structured array of alleles, sorted by rtime """
+
+    arr = np.zeros(len(alleles), dtype=dtype)
+    for name in dtype.names:
+        values = [ getattr(a, name) for a in alleles ]
+        if dtype[name].kind == 'S':
+            if any( len(v) > _STRLEN for v in values ):
+                raise RuntimeError('E: value of %s is too long to be packed' % name)
+            values = [ v.encode('ASCII') for v in values ]
+        arr[name] = values
+    return np.sort(arr, order='rtime', kind='stable')
+
+
+def unpack_alleles(alleleset, arr):
+    """ return list of PackedAllele from structured array """
+
+    names = arr.dtype.names
+    strings = [ i for (i, name) in enumerate(names) if arr.dtype[name].kind == 'S' ]
+    alleles = []
+    for row in arr.tolist():
+        if strings:
+            row = list(row)
+            for i in strings:
+                row[i] = row[i].decode('ASCII')
+        alleles.append( PackedAllele(alleleset, dict(zip(names, row))) )
+    return alleles
@@ -0,0 +1,197 @@
+# pipeline.py
+# parallel processing of assays, with worker processes and a single writer
+#
+# each worker opens the database on its own and runs a processing stage on one
+# assay at a time, without flushing; the changes of the stage are returned as
+# plain (table, id, values) rows and the session is discarded; the writer, ie.
+# the calling process, applies the rows in batches and commits once every
+# commit_size assays, so that the following stages see the results
+
+from fatools.lib.utils import cverr, set_verbosity
+from fatools.lib.sqlmodels.bulk import execute_many
+from fatools.lib.sqlmodels.stamps import touch_batch
+
+from sqlalchemy import bindparam, inspect
+import transaction
+
+
+_dbh = None
+_peakcache = None
+
+
+class ParallelPipeline(object):
+    """ run assay processing stages with jobs worker processes """
+
+    commit_size = 100
+    """ number of assays whose changes are committed at once """
+
+    def __init__(self, dbh, jobs, pack_peaks=False, aligncache=None, peakcache=None,
+                verbosity=0):
+        import concurrent.futures, multiprocessing
+
+        self.dbh = dbh
+        self.jobs = jobs
+        # workers must not inherit the sqlite connections of this process
+        self.executor = concurrent.futures.ProcessPoolExecutor( max_workers = jobs,
+                    mp_context = multiprocessing.get_context('spawn'),
+                    initializer = init_worker,
+                    initargs = (dbh.dbfile, pack_peaks, aligncache, peakcache, verbosity) )
+
+
+    def run(self, stage, assay_list, kwargs):
+        """ run stage, ie. the name of the assay method, on all assays of assay_list
+            of (assay, sample_code), and yield (sample_code, filename, result)
+        """
+
+        # assays are identified before processing, as committing closes the session
+        # of the assay list
+        items = [ (assay.id, sample_code, assay.filename)
+                    for (assay, sample_code) in assay_list.rows() ]
+
+        worker_kwargs = dict( (k, v) for (k, v) in kwargs.items()
+                                if k not in ('writer', 'peakdb') )
+        if worker_kwargs.get('markers'):
+            worker_kwargs['markers'] = [ m.id for m in worker_kwargs['markers'] ]
+
+        results = self.executor.map( run_stage, [ stage ] * len(items),
+                            [ assay_id for (assay_id, sample_code, filename) in items ],
+                            [ worker_kwargs ] * len(items), chunksize = 4 )
+
+        changes = []
+        pending = 0
+        for ((assay_id, sample_code, filename), (result, assay_changes, cache_counts)) in zip(
+                    items, results):
+
+            if cache_counts and kwargs.get('peakdb'):
+                # peak cache statistics of the worker
+                kwargs['peakdb'].hits += cache_counts[0]
+                kwargs['peakdb'].misses += cache_counts[1]
+
+            if stage == 'scan':
+                # the writer creates the allelesets & alleles of the selected peaks
+                assay = self.dbh.get_assay_by_id( assay_id )
+                assay.scan( peaks = result, **kwargs )
+                result = None
+            elif assay_changes is None:
+                # stage created or removed instances, eg. binning combined markers
+                cverr(3, 'D: processing assay %s in the writer' % filename)
+                assay = self.dbh.get_assay_by_id( assay_id )
+                result = getattr(assay, stage)( **kwargs )
+            else:
+                changes.extend( assay_changes )
+
+            yield (sample_code, filename, result)
+
+            pending += 1
+            if pending >= self.commit_size:
+                self.commit( changes, kwargs.get('writer') )
+                changes = []
+                pending = 0
+
+        self.commit( changes, kwargs.get('writer') )
+
+
+    def commit(self, changes, writer=None):
+        """ apply the changes returned by workers and commit """
+
+        session = self.dbh.session()
+        self.dbh.repack_peaks()
+        if writer:
+            writer.flush()
+        apply_changes( session, self.dbh, changes )
+        transaction.commit()
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+
+def init_worker(dbfile, pack_peaks, aligncache, peakcache, verbosity):
+    global _dbh, _peakcache
+
+    from fatools.lib.sqlmodels.handler import SQLHandler
+
+    if verbosity:
+        set_verbosity(verbosity)
+    _dbh = SQLHandler(dbfile)
+    _dbh.AlleleSet.pack_peaks = pack_peaks
+    if aligncache:
+        from fatools.lib.fautil import aligncache as cache_module
+        cache_module.set_cache(aligncache)
+    if peakcache:
+        from fatools.lib.fautil.peakcache import PeakCache
+        _peakcache = PeakCache(peakcache, shared=True)
+
+
+def run_stage(stage, assay_id, kwargs):
+    """ run stage on assay in a worker, return (result, changes, cache_counts); for
+        scanning, the result is the selected peaks of the channels and cache_counts
+        is the peak cache (hits, misses), otherwise changes is None if the stage
+        created or removed instances
+    """
+
+    session = _dbh.session()
+    try:
+        with session.no_autoflush:
+            assay = _dbh.get_assay_by_id( assay_id )
+            if stage == 'scan':
+                if _peakcache is None:
+                    return ( assay.select_peaks( kwargs['params'] ), [], None )
+                (hits, misses) = (_peakcache.hits, _peakcache.misses)
+                peaks = assay.select_peaks( kwargs['params'], _peakcache )
+                return ( peaks, [],
+                        (_peakcache.hits - hits, _peakcache.misses - misses) )
+
+            if kwargs.get('markers'):
+                kwargs = dict( kwargs,
+                        markers = [ _dbh.get_marker_by_id(i) for i in kwargs['markers'] ] )
+            result = getattr(assay, stage)( **kwargs )
+            return ( result, collect_changes( session ), None )
+    finally:
+        transaction.abort()
+
+
+def collect_changes(session):
+    """ return list of (table name, id, { column: value }) of the modified instances
+        of session, or None if instances have been created or removed
+    """
+
+    from fatools.lib.sqlmodels.schema import repack_allelesets
+    repack_allelesets(session)
+
+    if session.new or session.deleted:
+        return None
+
+    changes = []
+    for instance in session.dirty:
+        state = inspect(instance)
+        values = {}
+        for attr in state.mapper.column_attrs:
+            added = state.attrs[attr.key].history.added
+            if added:
+                values[attr.columns[0].name] = added[0]
+        if values:
+            changes.append( (state.mapper.local_table.name, state.identity[0], values) )
+    return changes
+
+
+def apply_changes(session, dbh, changes):
+    """ write changes returned by collect_changes(), grouped by table & columns """
+
+    tables = dbh.Assay.metadata.tables
+
+    groups = {}
+    for (table_name, instance_id, values) in changes:
+        key = (table_name, tuple(sorted(values)))
+        groups.setdefault(key, []).append(
+                    dict( [ ('_id', instance_id) ] + [ ('_' + k, v) for (k, v) in values.items() ] ) )
+
+    for ((table_name, columns), rows) in groups.items():
+        t = tables[table_name]
+        stmt = t.update().where( t.c.id == bindparam('_id') ).values(
+                    **{ name: bindparam('_' + name, type_=t.c[name].type) for name in columns } )
+        execute_many( session, stmt, rows )
+
+    if changes:
+        touch_batch( session )
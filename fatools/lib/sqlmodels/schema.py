@@ -5,11 +5,14 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import event, create_engine, func
 
 from sqlalchemy import and_, or_, schema, types, MetaData, Sequence, Column, ForeignKey, UniqueConstraint, Table
-from sqlalchemy.orm import relationship, backref, dynamic_loader, deferred, reconstructor
+from sqlalchemy import Index, FetchedValue
+from sqlalchemy.orm import relationship, backref, dynamic_loader, deferred, reconstructor, undefer
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.collections import column_mapped_collection, attribute_mapped_collection
 from sqlalchemy.orm.interfaces import MapperExtension
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.attributes import flag_dirty
 from sqlalchemy.exc import OperationalError, IntegrityError
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
@@ -23,7 +26,13 @@ from fatools.lib.fautil.mixin import ( PanelMixIn, AssayMixIn, ChannelMixIn, Mar
                 NoteMixIn, BatchNoteMixIn, SampleNoteMixIn, AssayNoteMixIn,
                 ChannelNoteMixIn, AlleleSetNoteMixIn, PanelNoteMixIn, MarkerNoteMixIn )
 
-import os, io, yaml
+from fatools.lib.const import peaktype
+from fatools.lib.sqlmodels.packing import (PackedAllele, peak_dtype, peak_defaults,
+                pack_alleles, unpack_alleles)
+
+from fatools.lib.sqlmodels.stamps import touch_batches
+
+import os, io, yaml, itertools
 
 #__all__ = ['get_base', 'get_dbsession', 'set_datalogger']
 
@@ -103,28 +112,58 @@ class YAMLCol(types.TypeDecorator):
         return copy.deepcopy(value)
 
 import numpy, copy
+from fatools.lib.sqlmodels import npcodec, tracestore
 
 class NPArray(types.TypeDecorator):
+    """ numpy array encoded with npcodec; if rtol is not None, arrays are
+        downcast to smaller dtype (within relative tolerance rtol) before stored;
+        if external is True, the encoded arrays can be kept in the trace store
+    """
     impl = types.LargeBinary
 
+    def __init__(self, *args, rtol=None, external=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rtol = rtol
+        self.external = external
+
     def process_bind_param(self, value, dialect):
         if value is None:
             return None
-        #buf = value.tostring()
-        buf = io.BytesIO()
-        numpy.save(buf, value)
-        return buf.getvalue()
+        blob = npcodec.encode(value, self.rtol)
+        if not self.external:
+            return blob
+        return tracestore.store_blob(blob, tracestore.get_store(dialect))
 
     def process_result_value(self, value, dialect):
         if value is None:
             return None
-        buf = io.BytesIO(value)
-        return numpy.load(buf)
-        #return numpy.fromstring(value)
+        return npcodec.decode( tracestore.load_blob(value, tracestore.get_store(dialect)) )
 
     def copy_value(self, value):
         return copy.deepcopy( value )
 
+    def compare_values(self, x, y):
+        if not isinstance(x, numpy.ndarray) or not isinstance(y, numpy.ndarray):
+            # None, or the symbols of unloaded attributes
+            return x is y
+        return x.dtype == y.dtype and numpy.array_equal(x, y)
+
+
+
+class TraceBlob(types.TypeDecorator):
+    """ binary data that can be kept in the trace store """
+    impl = types.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return tracestore.store_blob(value, tracestore.get_store(dialect))
+
+    def process_result_value(self, value, dialect):
+        if value is None or not tracestore.is_ref(value):
+            return value
+        return bytes( tracestore.load_blob(value, tracestore.get_store(dialect)) )
+
 
 
 class Note(Base, NoteMixIn):
@@ -148,9 +187,16 @@ class Batch(Base, BatchMixIn):
     remark = deferred(Column(types.String(1024), nullable=True))
     data = deferred(Column(YAMLCol(4096), nullable=False, default=''))
     bin_batch_id = Column(types.Integer, ForeignKey('batches.id'), nullable=True)
+    # deferred and server-side default, so that older database without the
+    # column can still be read and written
+    stamp = deferred(Column(types.Integer, nullable=False, server_default='0'))
+    """ modification stamp of the allele data of the batch, see stamps.py """
 
     bin_batch = relationship('Batch', uselist=False)
 
+    stamped = False
+    """ whether batches table has the stamp column, set by the db handler """
+
 
     def add_sample(self, sample_code):
         """ return a new Sample with sample_code """
@@ -226,7 +272,8 @@ class Sample(Base, SampleMixIn):
     remark = deferred(Column(types.String(1024), nullable=True))
 
     __table_args__ = (  UniqueConstraint( 'code', 'batch_id' ),
-                        UniqueConstraint( 'altcode', 'batch_id')
+                        UniqueConstraint( 'altcode', 'batch_id'),
+                        Index( 'ix_samples_batch_id', 'batch_id' )
                     )
 
     def new_assay(self, raw_data, filename, status, panel=None):
@@ -367,6 +414,7 @@ class Marker(Base, MarkerMixIn):
         bin.marker_id = self.id
         bin.batch_id = batch.id
         object_session(self).add(bin)
+        self._bins = {}
         return bin
 
 
@@ -430,6 +478,18 @@ class Bin(Base, BinMixIn):
             return None
 
 
+@event.listens_for(Bin.bins, 'set')
+def bins_set(target, value, oldvalue, initiator):
+    target.touch_bins()
+
+
+@event.listens_for(Bin, 'refresh')
+@event.listens_for(Bin, 'expire')
+def bins_reloaded(target, *args):
+    # bins might have been changed by other session
+    target.touch_bins()
+
+
 class Assay(Base, AssayMixIn):
 
     __tablename__ = 'assays'
@@ -460,7 +520,8 @@ class Assay(Base, AssayMixIn):
     #                    post_update = True,
     #                    backref = backref('assay', uselist=False))
 
-    ladder = relationship('Channel', uselist=False,
+    # post_update breaks the assay <-> channel cycle when both are flushed at once
+    ladder = relationship('Channel', uselist=False, post_update = True,
                 primaryjoin = "Assay.ladder_id == Channel.id")
 
     status = Column(types.String(32), nullable=False)
@@ -470,10 +531,12 @@ class Assay(Base, AssayMixIn):
 
     exclude = deferred(Column(types.String(128), nullable=False, default=''))
 
-    raw_data = deferred(Column(types.Binary(), nullable=False))
+    raw_data = deferred(Column(TraceBlob(), nullable=False))
     """ raw data for this assay (FSA file content) """
 
-    __table_args__ = (  UniqueConstraint( 'filename', 'panel_id', 'sample_id' ), )
+    __table_args__ = (  UniqueConstraint( 'filename', 'panel_id', 'sample_id' ),
+                        Index( 'ix_assays_sample_id', 'sample_id' )
+                    )
 
 
     def new_channel(self, raw_data, data, dye, wavelen, status, median, mean,
@@ -530,7 +593,7 @@ class Channel(Base, ChannelMixIn):
 
     markers = relationship(Marker, secondary='channels_markers', viewonly=True)
 
-    raw_data = deferred(Column(NPArray, nullable=False))
+    raw_data = deferred(Column(NPArray(rtol=0, external=True), nullable=False))
     """ raw data from channel as numpy array, can have empty array to accomodate
         allele data from CSV uploading """
 
@@ -544,7 +607,9 @@ class Channel(Base, ChannelMixIn):
     min_height = Column(types.Integer, nullable=False, default=-1)
     """ basic descriptive statistics for data"""
 
-    data = deferred(Column(NPArray, nullable=False))
+    __table_args__ = (  Index( 'ix_channels_assay_id', 'assay_id' ), )
+
+    data = deferred(Column(NPArray(rtol=1e-6, external=True), nullable=False))
     """ data after smoothed using savitzky-golay algorithm and baseline correction
         using top hat morphologic transform
     """
@@ -553,8 +618,11 @@ class Channel(Base, ChannelMixIn):
 
 
     def new_alleleset(self, revision=-1):
-        return AlleleSet( channel = self, sample = self.assay.sample,
+        alleleset = AlleleSet( channel = self, sample = self.assay.sample,
                             marker = self.marker )
+        # new alleleset is the latest one, even before it is flushed
+        self._latest_alleleset = alleleset
+        return alleleset
 
 
     def clear(self):
@@ -563,9 +631,15 @@ class Channel(Base, ChannelMixIn):
 
 
     def get_latest_alleleset(self):
+        alleleset = getattr(self, '_latest_alleleset', None)
+        if alleleset is not None and object_session(alleleset) is object_session(self):
+            return alleleset
         if self.allelesets.count() < 1:
             raise RuntimeError("ERR - channel does not have alleleset, probably hasn't been scanned!")
-        return self.allelesets[-1]
+        q = self.allelesets
+        if AlleleSet.packed_storage:
+            q = q.options( undefer('peaks') )
+        return q[-1]
 
 
 
@@ -621,17 +695,92 @@ class AlleleSet(Base, AlleleSetMixIn):
     binning_method = deferred(Column(types.String(32), nullable=False))
     """ method used for binning this alleleset """
 
+    # FetchedValue keeps the column out of INSERT unless set, so that older
+    # database without the column can still be written
+    peaks = deferred(Column(NPArray, nullable=True, server_default=FetchedValue()))
+    """ packed peaks, ie. peaks that are not materialized as Allele rows """
+
+    packed_storage = False
+    """ whether allelesets table has peaks column, set by the db handler """
+
+    pack_peaks = False
+    """ if True, new peaks are kept packed instead of created as Allele rows """
+
+    materialized_types = ( peaktype.bin, peaktype.called )
+    """ packed peaks of these types are stored as Allele rows when repacked """
+
+    # allele queries filter by sample & marker, and join to channels
+    __table_args__ = (  Index( 'ix_allelesets_sample_marker', 'sample_id', 'marker_id',
+                                'channel_id' ),
+                        Index( 'ix_allelesets_channel_id', 'channel_id' )
+                    )
+
 
     def new_allele(self, rtime, height, area, brtime, ertime, wrtime, srtime, beta, theta,
                     type, method):
-        allele = Allele( rtime = rtime, height = height, area = area,
+        values = dict( rtime = rtime, height = height, area = area,
                     brtime = brtime, ertime = ertime, wrtime = wrtime, srtime = srtime,
                     beta = beta, theta = theta, type = type, method = method )
+
+        if self.pack_peaks:
+            allele = PackedAllele( self, dict(_peak_defaults, **values) )
+            self.get_packed_alleles().append( allele )
+            self.peaks_changed()
+            return allele
+
+        allele = Allele( **values )
         allele.alleleset = self
 
         return allele
 
 
+    @property
+    def all_alleles(self):
+        """ Allele rows and packed peaks, sorted by rtime if any peak is packed """
+        packed = self.get_packed_alleles()
+        if not packed:
+            return self.alleles
+        return sorted( list(self.alleles) + packed, key = lambda a: a.rtime )
+
+
+    def get_packed_alleles(self):
+        try:
+            return self._packed
+        except AttributeError:
+            pass
+        if self.packed_storage and self.peaks is not None:
+            self._packed = unpack_alleles( self, self.peaks )
+        else:
+            self._packed = []
+        return self._packed
+
+
+    def peaks_changed(self):
+        session = object_session(self)
+        if session is None:
+            self.repack()
+            return
+        # flag as dirty, so that the repacked peaks are written when flushed
+        flag_dirty(self)
+        changed_allelesets(session).add(self)
+
+
+    def repack(self):
+        """ move packed peaks of materialized types to Allele rows, and pack the rest """
+
+        packed = []
+        for allele in self.get_packed_alleles():
+            if allele.type in self.materialized_types:
+                row = Allele( **allele.values(_peak_dtype.names) )
+                row.marker_id = self.marker_id
+                row.alleleset = self
+            else:
+                packed.append( allele )
+
+        self._packed = packed
+        self.peaks = pack_alleles( packed, _peak_dtype ) if packed else None
+
+
 
 class AlleleSetNote(Base, AlleleSetNoteMixIn):
 
@@ -653,7 +802,7 @@ class Allele(Base, AlleleMixIn):
                 nullable=False)
     alleleset = relationship(AlleleSet, uselist=False,
                 backref=backref('alleles', cascade='all, delete-orphan',
-                passive_deletes=True))
+                passive_deletes=True, order_by='Allele.rtime'))
 
     marker_id = Column(types.Integer, ForeignKey('markers.id', ondelete='CASCADE'),
                 nullable=False)
@@ -698,12 +847,104 @@ class Allele(Base, AlleleMixIn):
     qscore = Column(types.Float, nullable=False, default=-1)    # calculated in preannotate()
     qcall = Column(types.Float, nullable=False, default=-1)     # calculated in call()
 
+    # covering index for allele queries by alleleset (see get_allele_query()),
+    # and for size queries by marker
+    __table_args__ = (  Index( 'ix_alleles_alleleset_type_height', 'alleleset_id', 'type',
+                                'height', 'marker_id', 'bin', 'size' ),
+                        Index( 'ix_alleles_marker_type_size', 'marker_id', 'type', 'size' )
+                    )
+
 
     @property
     def channel(self):
         return self.alleleset.channel
 
 
+_peak_dtype = peak_dtype( Allele.__table__ )
+AlleleSet.peak_dtype = _peak_dtype
+_peak_defaults = peak_defaults( Allele.__table__ )
+
+
+def changed_allelesets(session):
+    """ return the allelesets of session whose packed peaks have been modified;
+        the set keeps them referenced until repacked, as the session drops its
+        references to allelesets once they are autoflushed
+    """
+    return session.info.setdefault('changed_allelesets', set())
+
+
+def repack_allelesets(session):
+    """ repack the modified allelesets of session; needs to be called before the
+        session is flushed, otherwise changes of packed peaks are not written
+    """
+    allelesets = session.info.pop('changed_allelesets', None)
+    if not allelesets:
+        return
+    for alleleset in list(allelesets):
+        if object_session(alleleset) is session:
+            alleleset.repack()
+
+
+# foreign key leading from each class holding allele data towards its batch
+_batch_keys = [ ( Allele, 'alleleset_ids', 'alleleset_id' ),
+                ( AlleleSet, 'sample_ids', 'sample_id' ),
+                ( Channel, 'assay_ids', 'assay_id' ),
+                ( Assay, 'sample_ids', 'sample_id' ),
+                ( Sample, 'batch_ids', 'batch_id' ),
+                ( Batch, 'batch_ids', 'id' ) ]
+
+
+@event.listens_for(Session, 'after_flush')
+def touch_modified_batches(session, flush_context):
+    """ increase the stamps of the batches whose allele data have been flushed;
+        the batches are found from the loaded foreign keys of the instances,
+        without loading any relationship
+    """
+    if not Batch.stamped:
+        return
+    keys = dict( batch_ids = set(), sample_ids = set(), assay_ids = set(),
+                alleleset_ids = set() )
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        for (class_, name, column) in _batch_keys:
+            if isinstance(instance, class_):
+                value = instance.__dict__.get(column)
+                if value is None:
+                    # unknown batch
+                    touch_batches( session, all_batches = True )
+                    return
+                keys[name].add( value )
+                break
+    touch_batches( session, **keys )
+
+
+@event.listens_for(AlleleSet, 'refresh')
+@event.listens_for(AlleleSet, 'expire')
+def allelesets_reloaded(target, *args):
+    if target is None:
+        return
+    session = object_session(target)
+    if session is None or target not in session.info.get('changed_allelesets', ()):
+        target.__dict__.pop('_packed', None)
+
+
+def has_batch_stamps(engine):
+    """ check whether batches table has the column for modification stamps """
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    if 'batches' not in inspector.get_table_names():
+        return False
+    return 'stamp' in [ c['name'] for c in inspector.get_columns('batches') ]
+
+
+def has_packed_storage(engine):
+    """ check whether allelesets table has the column for packed peaks """
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    if 'allelesets' not in inspector.get_table_names():
+        return False
+    return 'peaks' in [ c['name'] for c in inspector.get_columns('allelesets') ]
+
+
 
 def engine_from_file( dbfilename, bind=True ):
     """ return (engine, session) """
@@ -0,0 +1,69 @@
+# stamps.py
+# modification stamps of batches, stored in batches.stamp and used to invalidate
+# cached results; the stamp of a batch is increased by each flush or bulk write
+# that modifies the allele data of the batch, so that changes committed by other
+# processes are seen as well
+
+from sqlalchemy import select, union
+
+from zope.sqlalchemy import mark_changed
+
+
+def _tables():
+    from fatools.lib.sqlmodels.schema import Base
+    return Base.metadata.tables
+
+
+def touch_batch(session, batch_id=None):
+    """ mark batch as modified; if batch_id is None, all batches are marked """
+    if batch_id is None:
+        touch_batches(session, all_batches=True)
+    else:
+        touch_batches(session, batch_ids=[ batch_id ])
+
+
+def touch_batches(session, batch_ids=(), sample_ids=(), assay_ids=(), alleleset_ids=(),
+            all_batches=False):
+    """ mark as modified the batches of batch_ids, and the batches holding
+        sample_ids, assay_ids and alleleset_ids
+    """
+    from fatools.lib.sqlmodels.schema import Batch
+    if not Batch.stamped:
+        return
+
+    t = _tables()
+    batches = t['batches']
+    if all_batches:
+        stmt = batches.update()
+    else:
+        selects = []
+        if batch_ids:
+            selects.append( select( [ batches.c.id ] ).where(
+                        batches.c.id.in_( list(batch_ids) ) ) )
+        for (table, ids) in [ ( t['samples'], sample_ids ), ( t['assays'], assay_ids ),
+                                ( t['allelesets'], alleleset_ids ) ]:
+            if not ids:
+                continue
+            q = select( [ t['samples'].c.batch_id ] )
+            if table is not t['samples']:
+                q = q.select_from( table.join( t['samples'],
+                            table.c.sample_id == t['samples'].c.id ) )
+            selects.append( q.where( table.c.id.in_( list(ids) ) ) )
+        if not selects:
+            return
+        ids = selects[0] if len(selects) == 1 else union( *selects )
+        stmt = batches.update().where( batches.c.id.in_( ids ) )
+
+    session.execute( stmt.values( stamp = batches.c.stamp + 1 ) )
+    mark_changed( session )
+
+
+def get_stamps(session, batch_ids):
+    """ return dict of batch_id: stamp of the batches, or None if the database
+        does not store stamps; pending changes of session are flushed first
+    """
+    from fatools.lib.sqlmodels.schema import Batch
+    if not Batch.stamped:
+        return None
+    q = session.query( Batch.id, Batch.stamp ).filter( Batch.id.in_( list(batch_ids) ) )
+    return dict( q )
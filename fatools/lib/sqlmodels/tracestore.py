@@ -0,0 +1,260 @@
+# tracestore.py
+# append-only, content-addressed store of trace blobs, kept next to the database
+#
+# blobs are appended to chunk files, and located by their hash through an
+# append-only index of fixed-size records; the database column holds only the
+# reference, ie. magic + hash; blobs are read through memory maps of the
+# chunk files
+#
+# several processes may share the store: writers hold an exclusive lock on the
+# index while appending, and readers pick up the records appended by others by
+# reading the tail of the index
+#
+# the store is attached to the dialect of the engine of its database (see
+# set_store()), as the column types only get the dialect when processing values
+
+import os, struct, mmap, hashlib, shutil
+from contextlib import contextmanager
+
+
+MAGIC = b'FTR1'
+_DIGEST_SIZE = 20
+REF_SIZE = len(MAGIC) + _DIGEST_SIZE
+_RECORD = struct.Struct('<%dsIQQ' % _DIGEST_SIZE)     # digest, chunk, offset, length
+
+
+@contextmanager
+def _locked(f):
+    """ hold exclusive lock on file f; on Windows, the first byte is locked """
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield f
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        yield f
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class TraceStore(object):
+    """ store directory holds chunk-NNNNN.dat files, index.dat, and an ENABLED
+        file if new blobs are to be written into the store
+    """
+
+    chunk_size = 1 << 30
+    """ chunk files are not extended beyond this size """
+
+    min_size = 256
+    """ smaller blobs are kept in the database """
+
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}             # digest -> (chunk, offset, length)
+        self.last_chunk = 0
+        self._maps = {}             # chunk -> mmap
+        self._files = {}            # chunk -> file opened for appending
+        self._index_file = None
+        self._index_pos = 0         # size of index.dat already read
+        self.writable = os.path.exists( os.path.join(self.path, 'ENABLED') )
+        self._load_index()
+
+
+    @staticmethod
+    def path_for(dbfile):
+        return dbfile + '.traces'
+
+
+    def enable(self):
+        """ write new blobs into this store """
+        open( os.path.join(self.path, 'ENABLED'), 'w' ).close()
+        self.writable = True
+
+
+    def disable(self):
+        """ keep new blobs in the database; stored blobs are still readable """
+        if self.writable:
+            os.unlink( os.path.join(self.path, 'ENABLED') )
+        self.writable = False
+
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.path, 'chunk-%05d.dat' % chunk)
+
+
+    def _load_index(self):
+        """ read the index records appended since the last call """
+        index_path = os.path.join(self.path, 'index.dat')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'rb') as f:
+            f.seek(self._index_pos)
+            data = f.read()
+        data = data[: len(data) - len(data) % _RECORD.size]
+        self._index_pos += len(data)
+
+        sizes = {}
+        for (digest, chunk, offset, length) in _RECORD.iter_unpack(data):
+            if chunk not in sizes:
+                path = self._chunk_path(chunk)
+                sizes[chunk] = os.path.getsize(path) if os.path.exists(path) else 0
+            if offset + length > sizes[chunk]:
+                # blob was not completely written
+                continue
+            self.index[digest] = (chunk, offset, length)
+            self.last_chunk = max(self.last_chunk, chunk)
+
+
+    def put(self, blob):
+        """ append blob, unless already stored, and return its reference """
+
+        digest = hashlib.blake2b(blob, digest_size=_DIGEST_SIZE).digest()
+        if digest in self.index:
+            return MAGIC + digest
+
+        if self._index_file is None:
+            self._index_file = open( os.path.join(self.path, 'index.dat'), 'ab' )
+
+        # other processes may append to the same chunk and index meanwhile
+        with _locked(self._index_file):
+            self._load_index()
+            if digest in self.index:
+                return MAGIC + digest
+
+            chunk = self.last_chunk
+            f = self._append_file(chunk)
+            offset = f.seek(0, os.SEEK_END)
+            if offset > 0 and offset + len(blob) > self.chunk_size:
+                chunk += 1
+                f = self._append_file(chunk)
+                offset = f.seek(0, os.SEEK_END)
+
+            # blob first, so that index records always point to complete blobs
+            f.write(blob)
+            f.flush()
+            self._index_file.write( _RECORD.pack(digest, chunk, offset, len(blob)) )
+            self._index_file.flush()
+
+        self.index[digest] = (chunk, offset, len(blob))
+        self.last_chunk = chunk
+        return MAGIC + digest
+
+
+    def _append_file(self, chunk):
+        f = self._files.get(chunk)
+        if f is None:
+            f = self._files[chunk] = open(self._chunk_path(chunk), 'ab')
+        return f
+
+
+    def get(self, ref):
+        """ return read-only memoryview of the blob of ref """
+
+        digest = bytes(ref[len(MAGIC):])
+        if digest not in self.index:
+            # the blob may have been stored by another process since
+            self._load_index()
+        try:
+            chunk, offset, length = self.index[digest]
+        except KeyError:
+            raise RuntimeError('E: trace %s not found in store %s'
+                        % (digest.hex(), self.path))
+
+        m = self._maps.get(chunk)
+        if m is None or len(m) < offset + length:
+            # map again, as the chunk has grown since
+            with open(self._chunk_path(chunk), 'rb') as f:
+                m = self._maps[chunk] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(m)[offset:offset + length]
+
+
+    def usage(self, refs):
+        """ return ( bytes of blobs referenced by refs, bytes of orphaned blobs ),
+            where refs are all the references held by the database
+        """
+        self._load_index()
+        digests = set( bytes(ref[len(MAGIC):]) for ref in refs )
+        used = orphaned = 0
+        for (digest, (chunk, offset, length)) in self.index.items():
+            if digest in digests:
+                used += length
+            else:
+                orphaned += length
+        return used, orphaned
+
+
+    def compact(self, refs):
+        """ rewrite the store with only the blobs referenced by refs, where refs
+            are all the references held by the database; no other process may
+            use the store meanwhile
+        """
+        self._load_index()
+        digests = set( bytes(ref[len(MAGIC):]) for ref in refs )
+
+        new_path = self.path + '.compact'
+        if os.path.exists(new_path):
+            shutil.rmtree(new_path)
+        os.mkdir(new_path)
+        store = TraceStore(new_path)
+        for digest in sorted( digests & set(self.index), key = lambda d: self.index[d] ):
+            store.put( bytes( self.get(MAGIC + digest) ) )
+        store.close()
+        if self.writable:
+            store.enable()
+
+        self.close()
+        self._maps = {}
+        old_path = self.path + '.old'
+        os.rename(self.path, old_path)
+        os.rename(new_path, self.path)
+        shutil.rmtree(old_path)
+        self.__init__(self.path)
+
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+
+def set_store(engine, store):
+    """ set the store used by the trace columns of the database of engine """
+    engine.dialect.trace_store = store
+
+
+def get_store(dialect):
+    """ return the store of the engine of dialect, or None """
+    return getattr(dialect, 'trace_store', None)
+
+
+def is_ref(value):
+    return value is not None and len(value) == REF_SIZE and value[:len(MAGIC)] == MAGIC
+
+
+def load_blob(value, store):
+    """ return blob of value, which is either the blob itself or its reference """
+    if not is_ref(value):
+        return value
+    if store is None:
+        raise RuntimeError('E: database refers to external traces, but the trace store '
+                    'is not opened')
+    return store.get(value)
+
+
+def store_blob(blob, store):
+    """ return reference of blob if store is writable, otherwise blob """
+    if store is None or len(blob) < store.min_size or not store.writable:
+        return blob
+    return store.put(blob)
@@ -74,6 +74,11 @@ def init_argparser(parser=None):
     p.add_argument('-m', '--markers', default='',
             help = 'markers')
 
+    p.add_argument('--allelecache', default=0, type=int,
+            help = 'number of allele queries kept in memory, invalidated when their '
+                    'batches are modified; needs dbmgr --migrate-batchstamps for older '
+                    'database')
+
 
     return p
 
@@ -94,6 +99,10 @@ def do_analyze(args, dbhandler_func = get_dbhandler):
 
     elif dbh is None:
         dbh = dbhandler_func( args )
+        dbh.allele_cache_size = args.allelecache
+        if args.allelecache and not dbh.Batch.stamped:
+            cerr('W: --allelecache is ignored, database has no modification stamps of '
+                    'batches (upgrade with dbmgr --migrate-batchstamps)')
 
 
     if args.samplesummary:
@@ -22,7 +22,8 @@ def init_argparser(parser=None):
 
     p.add_argument('--outfile')
 
-    p.add_argument('--marker')
+    p.add_argument('--marker',
+        help = 'marker code, or comma-separated marker codes')
 
     p.add_argument('--commit', default=False, action='store_true',
         help = 'commit to database')
@@ -38,6 +39,9 @@ def init_argparser(parser=None):
     p.add_argument('--optimize', default=False, action='store_true',
         help = 'optimize bins for a particular marker / batch')
 
+    p.add_argument('--build', default=False, action='store_true',
+        help = 'build empirical bins from allele sizes in infile or database')
+
     p.add_argument('--summarize', default=False, action='store_true',
         help = 'summarize data frame')
 
@@ -51,6 +55,12 @@ def init_argparser(parser=None):
 
     p.add_argument('--shift', type=float, default=0)
 
+    p.add_argument('--tolerance', type=float, default=1e-3,
+        help = 'stop optimizing when no bin moves more than this (bp)')
+
+    p.add_argument('--jobs', type=int, default=1,
+        help = 'number of markers to optimize in parallel')
+
 
 
     return p
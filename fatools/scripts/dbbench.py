@@ -0,0 +1,277 @@
+
+import sys, argparse, os, time, tempfile, datetime
+import numpy as np
+
+from fatools.lib.utils import cout, cerr, cexit
+from fatools.lib.const import peaktype, binningmethod
+
+
+def init_argparser( parser=None ):
+
+    if parser is None:
+        p = argparse.ArgumentParser( 'dbbench' )
+    else:
+        p = parser
+
+    ## commands
+
+    p.add_argument('--alleles', default=False, action='store_true',
+        help = 'benchmark allele persistence, ORM vs bulk insert')
+
+    p.add_argument('--indexes', default=False, action='store_true',
+        help = 'benchmark allele query and show its query plan, before and after '
+                'index migration')
+
+    ## options
+
+    p.add_argument('--sqldb', default=False,
+        help = 'SQLite3 database file to be created (default: temporary file)')
+
+    p.add_argument('--channels', default=500, type=int,
+        help = 'number of channels')
+
+    p.add_argument('--peaks', default=100, type=int,
+        help = 'number of peaks per channel')
+
+    p.add_argument('--samples', default=100, type=int,
+        help = 'number of samples for --indexes')
+
+    return p
+
+
+def main(args):
+
+    if args.alleles:
+        do_alleles(args)
+    elif args.indexes:
+        do_indexes(args)
+    else:
+        cexit('E: unknown command, nothing to do!')
+
+
+def _dummy_values(table, **values):
+    """ fill required columns of table with dummy values """
+    from sqlalchemy import types
+    from fatools.lib.sqlmodels.schema import NPArray, YAMLCol, TraceBlob
+
+    for c in table.columns:
+        if c.name in values or c.primary_key or c.nullable or c.default is not None:
+            continue
+        if isinstance(c.type, NPArray):
+            values[c.name] = np.zeros(1)
+        elif isinstance(c.type, YAMLCol):
+            values[c.name] = ''
+        elif isinstance(c.type, types.DateTime):
+            values[c.name] = datetime.datetime.now()
+        elif isinstance(c.type, types.Integer):
+            values[c.name] = 0
+        elif isinstance(c.type, types.Float):
+            values[c.name] = 0.0
+        elif isinstance(c.type, types.Boolean):
+            values[c.name] = False
+        elif isinstance(c.type, (types.LargeBinary, types._Binary, TraceBlob)):
+            values[c.name] = b''
+        else:
+            values[c.name] = 'x'
+    return values
+
+
+def prepare_db(dbfile, n_channels, n_samples=1):
+    """ create database with one batch, n_samples samples with one assay each,
+        and n_channels channels distributed over the assays
+    """
+
+    from fatools.lib.sqlmodels import schema
+
+    engine, session = schema.engine_from_file(dbfile)
+    schema.Base.metadata.create_all(engine)
+    conn = engine.connect()
+    for (cls, values) in [  (schema.Batch, dict(id=1, code='bench')),
+                            (schema.Marker, dict(id=1, code='bench', species='x')),
+                            (schema.Panel, dict(id=1, code='bench')) ]:
+        conn.execute( cls.__table__.insert(), [ _dummy_values(cls.__table__, **values) ] )
+    for (cls, values) in [  (schema.Sample, lambda i: dict(id=i, code='bench%d' % i,
+                                    batch_id=1)),
+                            (schema.Assay, lambda i: dict(id=i, filename='bench', sample_id=i,
+                                    panel_id=1)) ]:
+        conn.execute( cls.__table__.insert(), [ _dummy_values(cls.__table__, **values(i))
+                        for i in range(1, n_samples + 1) ] )
+    t = schema.Channel.__table__
+    conn.execute( t.insert(), [ _dummy_values(t, id=i, assay_id=(i - 1) % n_samples + 1,
+                        marker_id=1, dye='x', raw_data=np.zeros(1, dtype=int),
+                        data=np.zeros(1))
+                    for i in range(1, n_channels + 1) ] )
+    conn.close()
+    return engine, session
+
+
+def synthetic_peaks(n, rng):
+    rtimes = np.sort( rng.randint(1000, 10000, n) )
+    return [ ( int(r), float(h), float(h * 8), int(r - 4), int(r + 4), 0.0, 8.0, 10.0 )
+                for (r, h) in zip(rtimes, rng.uniform(50, 5000, n)) ]
+
+
+def bench_orm(session, channels, peaks):
+    from fatools.lib.sqlmodels.schema import AlleleSet
+
+    sess = session()
+    for (channel_id, channel_peaks) in zip(channels, peaks):
+        alleleset = AlleleSet( channel_id = channel_id, sample_id = 1, marker_id = 1,
+                    scanning_method = 'bench', calling_method = 'bench',
+                    binning_method = 'bench' )
+        sess.add(alleleset)
+        for ( rtime, height, area, brtime, ertime, srtime, beta, theta ) in channel_peaks:
+            allele = alleleset.new_allele( rtime = rtime, height = height, area = area,
+                        brtime = brtime, ertime = ertime, wrtime = ertime - brtime,
+                        srtime = srtime, beta = beta, theta = theta,
+                        type = peaktype.scanned, method = binningmethod.notavailable )
+            allele.marker_id = 1
+    sess.flush()
+
+
+def bench_bulk(session, channels, peaks):
+    from fatools.lib.sqlmodels.schema import AlleleSet, Allele, Marker
+    from fatools.lib.sqlmodels.bulk import AlleleWriter
+
+    sess = session()
+    marker = sess.query(Marker).get(1)
+    writer = AlleleWriter(sess, Allele)
+    for (channel_id, channel_peaks) in zip(channels, peaks):
+        alleleset = AlleleSet( channel_id = channel_id, sample_id = 1, marker_id = 1,
+                    scanning_method = 'bench', calling_method = 'bench',
+                    binning_method = 'bench' )
+        sess.add(alleleset)
+        writer.add_peaks(alleleset, marker, channel_peaks)
+    writer.close()
+
+
+def do_alleles(args):
+
+    import transaction
+
+    if args.sqldb:
+        if os.path.exists(args.sqldb):
+            cexit('E: database file %s already exists' % args.sqldb)
+        dbfile = args.sqldb
+    else:
+        fd, dbfile = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        os.unlink(dbfile)
+
+    cerr('I: preparing %s with %d channel(s)' % (dbfile, args.channels))
+    engine, session = prepare_db(dbfile, args.channels)
+
+    rng = np.random.RandomState(0)
+    channels = list(range(1, args.channels + 1))
+    peaks = [ synthetic_peaks(args.peaks, rng) for c in channels ]
+    total = args.channels * args.peaks
+
+    results = []
+    for (label, func) in [ ('ORM', bench_orm), ('bulk', bench_bulk) ]:
+        start = time.perf_counter()
+        with transaction.manager:
+            func(session, channels, peaks)
+        elapsed = time.perf_counter() - start
+        results.append( (label, elapsed) )
+        session.remove()
+
+    stored = engine.execute('select count(*) from alleles').scalar()
+    if stored != 2 * total:
+        cerr('W: expecting %d stored alleles, found %d' % (2 * total, stored))
+
+    cout('alleles: %d (%d channels x %d peaks)' % (total, args.channels, args.peaks))
+    for (label, elapsed) in results:
+        cout('%-6s %8.2f s  %10.0f alleles/s' % (label, elapsed, total / elapsed))
+
+    if not args.sqldb:
+        os.unlink(dbfile)
+
+
+def fill_alleles(engine, n_channels, n_samples, n_peaks, rng):
+    """ insert one alleleset per channel, with every 5th peak as binned allele """
+
+    from fatools.lib.sqlmodels import schema
+
+    conn = engine.connect()
+    t = schema.AlleleSet.__table__
+    conn.execute( t.insert(), [ _dummy_values(t, id=i, channel_id=i, marker_id=1,
+                        sample_id=(i - 1) % n_samples + 1)
+                    for i in range(1, n_channels + 1) ] )
+
+    t = schema.Allele.__table__
+    for channel_id in range(1, n_channels + 1):
+        conn.execute( t.insert(), [
+                dict( alleleset_id = channel_id, marker_id = 1, rtime = rtime,
+                    height = height, area = area, brtime = brtime, ertime = ertime,
+                    size = rtime / 50, bin = int(rtime / 50),
+                    type = peaktype.bin if i % 5 == 0 else peaktype.noise,
+                    method = binningmethod.notavailable )
+                for (i, (rtime, height, area, brtime, ertime, srtime, beta, theta))
+                    in enumerate(synthetic_peaks(n_peaks, rng)) ] )
+    conn.close()
+
+
+def query_plan(engine, q):
+    """ return the detail lines of SQLite query plan of query q """
+    sql = str( q.statement.compile( engine, compile_kwargs = {'literal_binds': True} ) )
+    return [ row[-1] for row in engine.execute('EXPLAIN QUERY PLAN ' + sql) ]
+
+
+def bench_query(dbh, sample_ids, params, repeats=5):
+    """ return ( best time of repeats, number of rows, query plan ) of allele query """
+
+    q = dbh.get_allele_query( sample_ids, [ 1 ], params )
+    elapsed = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        rows = q.all()
+        elapsed.append( time.perf_counter() - start )
+    return min(elapsed), len(rows), query_plan(dbh.engine, q)
+
+
+def do_indexes(args):
+
+    from fatools.lib.sqlmodels import schema
+    from fatools.lib.sqlmodels.handler import SQLHandler
+    from fatools.lib.analytics.selector import Filter
+
+    fd, dbfile = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    os.unlink(dbfile)
+
+    n_channels = max(args.channels, args.samples)
+    cerr('I: preparing %s with %d sample(s), %d channel(s)'
+                % (dbfile, args.samples, n_channels))
+    engine, session = prepare_db(dbfile, n_channels, args.samples)
+
+    # emulate older database, without any of the declared indexes
+    for table in schema.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute('DROP INDEX %s' % index.name)
+
+    rng = np.random.RandomState(0)
+    fill_alleles(engine, n_channels, args.samples, args.peaks, rng)
+    dbh = SQLHandler(dbfile)
+
+    # a typical analysis selects a subset of samples
+    sample_ids = sorted( rng.choice( np.arange(1, args.samples + 1),
+                    max(1, args.samples // 20), replace=False ).tolist() )
+    params = Filter()
+
+    results = []
+    for label in ('before', 'after'):
+        if label == 'after':
+            dbh.migrate_indexes()
+        results.append( (label, ) + bench_query(dbh, sample_ids, params) )
+
+    cout('alleles: %d, querying %d of %d samples'
+                % (n_channels * args.peaks, len(sample_ids), args.samples))
+    for (label, elapsed, n_rows, plan) in results:
+        cout('%-6s %8.4f s  %d rows' % (label, elapsed, n_rows))
+        for line in plan:
+            cout('       %s' % line)
+
+    if not any( 'ix_alleles_alleleset_type_height' in line for line in results[-1][3] ):
+        cerr('W: allele query does not use the covering index')
+
+    os.unlink(dbfile)
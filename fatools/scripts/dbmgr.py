@@ -90,12 +90,42 @@ def init_argparser( parser=None ):
     p.add_argument('--viewpeakcachedb', default=False, action='store_true',
             help = 'view/summarize content of peakcachedb')
 
+    p.add_argument('--prunepeakcachedb', default=False, action='store_true',
+            help = 'remove peaks of previous peak finder versions from peakcachedb '
+                    '(and older than --maxage days)')
+
     p.add_argument('--reassignmarker', default=False, action='store_true',
             help = 'reassign marker (using dye)')
 
     p.add_argument('--dumppeaks', default=False, action='store_true',
             help = 'dump peaks to YAML file')
 
+    p.add_argument('--recodetraces', default=False, action='store_true',
+            help = 're-encode channel traces with compact codec (use with --compress)')
+
+    p.add_argument('--movetraces', default=False, choices=['store', 'db'],
+            help = 'move traces into the trace store next to the database, or back into '
+                    'the database')
+
+    p.add_argument('--compacttraces', default=False, action='store_true',
+            help = 'remove traces that are no longer referenced by the database from the '
+                    'trace store; no other process may use the database meanwhile')
+
+    p.add_argument('--migrate-indexes', dest='migrateindexes', default=False,
+            action='store_true',
+            help = 'create missing indexes in older database and analyze the tables')
+
+    p.add_argument('--migrate-packedpeaks', dest='migratepackedpeaks', default=False,
+            action='store_true',
+            help = 'add the column for packed peaks to older database')
+
+    p.add_argument('--migrate-batchstamps', dest='migratebatchstamps', default=False,
+            action='store_true',
+            help = 'add the column for modification stamps of batches to older database')
+
+    p.add_argument('--packpeaks', default=False, action='store_true',
+            help = 'store non-called peaks of batch(es) as packed peaks of their allelesets')
+
     ## options
 
     p.add_argument('--infile', default=False,
@@ -110,6 +140,9 @@ def init_argparser( parser=None ):
     p.add_argument('--commit', default=False, action='store_true',
             help = 'commit to database')
 
+    p.add_argument('--compress', default='',
+            help = 'compression for stored traces, eg. zlib:6 or lzma:1 (default none)')
+
     p.add_argument('-b', '--batch', default=False,
             help = 'batch code')
 
@@ -156,7 +189,10 @@ def init_argparser( parser=None ):
             help = 'abort for any warning')
 
     p.add_argument('--peakcachedb', default=None,
-            help = 'peakcache DB filename')
+            help = 'peak cache, either a SQLite file or a directory')
+
+    p.add_argument('--maxage', default=0, type=int,
+            help = 'maximum age in days of peak cache entries kept by --prunepeakcachedb')
 
     return p
 
@@ -184,6 +220,11 @@ def do_dbmgr(args, dbh = None, warning=True):
     if not dbh:
         dbh = get_dbhandler(args, initial = args.initdb)
 
+    if args.compress:
+        from fatools.lib.sqlmodels import npcodec
+        method, _, level = args.compress.partition(':')
+        npcodec.set_compression(method, int(level or 6))
+
     if args.uploadfsa is not False:
         do_uploadfsa(args, dbh)
     elif args.initbatch is not False:
@@ -224,8 +265,24 @@ def do_dbmgr(args, dbh = None, warning=True):
         do_renamefsa(args, dbh)
     elif args.viewpeakcachedb is not False:
         do_viewpeakcachedb(args, dbh)
+    elif args.prunepeakcachedb is not False:
+        do_prunepeakcachedb(args, dbh)
     elif args.dumppeaks is not False:
         do_dumppeaks(args, dbh)
+    elif args.recodetraces is not False:
+        do_recodetraces(args, dbh)
+    elif args.movetraces is not False:
+        do_movetraces(args, dbh)
+    elif args.compacttraces is not False:
+        do_compacttraces(args, dbh)
+    elif args.packpeaks is not False:
+        do_packpeaks(args, dbh)
+    elif args.migrateindexes is not False:
+        do_migrateindexes(args, dbh)
+    elif args.migratepackedpeaks is not False:
+        do_migratepackedpeaks(args, dbh)
+    elif args.migratebatchstamps is not False:
+        do_migratebatchstamps(args, dbh)
     else:
         if warning:
             cerr('Unknown command, nothing to do!')
@@ -695,22 +752,251 @@ def do_exportpeaks(args, dbh):
 
 
 
+def open_peakcache(args):
+
+    from fatools.lib.fautil.peakcache import PeakCache
+
+    if not args.peakcachedb:
+        cexit('E: please provide --peakcachedb')
+    if not os.path.exists(args.peakcachedb):
+        cexit('E: peak cache %s does not exist' % args.peakcachedb)
+    return PeakCache(args.peakcachedb)
+
+
 def do_viewpeakcachedb(args, dbh):
+    """ summarize peak cache by peak finder version, and by batch of the channels
+        whose traces have cached peaks
+    """
 
-    from leveldb import LevelDB
+    from fatools.lib.fautil import peakcache
+    from fatools.lib.fautil.algo import FIND_RAW_PEAKS_VERSION
+    from fatools.lib.sqlmodels import npcodec, tracestore
     from collections import defaultdict
 
-    ldb = LevelDB(args.peakcachedb, create_if_missing=False)
+    cache = open_peakcache(args)
+
+    versions = defaultdict(lambda: [0, 0])
+    traces = set()
+    for (key, size, created) in cache.entries():
+        (trace, fingerprint, version) = peakcache.split_key(key)
+        versions[version][0] += 1
+        versions[version][1] += size
+        if version == FIND_RAW_PEAKS_VERSION:
+            traces.add(trace)
+    cache.close()
+
+    cout('Peak cache: %s' % args.peakcachedb)
+    for version in sorted(versions):
+        cout('\tversion %d%s\t%6d entries\t%9d bytes' % (version,
+                ' (current)' if version == FIND_RAW_PEAKS_VERSION else '',
+                versions[version][0], versions[version][1]))
+
+    sess = dbh.session()
+    channel_batches = dict( sess.query( dbh.Channel.id, dbh.Batch.code )
+                .join( dbh.Assay, dbh.Channel.assay_id == dbh.Assay.id )
+                .join( dbh.Sample, dbh.Assay.sample_id == dbh.Sample.id )
+                .join( dbh.Batch, dbh.Sample.batch_id == dbh.Batch.id ) )
+
+    batches = defaultdict(lambda: [0, 0])
+    for rows in iter_trace_blobs( sess, dbh.Channel.__table__, ('data',) ):
+        for row in rows:
+            counts = batches[ channel_batches[row['id']] ]
+            counts[1] += 1
+            if row['data'] is not None:
+                data = npcodec.decode( tracestore.load_blob(row['data'], dbh.trace_store) )
+                if peakcache.trace_digest(data) in traces:
+                    counts[0] += 1
+
+    cout('Cached channels by batch:')
+    for batch_code in sorted(batches):
+        cout('\t%s\t%6d / %6d' % (batch_code, batches[batch_code][0], batches[batch_code][1]))
+
+
+def do_prunepeakcachedb(args, dbh):
+
+    from fatools.lib.fautil import peakcache
+    from fatools.lib.fautil.algo import FIND_RAW_PEAKS_VERSION
+    import time
+
+    cache = open_peakcache(args)
+    min_created = time.time() - args.maxage * 86400 if args.maxage > 0 else 0
+
+    keys = []
+    total = 0
+    for (key, size, created) in cache.entries():
+        total += 1
+        (trace, fingerprint, version) = peakcache.split_key(key)
+        if version != FIND_RAW_PEAKS_VERSION or created < min_created:
+            keys.append(key)
+    cache.delete(keys)
+    cache.close()
+
+    cerr('I: removed %d of %d peak cache entries' % (len(keys), total))
+
+
+def iter_trace_blobs(sess, table, names, chunk=500):
+    """ yield lists of rows of id and trace blobs of table, in chunks of ids;
+        blobs are read as plain binary, bypassing the column type processing
+    """
+
+    from sqlalchemy import select, type_coerce, types
+
+    q = select( [ table.c.id ] + [ type_coerce(table.c[name], types.LargeBinary).label(name)
+                    for name in names ] )
+    last_id = 0
+    while True:
+        rows = sess.execute( q.where( table.c.id > last_id ).order_by( table.c.id ).limit(chunk)
+                    ).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def update_trace_blobs(sess, table, names, params):
+    """ write blobs of params, ie. dicts of _id and _<name>, as plain binary """
+
+    from sqlalchemy import bindparam, types
+    from fatools.lib.sqlmodels.bulk import execute_many
+
+    stmt = table.update().where( table.c.id == bindparam('_id') ).values(
+                **{ name: bindparam('_' + name, type_=types.LargeBinary) for name in names } )
+    execute_many( sess, stmt, params )
+
+
+def do_recodetraces(args, dbh, chunk=500):
+    """ re-encode raw_data & data of all channels, in chunks of channel ids """
+
+    from fatools.lib.sqlmodels import npcodec, tracestore
+
+    t = dbh.Channel.__table__
+    names = ('raw_data', 'data')
+    rtols = { name: t.c[name].type.rtol for name in names }
+    sess = dbh.session()
+
+    before = after = count = 0
+    for rows in iter_trace_blobs( sess, t, names, chunk ):
+        params = []
+        for row in rows:
+            values = { '_id': row['id'] }
+            for name in names:
+                blob = tracestore.load_blob(row[name], dbh.trace_store)
+                recoded = npcodec.encode( npcodec.decode(blob), rtols[name] )
+                values['_' + name] = tracestore.store_blob(recoded, dbh.trace_store)
+                before += len(blob)
+                after += len(recoded)
+            params.append( values )
+
+        update_trace_blobs( sess, t, names, params )
+        count += len(rows)
+        cerr('I: recoded %d channel(s)' % count)
+
+    cerr('I: trace storage %5.1f MB => %5.1f MB' % (before / 1e6, after / 1e6))
+    cerr('I: run VACUUM on the database file to reclaim the free space')
+    if dbh.trace_store is not None:
+        report_trace_store(dbh)
+
+
+def do_movetraces(args, dbh, chunk=500):
+    """ move raw_data & data of channels and raw_data of assays into the trace
+        store (args.movetraces == 'store') or back into the database ('db')
+    """
+
+    from fatools.lib.sqlmodels import tracestore
+
+    if args.movetraces == 'store':
+        store = dbh.open_trace_store(create=True)
+        store.enable()
+    else:
+        store = dbh.trace_store
+        if store is None:
+            cexit('E: database does not have a trace store')
+
+    sess = dbh.session()
+    for (cls, names) in trace_columns(dbh):
+        t = cls.__table__
+        moved = count = 0
+        for rows in iter_trace_blobs( sess, t, names, chunk ):
+            params = []
+            for row in rows:
+                values = { '_id': row['id'] }
+                for name in names:
+                    blob = tracestore.load_blob(row[name], store)
+                    if args.movetraces == 'store':
+                        values['_' + name] = tracestore.store_blob(blob, store)
+                    else:
+                        values['_' + name] = bytes(blob)
+                    if tracestore.is_ref(values['_' + name]) != tracestore.is_ref(row[name]):
+                        moved += 1
+                params.append( values )
+
+            update_trace_blobs( sess, t, names, params )
+            count += len(rows)
+        cerr('I: %s - moved %d trace(s) of %d row(s)' % (t.name, moved, count))
+
+    if args.movetraces == 'store':
+        report_trace_store(dbh)
+        store.close()
+        cerr('I: run VACUUM on the database file to reclaim the free space')
+    else:
+        store.disable()
+        cerr('I: once committed, the trace store at %s can be removed' % store.path)
+
+
+def do_compacttraces(args, dbh):
+    """ remove the traces of the trace store that are not referenced by the database """
+
+    store = dbh.trace_store
+    if store is None:
+        cexit('E: database does not have a trace store')
 
-    batches = defaultdict(int)
+    refs = set( iter_trace_refs( dbh.session(), dbh ) )
+    used, orphaned = store.usage(refs)
+    if not orphaned:
+        cerr('I: trace store has no orphaned traces')
+        return
+    if not args.commit:
+        cerr('I: %5.1f MB of orphaned traces would be removed, run with --commit'
+                % (orphaned / 1e6))
+        return
 
-    for key in ldb.RangeIter(include_value=False):
-        batch_code = bytes(key.split(b'|', 1)[0])
-        batches[batch_code] += 1
+    store.compact(refs)
+    cerr('I: removed %5.1f MB of orphaned traces, %5.1f MB of traces kept'
+            % (orphaned / 1e6, used / 1e6))
 
-    cout('Peakcache DB: %s' % args.peakcachedb)
-    for (k,v) in batches.items():
-        cout('\t%s\t%4d' % (k.decode(),v))
+
+def trace_columns(dbh):
+    """ return list of (class, column names) of the traces that can be kept in the
+        trace store
+    """
+    return [ (dbh.Channel, ('raw_data', 'data')), (dbh.Assay, ('raw_data',)) ]
+
+
+def iter_trace_refs(sess, dbh):
+    """ yield the trace store references held by the database """
+
+    from sqlalchemy import select, func, type_coerce, types
+    from fatools.lib.sqlmodels import tracestore
+
+    for (cls, names) in trace_columns(dbh):
+        t = cls.__table__
+        for name in names:
+            # blobs kept in the database are not read
+            q = select( [ type_coerce(t.c[name], types.LargeBinary) ] ).where(
+                        func.length( t.c[name] ) == tracestore.REF_SIZE )
+            for (value,) in sess.execute(q):
+                if tracestore.is_ref(value):
+                    yield value
+
+
+def report_trace_store(dbh):
+    """ report the size of referenced and orphaned traces of the trace store """
+
+    used, orphaned = dbh.trace_store.usage( iter_trace_refs( dbh.session(), dbh ) )
+    cerr('I: trace store holds %5.1f MB of traces and %5.1f MB of orphaned traces'
+            % (used / 1e6, orphaned / 1e6))
+    if orphaned:
+        cerr('I: once committed, run --compacttraces to remove the orphaned traces')
 
 
 def do_showsample(args, dbh):
@@ -749,7 +1035,7 @@ def do_dumppeaks(args, dbh):
 
         for c in assay.channels:
 
-            alleles = list(c.get_latest_alleleset().alleles)
+            alleles = list(c.get_latest_alleleset().all_alleles)
 
             assay_data[c.dye] = [ [p.rtime, p.height, p.qscore, p.size]
                                 for p in alleles ]
@@ -788,15 +1074,48 @@ def get_assay_list( args, dbh ):
     if args.panel:
         panels = args.panel.split(',')
 
-    assay_list = []
-    for sample in batch.samples:
-        if samples and sample.code not in samples: continue
-        for assay in sample.assays:
-            if assays and assay.filename not in assays: continue
-            if fsaids and assay.id not in fsaids: continue
-            if panels and assay.panel.code not in panels: continue
-            assay_list.append( (assay, sample.code) )
+    assay_list = dbh.get_assay_list( batch, sample_codes = samples, filenames = assays,
+                    assay_ids = fsaids, panel_codes = panels )
 
     cerr('INFO - number of assays to be processed: %d' % len(assay_list))
     return assay_list
 
+
+def do_packpeaks(args, dbh):
+    """ pack the stored peaks of the batches, or of all batches """
+
+    if args.batch:
+        batches = [ dbh.get_batch(code) for code in args.batch.split(',') ]
+    else:
+        batches = list( dbh.get_batches() )
+
+    if not dbh.AlleleSet.packed_storage:
+        cexit('E: database has no column for packed peaks, run --migrate-packedpeaks first')
+
+    for batch in batches:
+        n_allelesets, n_alleles = dbh.pack_batch_peaks(batch)
+        cerr('I: batch %s - packed %d allele(s) of %d alleleset(s)'
+                % (batch.code, n_alleles, n_allelesets))
+    cerr('I: run VACUUM on the database to reclaim the freed space')
+
+
+def do_migrateindexes(args, dbh):
+
+    created = dbh.migrate_indexes()
+    cerr('I: %d index(es) created, tables have been analyzed' % len(created))
+
+
+def do_migratepackedpeaks(args, dbh):
+
+    if dbh.upgrade_packed_storage():
+        cerr('I: allelesets table has been upgraded for packed peaks')
+    else:
+        cerr('I: allelesets table already has the column for packed peaks')
+
+
+def do_migratebatchstamps(args, dbh):
+
+    if dbh.upgrade_batch_stamps():
+        cerr('I: batches table has been upgraded for modification stamps')
+    else:
+        cerr('I: batches table already has the column for modification stamps')
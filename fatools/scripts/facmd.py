@@ -1,7 +1,7 @@
 
 
 import sys, argparse, yaml, csv, transaction
-from fatools.lib.utils import cout, cerr, get_dbhandler, set_verbosity
+from fatools.lib.utils import cout, cerr, cexit, get_dbhandler, set_verbosity
 from fatools.lib import params
 from fatools.lib.const import assaystatus, peaktype
 from fatools.lib.fautil import algo
@@ -38,6 +38,9 @@ def init_argparser(parser=None):
     p.add_argument('--bin', default=False, action='store_true',
             help = 'binning peaks')
 
+    p.add_argument('--rebin', default=False, action='store_true',
+            help = 're-bin stored peaks of a batch in bulk, eg. after updating bins')
+
     p.add_argument('--postannotate', default=False, action='store_true',
             help = 'post annotate peaks')
 
@@ -82,7 +85,25 @@ def init_argparser(parser=None):
             help = 'output filename')
 
     p.add_argument('--peakcachedb', default=False,
-            help = 'peak cache db filename')
+            help = 'peak cache, either a SQLite file or a directory (existing, or with '
+                    'trailing /)')
+
+    p.add_argument('--bulk', default=False, action='store_true',
+            help = 'write peaks in bulk (--scan), or re-bin whole batch in bulk (--bin)')
+
+    p.add_argument('--packpeaks', default=False, action='store_true',
+            help = 'keep new peaks that are not called as packed peaks of their allelesets')
+
+    p.add_argument('--fused', default=False, action='store_true',
+            help = 'run all requested stages from scan to postannotate on each assay '
+                    'in a single pass')
+
+    p.add_argument('--jobs', default=1, type=int,
+            help = 'number of worker processes for scan, preannotate, alignladder, call, '
+                    'bin and postannotate (requires --commit)')
+
+    p.add_argument('--aligncache', default=False,
+            help = 'directory for caching ladder alignment results')
 
     p.add_argument('--method', default='',
             help = 'spesific method or algorithm to use')
@@ -151,6 +172,20 @@ def do_facmd(args, dbh=None):
     if args.verbose != 0:
         set_verbosity(args.verbose)
 
+    if args.packpeaks:
+        if not dbh.AlleleSet.packed_storage:
+            cexit('E: --packpeaks requires the column for packed peaks, upgrade the '
+                    'database with dbmgr --migrate-packedpeaks')
+        dbh.AlleleSet.pack_peaks = True
+
+    if args.jobs > 1:
+        if not args.commit:
+            cexit('E: --jobs requires --commit, as results are committed in batches')
+        from fatools.lib.sqlmodels.pipeline import ParallelPipeline
+        dbh.pipeline = ParallelPipeline( dbh, args.jobs, pack_peaks = args.packpeaks,
+                        aligncache = args.aligncache, peakcache = args.peakcachedb,
+                        verbosity = args.verbose )
+
     executed = 0
     if args.clear is not False:
         do_clear( args, dbh )
@@ -158,24 +193,30 @@ def do_facmd(args, dbh=None):
     if args.findpeaks is not False:
         do_findpeaks( args, dbh )
         executed += 1
-    if args.scan is not False:
-        do_scan(args, dbh)
-        executed += 1
-    if args.preannotate is not False:
-        do_preannotate(args, dbh)
-        executed += 1
-    if args.alignladder is not False:
-        do_alignladder(args, dbh)
-        executed += 1
-    if args.call is not False:
-        do_call(args, dbh)
-        executed += 1
-    if args.bin is not False:
-        do_bin(args, dbh)
-        executed += 1
-    if args.postannotate is not False:
-        do_postannotate(args, dbh)
-        executed += 1
+    if args.fused:
+        executed += do_fused(args, dbh)
+    else:
+        if args.scan is not False:
+            do_scan(args, dbh)
+            executed += 1
+        if args.preannotate is not False:
+            do_preannotate(args, dbh)
+            executed += 1
+        if args.alignladder is not False:
+            do_alignladder(args, dbh)
+            executed += 1
+        if args.call is not False:
+            do_call(args, dbh)
+            executed += 1
+        if args.bin is not False:
+            do_bin(args, dbh)
+            executed += 1
+        if args.rebin is not False:
+            do_rebin(args, dbh)
+            executed += 1
+        if args.postannotate is not False:
+            do_postannotate(args, dbh)
+            executed += 1
     if args.setallele is not False:
         do_setallele(args, dbh)
         executed += 1
@@ -199,6 +240,9 @@ def do_facmd(args, dbh=None):
     else:
         cerr('INFO - executed %d command(s)' % executed)
 
+    if args.jobs > 1:
+        dbh.pipeline.close()
+
 
 def do_clear( args, dbh ):
 
@@ -218,149 +262,241 @@ def do_scan( args, dbh ):
 
     cerr('I: Scanning peaks...')
 
-    scanning_parameter = params.Params()
+    kwargs = get_stage_kwargs( args, dbh, 'scan' )
     assay_list = get_assay_list( args, dbh )
 
-    if args.peakcachedb:
-        import leveldb
-        peakdb = leveldb.LevelDB(args.peakcachedb, create_if_missing=False)
+    if args.bulk:
+        from fatools.lib.sqlmodels.bulk import AlleleWriter
+        writer = AlleleWriter( dbh.session(), dbh.Allele )
     else:
-        peakdb = None
+        writer = None
 
-    if args.method:
-        scanning_parameter.ladder.method = args.method
-        scanning_parameter.nonladder.method = args.method
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'scan', 'Scanning', writer = writer, **kwargs ):
+        pass
 
-    counter = 1
-    for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Scanning: %s | %s' %
-                (counter, len(assay_list), sample_code, assay.filename))
+    if writer:
+        writer.close()
+        cerr('I: %d peak(s) written in bulk' % writer.total)
 
-        assay.scan( scanning_parameter, peakdb = peakdb )
-        counter += 1
+    if kwargs['peakdb']:
+        kwargs['peakdb'].close()
+        kwargs['peakdb'].report()
 
 
 def do_preannotate( args, dbh ):
 
     cerr('I: Preannotating peaks...')
 
-    scanning_parameter = params.Params()
+    kwargs = get_stage_kwargs( args, dbh, 'preannotate' )
     assay_list = get_assay_list( args, dbh )
 
-    counter = 1
-    for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Preannotating: %s | %s' %
-                (counter, len(assay_list), sample_code, assay.filename))
-
-        assay.preannotate( scanning_parameter )
-        counter += 1
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'preannotate', 'Preannotating', **kwargs ):
+        pass
 
 
 def do_alignladder( args, dbh ):
 
     cerr('Aligning ladders...')
 
+    if args.aligncache:
+        from fatools.lib.fautil import aligncache
+        cache = aligncache.set_cache(args.aligncache)
+    else:
+        cache = None
+
+    kwargs = get_stage_kwargs( args, dbh, 'alignladder' )
     assay_list = get_assay_list( args, dbh )
     counter = 1
-    for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Aligning: %s | %s' %
-                (counter, len(assay_list), sample_code, assay.filename))
-        (dpscore, rss, no_of_peaks, no_of_ladders, qcscore, remarks,
-            method) = assay.alignladder( args.excluded_peaks, force_mode = args.force )
-        if qcscore < 0.9:
-            msg = 'W! low ladder QC'
-        else:
-            msg = 'I:'
-        cerr( '%s [%d/%d] - Score %3.2f %4.2f %5.2f %d/%d %s for %s | %s'
-                % ( msg, counter, len(assay_list),
-                    qcscore, dpscore, rss, no_of_peaks, no_of_ladders,
-                    method, sample_code, assay.filename) )
-        if remarks:
-            cerr('%s - %s' % (msg, ' | '.join(remarks)))
-        if qcscore != 1.0 and args.abort:
-            sys.exit(1)
-
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'alignladder', 'Aligning', **kwargs ):
+        report_alignment( args, result, counter, len(assay_list), sample_code, filename )
         counter += 1
 
+    if cache:
+        cache.report()
+
+
+def report_alignment( args, result, counter, total, sample_code, filename ):
+
+    (dpscore, rss, no_of_peaks, no_of_ladders, qcscore, remarks, method) = result
+    if qcscore < 0.9:
+        msg = 'W! low ladder QC'
+    else:
+        msg = 'I:'
+    cerr( '%s [%d/%d] - Score %3.2f %4.2f %5.2f %d/%d %s for %s | %s'
+            % ( msg, counter, total,
+                qcscore, dpscore, rss, no_of_peaks, no_of_ladders,
+                method, sample_code, filename) )
+    if remarks:
+        cerr('%s - %s' % (msg, ' | '.join(remarks)))
+    if qcscore != 1.0 and args.abort:
+        sys.exit(1)
+
 
 def do_call(args, dbh):
 
     cerr('I: Calling peaks...')
 
-    scanning_parameter = params.Params()
-
+    kwargs = get_stage_kwargs( args, dbh, 'call' )
     assay_list = get_assay_list( args, dbh )
-    counter = 1
-    for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Calling: %s | %s' %
-                (counter, len(assay_list), sample_code, assay.filename))
-        assay.call( scanning_parameter )
-        counter += 1
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'call', 'Calling', **kwargs ):
+        pass
 
 
 def do_bin(args, dbh):
 
+    if args.bulk:
+        # whole batch can be binned without loading the assays
+        if args.batch and not (args.sample or args.assay or args.panel):
+            return do_rebin(args, dbh)
+        cerr('W: --bulk binning requires --batch only, using per-assay binning')
+
     cerr('I: Binning peaks...')
 
-    scanning_parameter = params.Params()
+    kwargs = get_stage_kwargs( args, dbh, 'bin' )
+    assay_list = get_assay_list( args, dbh )
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'bin', 'Binning', **kwargs ):
+        pass
+
+
+def do_rebin(args, dbh):
+
+    if not args.batch:
+        cexit('E: --rebin requires --batch')
 
     if args.marker:
         markers = [ dbh.get_marker( code ) for code in args.marker.split(',') ]
     else:
         markers = None
 
-
-    assay_list = get_assay_list( args, dbh )
-    counter = 1
-    for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Binning: %s | %s' %
-                (counter, len(assay_list), sample_code, assay.filename))
-        assay.bin( scanning_parameter, markers )
-        counter += 1
+    for batch_code in args.batch.split(','):
+        batch = dbh.get_batch( batch_code )
+        cerr('I: Re-binning peaks of batch %s...' % batch.code)
+        try:
+            updated = dbh.rebin_batch( batch, markers )
+        except RuntimeError as err:
+            cexit(str(err))
+        cerr('I: batch %s => %d allele(s) updated' % (batch.code, updated))
 
 
 def do_postannotate(args, dbh):
 
     cerr('I: Post-annotating peaks...')
 
-    scanning_parameter = params.Params()
-
-    if args.marker:
-        markers = [ dbh.get_marker( code ) for code in args.marker.split(',') ]
+    kwargs = get_stage_kwargs( args, dbh, 'postannotate' )
+    assay_list = get_assay_list( args, dbh )
+    for (sample_code, filename, result) in process_assays( args, dbh, assay_list,
+                'postannotate', 'Post-annotating', **kwargs ):
+        pass
+
+
+def do_fused(args, dbh):
+    """ run all requested stages on each assay before processing the next one; the
+        changes of an assay are flushed at once, and the assay is then released
+        from the session; return the number of stages
+    """
+
+    stages = [ stage for stage in FUSED_STAGES if getattr(args, stage) ]
+    if args.jobs > 1:
+        cexit('E: --fused can not be used with --jobs')
+    if args.rebin:
+        cexit('E: --fused can not be used with --rebin')
+    if args.bulk:
+        cerr('W: --bulk is ignored with --fused')
+
+    cerr('I: Processing assays with %s...' % ', '.join(stages))
+
+    if args.aligncache:
+        from fatools.lib.fautil import aligncache
+        cache = aligncache.set_cache(args.aligncache)
     else:
-        markers = None
-
-    if args.stutter_ratio > 0:
-        scanning_parameter.nonladder.stutter_ratio = args.stutter_ratio
-    if args.stutter_range > 0:
-        scanning_parameter.nonladder.stutter_range = args.stutter_range
+        cache = None
 
+    kwargs = { stage: get_stage_kwargs( args, dbh, stage ) for stage in stages }
+    session = dbh.session()
 
     assay_list = get_assay_list( args, dbh )
     counter = 1
     for (assay, sample_code) in assay_list:
-        cerr('I: [%d/%d] - Post-annotating: %s | %s' %
+        cerr('I: [%d/%d] - Processing: %s | %s' %
                 (counter, len(assay_list), sample_code, assay.filename))
-        assay.postannotate( scanning_parameter, markers )
+
+        # queries do not need the pending changes of this assay
+        with session.no_autoflush:
+            for stage in stages:
+                result = getattr(assay, stage)( **kwargs[stage] )
+                if stage == 'alignladder':
+                    report_alignment( args, result, counter, len(assay_list), sample_code,
+                            assay.filename )
+        dbh.repack_peaks()
+        session.flush()
+        dbh.release_assay( assay )
         counter += 1
 
+    if cache:
+        cache.report()
+    if 'scan' in kwargs and kwargs['scan']['peakdb']:
+        kwargs['scan']['peakdb'].close()
+        kwargs['scan']['peakdb'].report()
+    return len(stages)
+
+
+FUSED_STAGES = [ 'scan', 'preannotate', 'alignladder', 'call', 'bin', 'postannotate' ]
+
+
+def get_stage_kwargs( args, dbh, stage ):
+    """ return keyword arguments of the assay method of stage """
+
+    scanning_parameter = params.Params()
+
+    if stage == 'scan':
+        if args.peakcachedb:
+            from fatools.lib.fautil.peakcache import PeakCache
+            peakdb = PeakCache(args.peakcachedb)
+        else:
+            peakdb = None
+        if args.method:
+            scanning_parameter.ladder.method = args.method
+            scanning_parameter.nonladder.method = args.method
+        return dict( params = scanning_parameter, peakdb = peakdb )
+
+    if stage == 'alignladder':
+        return dict( excluded_peaks = args.excluded_peaks, force_mode = args.force )
+
+    if stage in ('bin', 'postannotate'):
+        if args.marker:
+            markers = [ dbh.get_marker( code ) for code in args.marker.split(',') ]
+        else:
+            markers = None
+        if stage == 'postannotate':
+            if args.stutter_ratio > 0:
+                scanning_parameter.nonladder.stutter_ratio = args.stutter_ratio
+            if args.stutter_range > 0:
+                scanning_parameter.nonladder.stutter_range = args.stutter_range
+        return dict( params = scanning_parameter, markers = markers )
+
+    return dict( params = scanning_parameter )
+
 
 
 def do_findpeaks( args, dbh ):
 
-    import leveldb
     from fatools.lib import params
+    from fatools.lib.fautil.peakcache import PeakCache
 
     cerr('Finding and caching peaks...')
 
     if not args.peakcachedb:
         cexit('ERR - please provide cache db filename')
 
-    # opening LevelDB database
     if args.peakcachedb == '-':
         peakdb = None
     else:
-        peakdb = leveldb.LevelDB(args.peakcachedb)
+        peakdb = PeakCache(args.peakcachedb)
 
     scanning_parameter = params.Params()
     assay_list = get_assay_list( args, dbh )
@@ -375,17 +511,22 @@ def do_findpeaks( args, dbh ):
     for (assay, sample_code) in assay_list:
         cerr('\rI: [%d/%d] processing assay' % (counter, len(assay_list)), nl=False)
         for c in assay.channels:
-            if c.marker.code == 'ladder':
-                params = scanning_parameter.ladder
+            params = c.scanning_params( scanning_parameter )
+            if peakdb:
+                key = peakdb.make_key( c.data, params, algo.FIND_RAW_PEAKS_VERSION )
+                if peakdb.get( key ) is not None:
+                    continue
             else:
-                params = scanning_parameter.nonladder
-            channel_list.append( (c.tag(), c.data, params) )
+                key = c.tag()
+            channel_list.append( (key, c.data, params) )
         counter += 1
     cerr('')
 
     do_parallel_find_peaks( channel_list, peakdb )
 
-    #peakdb.close()
+    if peakdb:
+        peakdb.close()
+        peakdb.report()
 
 
 
@@ -513,6 +654,29 @@ def do_showz( args, dbh ):
 
 # helpers
 
+def process_assays( args, dbh, assay_list, stage, label, **kwargs ):
+    """ run stage, ie. the name of the assay method, with kwargs on each assay and
+        yield (sample_code, filename, result); with --jobs, the assays are processed
+        by worker processes
+    """
+
+    total = len(assay_list)
+    if args.jobs > 1:
+        results = dbh.pipeline.run( stage, assay_list, kwargs )
+        for (counter, (sample_code, filename, result)) in enumerate(results, 1):
+            cerr('I: [%d/%d] - %s: %s | %s' % (counter, total, label, sample_code, filename))
+            yield (sample_code, filename, result)
+        return
+
+    counter = 1
+    for (assay, sample_code) in assay_list:
+        cerr('I: [%d/%d] - %s: %s | %s' % (counter, total, label, sample_code, assay.filename))
+        result = getattr(assay, stage)( **kwargs )
+        dbh.repack_peaks()
+        yield (sample_code, assay.filename, result)
+        counter += 1
+
+
 def get_assay_list( args, dbh ):
 
     if not args.batch:
@@ -536,13 +700,8 @@ def get_assay_list( args, dbh ):
     if args.panel:
         panels = args.panel.split(',')
 
-    assay_list = []
-    for sample in batch.samples:
-        if samples and sample.code not in samples: continue
-        for assay in sample.assays:
-            if assays and assay.filename not in assays: continue
-            if panels and assay.panel.code not in panels: continue
-            assay_list.append( (assay, sample.code) )
+    assay_list = dbh.get_assay_list( batch, sample_codes = samples, filenames = assays,
+                    panel_codes = panels )
 
     cerr('INFO - number of assays to be processed: %d' % len(assay_list))
     return assay_list
@@ -576,7 +735,7 @@ def printout_assay( assay, outfile=sys.stdout, fmt='text' ):
 
 def do_parallel_find_peaks( channel_list, peakdb ):
 
-    import concurrent.futures, pickle
+    import concurrent.futures
 
     cerr('I: Processing channel(s)')
     total = len(channel_list)
@@ -584,7 +743,7 @@ def do_parallel_find_peaks( channel_list, peakdb ):
     with concurrent.futures.ProcessPoolExecutor() as executor:
         for (tag, peaks) in executor.map( find_peaks_p, channel_list ):
             if peakdb:
-                peakdb.Put(tag.encode(), pickle.dumps(peaks))
+                peakdb.put(tag, peaks)
             else:
                 cout('== channel %s\n' % tag )
                 cout(str(peaks))
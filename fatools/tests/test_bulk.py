@@ -0,0 +1,74 @@
+# test_bulk.py
+
+import os, shutil, tempfile, unittest
+
+import numpy as np
+import transaction
+
+from fatools.scripts.dbbench import prepare_db, synthetic_peaks
+from fatools.lib.sqlmodels import schema
+from fatools.lib.sqlmodels.bulk import AlleleWriter
+
+
+class TestAlleleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine, self.session = prepare_db( os.path.join(self.tmpdir, 'test.db'), 4, 2 )
+        self.pack_peaks = schema.AlleleSet.pack_peaks
+        self.packed_storage = schema.AlleleSet.packed_storage
+        schema.AlleleSet.packed_storage = True
+
+
+    def tearDown(self):
+        schema.AlleleSet.pack_peaks = self.pack_peaks
+        schema.AlleleSet.packed_storage = self.packed_storage
+        self.session.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+
+    def scan(self, n_peaks=10):
+        """ write peaks of all channels in bulk, then set the status of the assays
+            after the last batch has been written, as facmd --scan does
+        """
+        rng = np.random.RandomState(1)
+        with transaction.manager:
+            sess = self.session()
+            marker = sess.query(schema.Marker).get(1)
+            writer = AlleleWriter(sess, schema.Allele, batch_size=n_peaks)
+            allelesets = []
+            for channel in sess.query(schema.Channel).order_by(schema.Channel.id):
+                alleleset = channel.new_alleleset()
+                alleleset.scanning_method = alleleset.calling_method = 'test'
+                alleleset.binning_method = 'test'
+                sess.add(alleleset)
+                writer.add_peaks(alleleset, marker, synthetic_peaks(n_peaks, rng))
+                allelesets.append(alleleset)
+            for assay in sess.query(schema.Assay):
+                assay.status = 'scanned'
+            writer.close()
+
+            self.assertEqual( [ assay.status for assay in sess.query(schema.Assay) ],
+                        [ 'scanned', 'scanned' ] )
+            self.assertEqual( [ len(a.all_alleles) for a in allelesets ], [ n_peaks ] * 4 )
+            self.assertEqual( writer.total, 4 * n_peaks )
+
+        sess = self.session()
+        self.assertEqual( [ assay.status for assay in sess.query(schema.Assay) ],
+                    [ 'scanned', 'scanned' ] )
+
+
+    def test_status_kept_after_last_batch(self):
+        self.scan()
+        self.assertEqual( self.session().query(schema.Allele).count(), 40 )
+
+
+    def test_status_kept_with_packed_peaks(self):
+        schema.AlleleSet.pack_peaks = True
+        self.scan()
+        self.assertEqual( self.session().query(schema.Allele).count(), 0 )
+
+
+if __name__ == '__main__':
+    unittest.main()
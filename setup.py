@@ -14,7 +14,6 @@ requires = [
     'matplotlib',
     'pyyaml',
     'pandas',
-    'leveldb',
     'attrs',
     ]
 